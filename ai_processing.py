@@ -1,16 +1,93 @@
 # ai_processing.py
 
 import asyncio
-import google.generativeai as genai
+import logging
 import os
-from config import GEMINI_API_KEYS
+from typing import Optional
+from config import GEMINI_API_KEYS, GEMINI_HEDGE_MODEL
+from metrics import measure
+import hedging
+import model_router
+import prompt_cache
 
-async def get_ai_review(prompt_template: str, task_text: str, audio_file_path: str) -> str:
+logger = logging.getLogger(__name__)
+
+# Модель для дублирующего запроса, если основной задерживается (см. hedging.py); по умолчанию та же,
+# что выбрал model_router
+HEDGE_MODEL_NAME = GEMINI_HEDGE_MODEL
+
+# google.generativeai импортируется почти секунду, поэтому загружается при первом запросе
+# или в фоновом прогреве после старта бота (см. warm_up)
+genai = None
+# Сколько рецензий сейчас в работе: по этому числу model_router видит нагрузку
+_reviews_in_flight = 0
+
+
+def _get_genai():
+    global genai
+    if genai is None:
+        import google.generativeai
+        genai = google.generativeai
+    return genai
+
+
+async def _load_genai():
+    # Если фоновый прогрев еще не закончился, импортируем в потоке, чтобы не блокировать бота
+    if genai is not None:
+        return genai
+    return await asyncio.to_thread(_get_genai)
+
+
+def warm_up():
+    """Заранее импортирует SDK Gemini. Вызывается в отдельном потоке после запуска бота."""
+    _get_genai()
+
+
+async def _generate(genai, api_key: str, model_name: str, generation_config: dict,
+                    instruction: str, prompt: str, task_text: str, audio_file):
+    """Один запрос рецензии: с инструкцией из кэша контекста, а если не вышло — с полным промптом."""
+    cached_model = await prompt_cache.get_model(genai, api_key, model_name, instruction, generation_config)
+    if cached_model is not None:
+        try:
+            with measure("gemini", "generate"):
+                return await cached_model.generate_content_async(
+                    [prompt_cache.request_text(task_text), audio_file]
+                )
+        except Exception as e:
+            # Кэш мог истечь или быть удален; повторяем тот же запрос с полным промптом
+            logger.warning("Запрос с кэшем промпта не удался, отправляем промпт целиком: %s", e)
+            prompt_cache.drop(api_key, model_name, instruction)
+    model = genai.GenerativeModel(model_name, generation_config=generation_config)
+    with measure("gemini", "generate"):
+        return await model.generate_content_async([prompt, audio_file])
+
+
+async def get_ai_review(prompt_template: str, task_text: str, audio_file_path: str,
+                        duration: Optional[float] = None, task_type: Optional[str] = None) -> str:
     """
     Генерирует рецензию от AI, НАПРЯМУЮ АНАЛИЗИРУЯ АУДИОФАЙЛ.
+    Модель выбирается по типу задания, длительности ответа и нагрузке (см. model_router.py).
     """
-    prompt = prompt_template.format(task_text=task_text, user_text="[АУДИООТВЕТ УЧЕНИКА ПРИКРЕПЛЕН К ЗАПРОСУ]")
-    
+    global _reviews_in_flight
+    _reviews_in_flight += 1
+    try:
+        return await _get_ai_review(prompt_template, task_text, audio_file_path, duration, task_type)
+    finally:
+        _reviews_in_flight -= 1
+
+
+async def _get_ai_review(prompt_template: str, task_text: str, audio_file_path: str,
+                         duration: Optional[float], task_type: Optional[str]) -> str:
+    # Текущая рецензия тоже учтена в _reviews_in_flight, поэтому вычитаем ее
+    route = model_router.choose_route(task_type, duration, _reviews_in_flight - 1)
+    model_name = route["model"]
+    generation_config = route["generation_config"]
+    hedge_model_name = HEDGE_MODEL_NAME or model_name
+    prompt = prompt_template.format(task_text=task_text, user_text=prompt_cache.USER_TEXT_REF)
+    # Инструкция типа задания берется из кэша контекста Gemini, отправляется только текст задания (см. prompt_cache.py)
+    instruction = prompt_cache.static_prompt(prompt_template)
+    genai = await _load_genai()
+
     for api_key in GEMINI_API_KEYS:
         try:
             genai.configure(api_key=api_key)
@@ -19,35 +96,42 @@ async def get_ai_review(prompt_template: str, task_text: str, audio_file_path: s
             # Используем стандартную функцию upload_file внутри run_in_executor,
             # чтобы она выполнялась в отдельном потоке и не блокировала бота.
             
-            print(f"Загрузка файла {audio_file_path} в Google AI...")
+            logger.debug("Загрузка файла %s в Google AI...", audio_file_path)
             loop = asyncio.get_running_loop()
             
             # genai.upload_file - это правильная функция для загрузки
-            audio_file = await loop.run_in_executor(
-                None, 
-                lambda: genai.upload_file(path=audio_file_path)
-            )
-            print("Файл успешно загружен.")
+            with measure("gemini", "upload"):
+                audio_file = await loop.run_in_executor(
+                    None, 
+                    lambda: genai.upload_file(path=audio_file_path)
+                )
+            logger.debug("Файл успешно загружен.")
             # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
 
-            model = genai.GenerativeModel('gemini-2.5-flash')
-            
-            print(f"Попытка использовать API ключ, который заканчивается на ...{api_key[-4:]}")
-            response = await model.generate_content_async([prompt, audio_file])
-            print("Запрос к Gemini API с аудиофайлом успешен.")
+            logger.debug("Попытка использовать API ключ, который заканчивается на ...%s", api_key[-4:])
+            # Дубль идет с тем же ключом: загруженный файл доступен только ему
+            response = await hedging.run(
+                lambda: _generate(genai, api_key, model_name, generation_config,
+                                  instruction, prompt, task_text, audio_file),
+                lambda: _generate(genai, api_key, hedge_model_name, generation_config,
+                                  instruction, prompt, task_text, audio_file),
+            )
+            prompt_cache.record_usage(response)
+            logger.info("Запрос к Gemini API с аудиофайлом успешен.")
 
             # Удаление файла также делаем неблокирующим способом
-            await loop.run_in_executor(
-                None,
-                lambda: genai.delete_file(name=audio_file.name)
-            )
-            print(f"Временный файл {audio_file.name} удален из Google AI.")
+            with measure("gemini", "delete"):
+                await loop.run_in_executor(
+                    None,
+                    lambda: genai.delete_file(name=audio_file.name)
+                )
+            logger.debug("Временный файл %s удален из Google AI.", audio_file.name)
 
             return response.text
         
         except Exception as e:
-            print(f"Ошибка с ключом ...{api_key[-4:]}: {e}")
+            logger.warning("Ошибка с ключом ...%s: %s", api_key[-4:], e)
             continue
             
-    print("Все API ключи не сработали.")
+    logger.error("Все API ключи не сработали.")
     return "Бот сейчас перегружен. Пожалуйста, попробуйте еще раз через несколько минут."
\ No newline at end of file
@@ -0,0 +1,129 @@
+# audio_processing.py
+
+import asyncio
+import importlib.util
+import logging
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from config import FFMPEG_BINARY, VOICE_PRESCREEN
+from metrics import describe, inc, measure
+import voice_analysis
+
+logger = logging.getLogger(__name__)
+
+# Проверка голосовых перед отправкой в Gemini: декодирование через ffmpeg,
+# поиск речи по энергии кадров (NumPy), обрезка тишины и пережатие в Opus для речи.
+# Сам анализ — в voice_analysis.py, он выполняется в пуле процессов.
+ENABLED = VOICE_PRESCREEN
+
+# Сколько процессов анализируют голосовые одновременно
+WORKERS = max(1, min(4, (os.cpu_count() or 2) // 2))
+# Если в очереди пула больше стольких записей на процесс, новые голосовые отправляются без проверки:
+# ожидание в очереди не должно стоить дольше, чем экономия на загрузке в Gemini
+MAX_QUEUE_PER_WORKER = 2
+VOICE_SKIPPED = "skipped"
+
+VOICE_OK = voice_analysis.VOICE_OK
+VOICE_EMPTY = voice_analysis.VOICE_EMPTY
+VOICE_UNCHECKED = "unchecked"
+
+PRESCREEN_METRIC = "egebot_voice_prescreen_total"
+BYTES_METRIC = "egebot_voice_prescreen_bytes_total"
+describe(PRESCREEN_METRIC, "Результаты проверки голосовых перед отправкой в Gemini")
+describe(BYTES_METRIC, "Размер голосовых до и после обрезки тишины, байт")
+
+_pool: Optional[ProcessPoolExecutor] = None
+_available: Optional[bool] = None
+# Сколько голосовых сейчас в пуле (в очереди или в работе)
+_in_pool = 0
+
+
+def is_available() -> bool:
+    """Проверка работает, только если есть ffmpeg и установлен numpy."""
+    global _available
+    if _available is None:
+        has_ffmpeg = shutil.which(FFMPEG_BINARY) is not None
+        has_numpy = importlib.util.find_spec("numpy") is not None
+        _available = has_ffmpeg and has_numpy
+        if not _available:
+            logger.warning(
+                "Проверка голосовых отключена: ffmpeg %s, numpy %s.",
+                "найден" if has_ffmpeg else "не найден", "найден" if has_numpy else "не установлен"
+            )
+    return _available
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            # Процессы порождаются из легкого сервера, а не из бота с его потоками и соединениями;
+            # предзагружается только voice_analysis, без main и aiogram
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["voice_analysis"])
+        else:
+            context = multiprocessing.get_context("spawn")
+        _pool = ProcessPoolExecutor(max_workers=WORKERS, mp_context=context)
+    return _pool
+
+
+async def warm_up():
+    """Запускает процессы пула заранее (вызывается из фонового прогрева в main.py)."""
+    if not ENABLED or not is_available():
+        return
+    loop = asyncio.get_running_loop()
+    pool = _get_pool()
+    await asyncio.gather(*(loop.run_in_executor(pool, voice_analysis.warm_up) for _ in range(WORKERS)))
+
+
+def shutdown():
+    """Останавливает процессы пула (вызывается при выходе из бота)."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def prescreen_voice(path: str) -> dict:
+    """
+    Проверяет голосовое перед отправкой в Gemini. Возвращает словарь со статусом
+    (VOICE_OK, VOICE_EMPTY, VOICE_SKIPPED или VOICE_UNCHECKED) и путем к файлу, который нужно отправить.
+    Если проверка недоступна, упала или пул перегружен, отправляется исходный файл.
+    """
+    global _in_pool
+    unchecked = {"status": VOICE_UNCHECKED, "path": path}
+    if not ENABLED or not is_available():
+        return unchecked
+    if _in_pool >= WORKERS * MAX_QUEUE_PER_WORKER:
+        inc(PRESCREEN_METRIC, result=VOICE_SKIPPED)
+        return {"status": VOICE_SKIPPED, "path": path}
+
+    output_path = f"{os.path.splitext(path)[0]}_speech.ogg"
+    loop = asyncio.get_running_loop()
+    _in_pool += 1
+    try:
+        with measure("audio", "prescreen"):
+            result = await loop.run_in_executor(
+                _get_pool(), voice_analysis.prescreen_file, FFMPEG_BINARY, path, output_path
+            )
+    except Exception as e:
+        logger.warning("Не удалось проверить голосовое %s: %s", path, e)
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        inc(PRESCREEN_METRIC, result=VOICE_UNCHECKED)
+        return unchecked
+    finally:
+        _in_pool -= 1
+
+    inc(PRESCREEN_METRIC, result=result["status"])
+    inc(BYTES_METRIC, result["bytes_in"], stage="received")
+    inc(BYTES_METRIC, result["bytes_out"], stage="uploaded")
+    logger.info(
+        "Голосовое %s: %s, речь %s из %s сек., %s -> %s байт.",
+        path, result["status"], result["speech_seconds"], result["duration"], result["bytes_in"], result["bytes_out"]
+    )
+    return result
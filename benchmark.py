@@ -0,0 +1,2688 @@
+# benchmark.py
+"""
+Нагрузочный прогон бота без внешних сервисов.
+
+Запускает настоящий router из handlers.py (через main.create_dispatcher) и локальные
+заглушки Bot API, Gemini и Robokassa OpState. Синтетические пользователи проходят
+сценарии (старт, выбор задания, голосовой ответ, проверка оплаты) с заданной
+параллельностью. В конце печатаются p50/p95/p99 задержки и апдейты в секунду,
+а результат дописывается в benchmark_results.jsonl вместе с коммитом, чтобы
+регрессии между коммитами было видно сразу.
+
+С --soak бот гоняется часами, а отчет показывает рост RSS, памяти по tracemalloc
+(с разбивкой по модулям), дескрипторов и задач asyncio. При превышении порогов
+скрипт завершается с кодом 1.
+
+С --log-stall N скрипт пишет N строк лога в дочернем процессе за медленным читателем stdout — через
+print() и через очередь log_manager — и сравнивает самые долгие задержки цикла событий.
+
+С --schema-queries N скрипт заполняет базу N пользователями и сравнивает запросы, ради которых
+заведены индексы (поиск по username, подписчики, истекающие подписки, очистка счетов), с полным
+просмотром таблицы (NOT INDEXED), и печатает план каждого запроса.
+
+С --history N скрипт заполняет историю разборов N записями и замеряет размер базы,
+сжатие и скорость постраничного чтения истории.
+
+С --seen-sets N скрипт заполняет наборы полученных заданий N пользователей (лист из
+--seen-catalog заданий) и замеряет их размер в базе и в памяти, выбор задания без повторов
+при разной заполненности набора и перенос наборов после изменения списка заданий.
+
+С --stats N скрипт заполняет базу N разборами и оплатами за год и сравнивает экран статистики
+(сводки stats_hourly/stats_daily) с теми же цифрами, посчитанными запросами по истории,
+а также замеряет, сколько триггеры сводок добавляют к записи события.
+
+С --export N скрипт заполняет базу N пользователями и счетами и замеряет выгрузку для админов:
+время, размер архива, RSS во время выгрузки и задержки цикла событий, пока она идет.
+
+С --storage-suite скрипт проверяет, что хранилища SQLite и PostgreSQL (--storage-backend) ведут себя
+одинаково: параллельные резервы не уходят в минус, счет проводится один раз, супер-админ не удаляется,
+заблокировавшие бота пропускаются, предупреждение об окончании подписки берет в работу один хост,
+история разборов и наборы полученных заданий общие. Для PostgreSQL проверяется и перенос из users.db
+(import_sqlite). Затем замеряет операции хранилища в секунду на --users сессиях.
+Без --postgres-dsn поднимается встроенный PostgreSQL (пакет pgserver); таблицы создаются во временной
+схеме и удаляются после прогона. При нарушениях скрипт завершается с кодом 1.
+
+С --credit-stress N каждый из 50 пользователей с балансом 5 заданий одновременно отправляет N ответов
+(на хранилищах --storage-backend). Проверяется, что списано не больше, чем было, баланс не уходит
+в минус, резерв не завершается дважды, а сумма журнала сходится с балансом; иначе код выхода 1.
+
+С --payment-taps N один пользователь N раз одновременно жмет «проверить оплату»: при сбое Robokassa,
+пока счет не оплачен и после оплаты. Проверяется, что на каждую пачку уходит один запрос OpState,
+сбой не запоминается как «не оплачено», а счет проводится и задание начисляется один раз.
+
+С --broadcast N скрипт рассылает сообщение N пользователям через заглушку Bot API, которая отвечает 403
+заблокировавшим бота и 429 с retry_after. На середине рассылка прерывается и продолжается с сохраненной
+позиции. Проверяется, что каждый получил сообщение один раз, заблокировавшие помечены, бесконечный 429
+не вешает рассылку, а счетчики совпадают с ответами Telegram.
+
+С --profiler-check N скрипт прогоняет сценарий (--scenario) на N пользователях без профилировщика
+и с ним, записывая каждый апдейт как медленный, и печатает накладные расходы и долю базы, внешних
+вызовов и прочего. Проверяется, что вложенные замеры базы и параллельные вызовы одной зависимости
+не завышают время; иначе код выхода 1.
+
+С --throttle-overhead N скрипт только замеряет, сколько микросекунд на апдейт добавляет
+защита от флуда. В обычном прогоне она выключена (синтетические пользователи действуют
+быстрее людей); --throttle включает ее, а сценарий flood проверяет отказы.
+
+С --import-budget скрипт только проверяет, сколько стоит импорт бота сверх импорта
+aiogram, и что тяжелые SDK (Gemini, pandas, openpyxl) не загружаются при старте.
+
+Примеры:
+    python benchmark.py --users 300 --concurrency 50 --scenario mixed
+    python benchmark.py --soak 14400 --users 50 --soak-sample-interval 300
+    python benchmark.py --import-budget 0.5
+    python benchmark.py --log-stall 3000
+    python benchmark.py --schema-queries 1000000
+    python benchmark.py --history 1000000
+    python benchmark.py --seen-sets 100000 --seen-catalog 1000
+    python benchmark.py --stats 1000000
+    python benchmark.py --export 3000000
+    python benchmark.py --payment-taps 50
+    python benchmark.py --broadcast 200
+    python benchmark.py --profiler-check 100 --scenario voice --gemini-latency 0.2
+    python benchmark.py --storage-suite --users 1000 --postgres-dsn postgresql://bot@db/egebot
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import gc
+import glob
+import importlib.util
+import itertools
+import json
+import math
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import zipfile
+import time
+import tracemalloc
+import urllib.request
+import zlib
+from collections import Counter, defaultdict, deque
+from types import SimpleNamespace
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from aiohttp import ClientSession, web
+
+# Бот читает настройки из окружения при импорте. В прогоне нельзя обращаться к настоящим
+# сервисам, поэтому все ключи заменяются заглушками до импорта модулей бота.
+BENCHMARK_ENV = {
+    "TELEGRAM_TOKEN": "123456:BENCHMARK-TOKEN",
+    "ADMIN_PASSWORD": "benchmark",
+    "GEMINI_API_KEY": "benchmark-key",
+    "ROBOKASSA_MERCHANT_LOGIN": "benchmark",
+    "ROBOKASSA_PASSWORD_1": "benchmark-1",
+    "ROBOKASSA_PASSWORD_2": "benchmark-2",
+    "ROBOKASSA_TEST_PASSWORD_1": "benchmark-test-1",
+    "ROBOKASSA_TEST_PASSWORD_2": "benchmark-test-2",
+    "METRICS_PORT": "0",
+    "LOG_LEVEL": "WARNING",
+}
+os.environ.update(BENCHMARK_ENV)
+# Файлы заданий, текстов и цен читаются относительно рабочей папки
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+os.chdir(REPO_DIR)
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+import ai_processing  # noqa: E402
+import audio_processing  # noqa: E402
+import broadcast  # noqa: E402
+import database as db  # noqa: E402
+import hedging  # noqa: E402
+import metrics  # noqa: E402
+import model_router  # noqa: E402
+import profiler  # noqa: E402
+import prompt_cache  # noqa: E402
+import robokassa_api  # noqa: E402
+import task_manager as tm  # noqa: E402
+import seen_tasks  # noqa: E402
+import storage  # noqa: E402
+import export  # noqa: E402
+import throttling  # noqa: E402
+from config import FFMPEG_BINARY, SUPER_ADMIN_ID, TELEGRAM_TOKEN  # noqa: E402
+from log_manager import stop_logging  # noqa: E402
+from main import create_dispatcher  # noqa: E402
+
+RESULTS_FILE = "benchmark_results.jsonl"
+# Насколько p95 может вырасти (или пропускная способность упасть), прежде чем считать это регрессией
+REGRESSION_TOLERANCE = 0.10
+FIRST_USER_ID = 10_000_000
+FLOOD_CLICKS = 30
+FAKE_REVIEW = "Хороший ответ. Обратите внимание на интонацию в конце фразы."
+# Минимальный OGG-заголовок: боту нужен только файл, содержимое не разбирается
+FAKE_VOICE = b"OggS" + b"\0" * 1020
+# Модели заглушки Gemini: множитель задержки и условные цены в $ за 1 млн токенов
+# (порядок цен как у публичного прайса; нужны только для сравнения прогонов между собой)
+FAKE_MODELS = {
+    "gemini-2.5-flash": {"latency": 1.0, "audio": 1.00, "text": 0.30, "output": 2.50},
+    "gemini-2.5-flash-lite": {"latency": 0.5, "audio": 0.30, "text": 0.10, "output": 0.40},
+}
+# Gemini считает аудио по 32 токена в секунду; кэшированный контекст стоит четверть обычного
+AUDIO_TOKENS_PER_SECOND = 32
+CACHED_TOKEN_DISCOUNT = 0.25
+FAKE_OUTPUT_TOKENS = 800
+
+
+# --- Заглушки внешних сервисов ---
+
+class FakeServices:
+    """Один aiohttp-сервер: /tg — Bot API, /gemini — Gemini, /robokassa — OpState."""
+
+    def __init__(self, telegram_latency: float, gemini_latency: float,
+                 robokassa_latency: float, paid_ratio: float):
+        self.telegram_latency = telegram_latency
+        self.gemini_latency = gemini_latency
+        self.robokassa_latency = robokassa_latency
+        self.paid_ratio = paid_ratio
+        # Ответы copyMessage для рассылки: заблокировавшие бота (403), сколько раз ответить 429,
+        # и сколько сообщений дошло до каждого чата
+        self.blocked_chats: set = set()
+        self.flood_chats: Counter = Counter()
+        self.flood_retry_after = 1
+        self.copied: Counter = Counter()
+        # Если задан, OpState отвечает этим HTTP-статусом вместо XML (сбой Robokassa)
+        self.robokassa_error_status: Optional[int] = None
+        # Доля «зависших» генераций и их задержка (хвост распределения, как у настоящего Gemini)
+        self.gemini_slow_ratio = 0.0
+        self.gemini_slow_latency = 0.0
+        # Для оценки стоимости: сколько секунд аудио в каждом запросе
+        self.voice_seconds = 0
+        self.cost_usd: Counter = Counter()
+        self.calls: Counter = Counter()
+        self.bytes: Counter = Counter()
+        # Что отдавать при скачивании голосовых: по умолчанию заглушка, с --voice-corpus — синтетические записи
+        self.voice_files: List[bytes] = [FAKE_VOICE]
+        self._message_ids = itertools.count(1000)
+        self._file_ids = itertools.count(1)
+        self._cache_ids = itertools.count(1)
+        self.caches: Dict[str, int] = {}
+        self._runner = None
+        self.base_url = ""
+
+    async def start(self):
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post("/tg/bot{token}/{method}", self._telegram_method)
+        app.router.add_get("/tg/file/bot{token}/{path:.*}", self._telegram_file)
+        app.router.add_post("/gemini/upload", self._gemini_upload)
+        app.router.add_post("/gemini/generate", self._gemini_generate)
+        app.router.add_delete("/gemini/files/{name}", self._gemini_delete)
+        app.router.add_post("/gemini/count_tokens", self._gemini_count_tokens)
+        app.router.add_post("/gemini/caches", self._gemini_cache_create)
+        app.router.add_delete("/gemini/cachedContents/{name}", self._gemini_cache_delete)
+        app.router.add_get("/robokassa/OpState", self._robokassa_op_state)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _message(self, chat_id: int, text: str = "") -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text,
+        }
+
+    async def _telegram_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        self.calls[f"telegram.{method}"] += 1
+        if self.telegram_latency:
+            await asyncio.sleep(self.telegram_latency)
+
+        chat_id = int(data.get("chat_id") or 0)
+        if method in ("answerCallbackQuery", "deleteMessage"):
+            result = True
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        elif method == "getFile":
+            result = {"file_id": data.get("file_id"), "file_unique_id": "voice",
+                      "file_path": f"voice/{data.get('file_id')}.oga"}
+        elif method == "getChat":
+            result = {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"}
+        elif method == "copyMessage":
+            if chat_id in self.blocked_chats:
+                return web.json_response({"ok": False, "error_code": 403,
+                                          "description": "Forbidden: bot was blocked by the user"}, status=403)
+            if self.flood_chats[chat_id] > 0:
+                self.flood_chats[chat_id] -= 1
+                return web.json_response({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.flood_retry_after}",
+                    "parameters": {"retry_after": self.flood_retry_after},
+                }, status=429)
+            self.copied[chat_id] += 1
+            result = {"message_id": next(self._message_ids)}
+        elif method == "sendMediaGroup":
+            result = [self._message(chat_id), self._message(chat_id)]
+        else:
+            result = self._message(chat_id, data.get("text", ""))
+        return web.json_response({"ok": True, "result": result})
+
+    async def _telegram_file(self, request: web.Request) -> web.Response:
+        self.calls["telegram.download"] += 1
+        path = request.match_info["path"]
+        return web.Response(body=self.voice_files[zlib.crc32(path.encode()) % len(self.voice_files)])
+
+    async def _gemini_upload(self, request: web.Request) -> web.Response:
+        self.bytes["gemini.upload"] += len(await request.read())
+        self.calls["gemini.upload"] += 1
+        return web.json_response({"name": f"files/benchmark-{next(self._file_ids)}"})
+
+    async def _gemini_generate(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        model = data["model"].replace("models/", "")
+        profile = FAKE_MODELS.get(model)
+        if profile is None:
+            return web.json_response({"error": f"unknown model {model}"}, status=404)
+        self.calls["gemini.generate"] += 1
+        self.calls[f"gemini.generate.{model}"] += 1
+        self.bytes["gemini.prompt"] += data["prompt_bytes"]
+        cached_bytes = 0
+        if data.get("cached_content"):
+            if data["cached_content"] not in self.caches:
+                return web.json_response({"error": "cached content not found"}, status=404)
+            cached_bytes = self.caches[data["cached_content"]]
+        latency = self.gemini_latency * profile["latency"]
+        if random.random() < self.gemini_slow_ratio:
+            latency = self.gemini_slow_latency
+        if latency:
+            await asyncio.sleep(latency)
+        # Токены текста условно считаются по 4 байта
+        usage = {"prompt_token_count": (data["prompt_bytes"] + cached_bytes) // 4,
+                 "cached_content_token_count": cached_bytes // 4}
+        self.cost_usd[model] += (
+            self.voice_seconds * AUDIO_TOKENS_PER_SECOND * profile["audio"]
+            + data["prompt_bytes"] // 4 * profile["text"]
+            + cached_bytes // 4 * profile["text"] * CACHED_TOKEN_DISCOUNT
+            + FAKE_OUTPUT_TOKENS * profile["output"]
+        ) / 1_000_000
+        return web.json_response({"text": FAKE_REVIEW, "usage_metadata": usage})
+
+    async def _gemini_count_tokens(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        self.calls["gemini.count_tokens"] += 1
+        # Токены текста условно считаются по 4 байта, как в _gemini_generate
+        return web.json_response({"total_tokens": data["prompt_bytes"] // 4})
+
+    async def _gemini_cache_create(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        self.calls["gemini.cache_create"] += 1
+        self.bytes["gemini.prompt"] += data["prompt_bytes"]
+        name = f"cachedContents/benchmark-{next(self._cache_ids)}"
+        self.caches[name] = data["prompt_bytes"]
+        return web.json_response({"name": name, "model": data["model"]})
+
+    async def _gemini_cache_delete(self, request: web.Request) -> web.Response:
+        self.calls["gemini.cache_delete"] += 1
+        self.caches.pop(f"cachedContents/{request.match_info['name']}", None)
+        return web.json_response({})
+
+    async def _gemini_delete(self, request: web.Request) -> web.Response:
+        self.calls["gemini.delete"] += 1
+        return web.json_response({})
+
+    async def _robokassa_op_state(self, request: web.Request) -> web.Response:
+        self.calls["robokassa.op_state"] += 1
+        if self.robokassa_latency:
+            await asyncio.sleep(self.robokassa_latency)
+        if self.robokassa_error_status is not None:
+            return web.Response(status=self.robokassa_error_status, text="Service Unavailable")
+        state = 100 if random.random() < self.paid_ratio else 5
+        body = (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<OperationStateResponse xmlns="http://merchant.roboxchange.com/WebService/">'
+            f'<Result><Code>0</Code></Result><State><Code>{state}</Code></State>'
+            '</OperationStateResponse>'
+        )
+        return web.Response(text=body, content_type="text/xml")
+
+
+def _prompt_bytes(contents) -> int:
+    """Сколько байт текста промпта в запросе (файлы не считаются)."""
+    return sum(len(part.encode("utf-8")) for part in contents if isinstance(part, str))
+
+
+class FakeGenAI:
+    """
+    Подменяет модуль google.generativeai внутри ai_processing: те же вызовы
+    (configure, upload_file, GenerativeModel с count_tokens, delete_file, caching.CachedContent),
+    но запросы идут в заглушку.
+    """
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self._session = None
+        self.GenerativeModel = FakeModelFactory(self)
+        self.caching = SimpleNamespace(CachedContent=SimpleNamespace(create=self._create_cache))
+
+    def configure(self, **kwargs):
+        pass
+
+    def upload_file(self, path: str):
+        with open(path, "rb") as f:
+            request = urllib.request.Request(f"{self.base_url}/upload", data=f.read(), method="POST")
+        with urllib.request.urlopen(request) as response:
+            return SimpleNamespace(**json.load(response))
+
+    def delete_file(self, name: str):
+        request = urllib.request.Request(f"{self.base_url}/{name}", method="DELETE")
+        urllib.request.urlopen(request).close()
+
+    def _create_cache(self, model: str, contents, **kwargs):
+        payload = json.dumps({"model": model, "prompt_bytes": _prompt_bytes(contents)}).encode()
+        request = urllib.request.Request(f"{self.base_url}/caches", data=payload, method="POST",
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as response:
+            data = json.load(response)
+        # DELETE /gemini/cachedContents/<id> — тот же запрос, что и удаление файла
+        return SimpleNamespace(name=data["name"], model=data["model"],
+                               delete=lambda: self.delete_file(name=data["name"]))
+
+    async def post(self, path: str, payload: dict) -> dict:
+        if self._session is None:
+            self._session = ClientSession()
+        async with self._session.post(f"{self.base_url}{path}", json=payload) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+class FakeModelFactory:
+    """genai.GenerativeModel: вызывается как класс и умеет from_cached_content."""
+
+    def __init__(self, genai: FakeGenAI):
+        self._genai = genai
+
+    def __call__(self, model_name: str, **kwargs):
+        return FakeGenerativeModel(self._genai, model_name)
+
+    def from_cached_content(self, cached_content, **kwargs):
+        return FakeGenerativeModel(self._genai, cached_content.model, cached_content.name)
+
+
+class FakeGenerativeModel:
+    def __init__(self, genai: FakeGenAI, model_name: str, cached_content: str = ""):
+        self._genai = genai
+        self.model_name = model_name
+        self.cached_content = cached_content
+
+    def count_tokens(self, contents, **kwargs):
+        payload = json.dumps({"model": self.model_name, "prompt_bytes": _prompt_bytes(
+            [contents] if isinstance(contents, str) else contents)}).encode()
+        request = urllib.request.Request(f"{self._genai.base_url}/count_tokens", data=payload, method="POST",
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as response:
+            return SimpleNamespace(**json.load(response))
+
+    async def generate_content_async(self, contents, **kwargs):
+        data = await self._genai.post("/generate", {
+            "model": self.model_name,
+            "cached_content": self.cached_content,
+            "prompt_bytes": _prompt_bytes(contents),
+        })
+        return SimpleNamespace(text=data["text"], usage_metadata=SimpleNamespace(**data["usage_metadata"]))
+
+
+# --- Синтетические апдейты ---
+
+class TraceBuilder:
+    """Строит апдейты от имени одного пользователя."""
+
+    _update_ids = itertools.count(1)
+
+    def __init__(self, user_id: int):
+        self.user = {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"bench{user_id}"}
+        self.chat = {"id": user_id, "type": "private"}
+        self._message_ids = itertools.count(1)
+
+    def _message(self, **fields) -> dict:
+        return {"message_id": next(self._message_ids), "date": int(time.time()),
+                "chat": self.chat, "from": self.user, **fields}
+
+    def text(self, text: str) -> Update:
+        return Update(update_id=next(self._update_ids), message=self._message(text=text))
+
+    def voice(self, duration: int) -> Update:
+        voice = {"file_id": f"voice-{self.user['id']}", "file_unique_id": "voice", "duration": duration}
+        return Update(update_id=next(self._update_ids), message=self._message(voice=voice))
+
+    def callback(self, data: str) -> Update:
+        callback_query = {
+            "id": str(next(self._update_ids)),
+            "from": self.user,
+            "chat_instance": "benchmark",
+            "data": data,
+            "message": self._message(text="menu"),
+        }
+        return Update(update_id=next(self._update_ids), callback_query=callback_query)
+
+
+def build_trace(scenario: str, builder: TraceBuilder, task_types: List[str], voice_duration: int) -> List:
+    """Возвращает список шагов (название шага, апдейт) для одного пользователя."""
+    start = [("start", builder.text("/start"))]
+    task = [
+        ("get_task", builder.callback("get_task")),
+        ("select_task", builder.callback(f"select_task_{random.choice(task_types)}")),
+    ]
+    voice = [("voice", builder.voice(voice_duration))]
+    # Пользователь, который без остановки жмет «Получить задание»
+    flood = [("flood", builder.callback("get_task")) for _ in range(FLOOD_CLICKS)]
+    payment = [
+        ("subscribe_menu", builder.callback("show_subscribe_options")),
+        ("buy", builder.callback("buy_week")),
+        ("check_payment", builder.callback("check_robokassa_payment")),
+    ]
+    traces = {
+        "start": start,
+        "task": start + task,
+        "voice": start + task + voice,
+        "payment": start + payment,
+        "flood": start + flood,
+    }
+    if scenario == "mixed":
+        scenario = random.choices(["start", "task", "voice", "payment"], weights=[2, 3, 3, 2])[0]
+    return traces[scenario]
+
+
+# --- Синтетические голосовые ---
+
+CORPUS_SAMPLE_RATE = 48000
+# Голосовые Telegram — Opus моно около 32 кбит/с
+CORPUS_BITRATE = "32k"
+CORPUS_NOISE_DB = -60
+
+
+def _synthetic_speech(rng, seconds: float):
+    """Похожий на речь сигнал: "слоги" из гармоник основного тона, разделенные паузами."""
+    import numpy as np
+
+    rate = CORPUS_SAMPLE_RATE
+    parts, total = [], 0
+    while total < seconds * rate:
+        syllable = int(rng.uniform(0.12, 0.3) * rate)
+        pause = int(rng.uniform(0.04, 0.35) * rate)
+        t = np.arange(syllable) / rate
+        f0 = rng.uniform(110, 240)
+        tone = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 6))
+        parts += [0.25 * tone * np.sin(np.pi * np.arange(syllable) / syllable), np.zeros(pause)]
+        total += syllable + pause
+    return np.concatenate(parts)[:int(seconds * rate)]
+
+
+def build_voice_corpus() -> Dict[str, bytes]:
+    """
+    Синтетические записи: тишина, случайное нажатие, речь с длинной тишиной по краям
+    и сплошная речь. Кодируются в OGG/Opus так же, как голосовые Telegram.
+    """
+    import numpy as np
+
+    rate = CORPUS_SAMPLE_RATE
+    rng = np.random.default_rng(1)
+
+    def noise(seconds: float):
+        return rng.normal(0, 10 ** (CORPUS_NOISE_DB / 20), int(seconds * rate))
+
+    tap = noise(4)
+    tap[rate:rate + int(0.06 * rate)] += rng.uniform(-0.5, 0.5, int(0.06 * rate))
+    clips = {
+        "silence": noise(15),
+        "tap": tap,
+        "padded_speech": np.concatenate([noise(4), _synthetic_speech(rng, 20) + noise(20), noise(6)]),
+        "speech": _synthetic_speech(rng, 30) + noise(30),
+    }
+    corpus = {}
+    for name, signal in clips.items():
+        pcm = (np.clip(signal, -1, 1) * 32767).astype(np.int16).tobytes()
+        corpus[name] = subprocess.run(
+            [FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-f", "s16le", "-ar", str(rate), "-ac", "1",
+             "-i", "pipe:0", "-c:a", "libopus", "-b:a", CORPUS_BITRATE, "-f", "ogg", "pipe:1"],
+            input=pcm, capture_output=True, check=True,
+        ).stdout
+    return corpus
+
+
+async def report_prescreen(corpus: Dict[str, bytes]):
+    """Печатает, что проверка голосовых делает с каждой записью корпуса и сколько это занимает."""
+    print(f"{'запись':<16}{'результат':>10}{'речь, с':>9}{'байт до':>10}{'байт после':>12}{'время, мс':>11}")
+    with tempfile.TemporaryDirectory(prefix="egebot-voice-") as directory:
+        for name, data in corpus.items():
+            path = os.path.join(directory, f"{name}.ogg")
+            with open(path, "wb") as f:
+                f.write(data)
+            started = time.perf_counter()
+            result = await audio_processing.prescreen_voice(path)
+            elapsed = (time.perf_counter() - started) * 1000
+            print(f"{name:<16}{result['status']:>10}{result.get('speech_seconds', '-'):>9}"
+                  f"{len(data):>10}{result.get('bytes_out', len(data)):>12}{elapsed:>11.1f}")
+
+
+# --- Прогон и отчет ---
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[index]
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50) * 1000, 2),
+        "p95": round(percentile(values, 95) * 1000, 2),
+        "p99": round(percentile(values, 99) * 1000, 2),
+        "max": round(values[-1] * 1000, 2) if values else 0.0,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class Harness:
+    """Бот с заглушками сервисов. Общий для нагрузочного прогона и soak-теста."""
+
+    def __init__(self, args):
+        self.args = args
+        self.services = FakeServices(args.telegram_latency, args.gemini_latency,
+                                     args.robokassa_latency, args.paid_ratio)
+        self.services.gemini_slow_ratio = args.gemini_slow_ratio
+        self.services.gemini_slow_latency = args.gemini_slow_latency
+        self.services.voice_seconds = args.voice_duration
+        self.fake_genai = None
+        self.bot = None
+        self.dp = None
+        self.task_types: List[str] = []
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+
+    async def start(self):
+        await self.services.start()
+        self.fake_genai = FakeGenAI(f"{self.services.base_url}/gemini")
+        ai_processing.genai = self.fake_genai
+        robokassa_api.OPSTATE_URL = f"{self.services.base_url}/robokassa/OpState"
+        audio_processing.ENABLED = self.args.prescreen
+        prompt_cache.ENABLED = not self.args.no_prompt_cache
+        hedging.ENABLED = self.args.hedge
+        throttling.ENABLED = self.args.throttle
+        if self.args.hedge_min_delay is not None:
+            hedging.MIN_DELAY = self.args.hedge_min_delay
+        if self.args.pressure_threshold is not None:
+            model_router.PRESSURE_THRESHOLD = self.args.pressure_threshold
+        if self.args.voice_corpus:
+            corpus = build_voice_corpus()
+            self.services.voice_files = list(corpus.values())
+            await audio_processing.warm_up()
+            await report_prescreen(corpus)
+
+        workdir = tempfile.mkdtemp(prefix="egebot-bench-")
+        db.DB_FILE = os.path.join(workdir, "users.db")
+        await db.db_start()
+
+        session = AiohttpSession(api=TelegramAPIServer.from_base(f"{self.services.base_url}/tg"))
+        self.bot = Bot(token=TELEGRAM_TOKEN, session=session)
+        self.dp = create_dispatcher(self.bot)
+        self.task_types = tm.get_task_types()
+
+    async def stop(self):
+        await db.flush_user_writes()
+        if self.bot is not None:
+            await self.bot.session.close()
+        if self.fake_genai is not None:
+            await self.fake_genai.close()
+        await self.services.stop()
+        audio_processing.shutdown()
+
+    async def run_users(self, user_ids: Iterable[int]):
+        """Прогоняет сценарий для каждого пользователя, не больше concurrency одновременно."""
+        args = self.args
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def run_user(user_id: int):
+            async with semaphore:
+                for step, update in build_trace(args.scenario, TraceBuilder(user_id), self.task_types, args.voice_duration):
+                    started = time.perf_counter()
+                    try:
+                        await self.dp.feed_update(self.bot, update)
+                    except Exception as e:
+                        self.errors[f"{step}: {type(e).__name__}"] += 1
+                    self.latencies[step].append(time.perf_counter() - started)
+                    if args.think_time:
+                        await asyncio.sleep(args.think_time)
+
+        await asyncio.gather(*(run_user(user_id) for user_id in user_ids))
+
+
+def benchmark_params(args) -> dict:
+    return {
+        "scenario": args.scenario,
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "telegram_latency": args.telegram_latency,
+        "gemini_latency": args.gemini_latency,
+        "gemini_slow_ratio": args.gemini_slow_ratio,
+        "gemini_slow_latency": args.gemini_slow_latency,
+        "robokassa_latency": args.robokassa_latency,
+        "think_time": args.think_time,
+        "voice_corpus": args.voice_corpus,
+        "prescreen": args.prescreen,
+        "prompt_cache": not args.no_prompt_cache,
+        "hedge": args.hedge,
+        "throttle": args.throttle,
+        "pressure_threshold": model_router.PRESSURE_THRESHOLD if args.pressure_threshold is None else args.pressure_threshold,
+    }
+
+
+async def run_benchmark(args) -> dict:
+    harness = Harness(args)
+    await harness.start()
+    started = time.perf_counter()
+    try:
+        await harness.run_users(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+        elapsed = time.perf_counter() - started
+    finally:
+        await harness.stop()
+
+    latencies = harness.latencies
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "params": benchmark_params(args),
+        "updates": len(all_latencies),
+        "elapsed": round(elapsed, 3),
+        "updates_per_sec": round(len(all_latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {"all": summarize(all_latencies),
+                       **{step: summarize(values) for step, values in sorted(latencies.items())}},
+        "errors": dict(harness.errors),
+        "external_calls": dict(sorted(harness.services.calls.items())),
+        "gemini_upload_bytes": harness.services.bytes["gemini.upload"],
+        "gemini_prompt_bytes": harness.services.bytes["gemini.prompt"],
+        "gemini_cost_usd": {model: round(cost, 4) for model, cost in sorted(harness.services.cost_usd.items())},
+        "throttled": dict(throttling.throttle_stats),
+    }
+
+
+def load_previous(params: dict):
+    """Последний сохраненный результат с теми же параметрами."""
+    if not os.path.exists(RESULTS_FILE):
+        return None
+    previous = None
+    with open(RESULTS_FILE, encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry.get("params") == params:
+                previous = entry
+    return previous
+
+
+def compare(result: dict, previous: dict) -> List[str]:
+    """Возвращает список найденных регрессий относительно прошлого прогона."""
+    regressions = []
+    for step, current in result["latency_ms"].items():
+        before = previous["latency_ms"].get(step)
+        if before and before["p95"] and current["p95"] > before["p95"] * (1 + REGRESSION_TOLERANCE):
+            regressions.append(f"{step}: p95 {before['p95']} -> {current['p95']} мс")
+    if result["updates_per_sec"] < previous["updates_per_sec"] * (1 - REGRESSION_TOLERANCE):
+        regressions.append(f"пропускная способность {previous['updates_per_sec']} -> {result['updates_per_sec']} апд./сек.")
+    return regressions
+
+
+def print_report(result: dict, previous):
+    print(f"Коммит {result['commit']}: {result['updates']} апдейтов за {result['elapsed']} сек. "
+          f"({result['updates_per_sec']} апд./сек.)")
+    print(f"{'шаг':<16}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for step, stats in result["latency_ms"].items():
+        print(f"{step:<16}{stats['count']:>8}{stats['p50']:>10}{stats['p95']:>10}{stats['p99']:>10}{stats['max']:>10}")
+    if result["errors"]:
+        print("Ошибки:", result["errors"])
+    print("Внешние вызовы:", result["external_calls"])
+    print(f"Загружено в Gemini: {result['gemini_upload_bytes']} байт аудио, "
+          f"{result.get('gemini_prompt_bytes', 0)} байт текста промптов")
+    if result.get("throttled"):
+        print("Отклонено защитой от флуда:", result["throttled"])
+    cost = result.get("gemini_cost_usd") or {}
+    if cost:
+        print(f"Условная стоимость Gemini: ${sum(cost.values()):.4f}", cost)
+    if previous is not None:
+        print(f"Сравнение с коммитом {previous['commit']} ({previous['updates_per_sec']} апд./сек., "
+              f"p95 {previous['latency_ms']['all']['p95']} мс)")
+
+
+# --- Soak-тест: многочасовой прогон с отслеживанием утечек ---
+
+SOAK_TRACEMALLOC_FRAMES = 10
+SOAK_TOP_ALLOCATORS = 15
+
+
+def read_rss_mb() -> float:
+    """Текущий RSS процесса. Без /proc (не Linux) — пиковый RSS из getrusage."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def count_open_fds() -> int:
+    for path in ("/proc/self/fd", "/dev/fd"):
+        if os.path.isdir(path):
+            return len(os.listdir(path))
+    return -1
+
+
+def short_path(filename: str) -> str:
+    """Путь файла относительно бота, site-packages или стандартной библиотеки."""
+    path = os.path.abspath(filename)
+    if path.startswith(REPO_DIR + os.sep):
+        return os.path.relpath(path, REPO_DIR)
+    parts = path.split(os.sep)
+    for marker in ("site-packages", "dist-packages"):
+        if marker in parts:
+            return "/".join(parts[parts.index(marker) + 1:])
+    return f"stdlib/{os.path.basename(path)}"
+
+
+def module_of(filename: str) -> str:
+    """Модуль, которому принадлежит файл: файл бота, пакет из site-packages или stdlib/модуль."""
+    path = short_path(filename)
+    if path.startswith("stdlib/"):
+        return os.path.splitext(path)[0]
+    return path.split("/")[0].split(".")[0] if "/" in path else path
+
+
+def take_sample(harness: Harness, started: float, rounds: int) -> dict:
+    traced, _ = tracemalloc.get_traced_memory()
+    storage = getattr(harness.dp.storage, "storage", {})
+    return {
+        "elapsed": round(time.monotonic() - started),
+        "rounds": rounds,
+        "rss_mb": round(read_rss_mb(), 1),
+        "traced_mb": round(traced / 2**20, 1),
+        "open_fds": count_open_fds(),
+        "asyncio_tasks": len(asyncio.all_tasks()),
+        "fsm_records": len(storage),
+        "voice_files": len(glob.glob("voice_*.ogg")),
+    }
+
+
+def top_allocators(before: tracemalloc.Snapshot, after: tracemalloc.Snapshot) -> List[dict]:
+    """Места с наибольшим приростом памяти, сгруппированные по модулям и строкам."""
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen *>")]
+    before, after = before.filter_traces(filters), after.filter_traces(filters)
+    by_module: Counter = Counter()
+    lines = []
+    for stat in after.compare_to(before, "lineno"):
+        if stat.size_diff <= 0:
+            continue
+        frame = stat.traceback[0]
+        by_module[module_of(frame.filename)] += stat.size_diff
+        if len(lines) < SOAK_TOP_ALLOCATORS:
+            lines.append({
+                "module": module_of(frame.filename),
+                "line": f"{short_path(frame.filename)}:{frame.lineno}",
+                "growth_kb": round(stat.size_diff / 1024, 1),
+                "blocks": stat.count_diff,
+            })
+    modules = [{"module": module, "growth_kb": round(size / 1024, 1)}
+               for module, size in by_module.most_common(SOAK_TOP_ALLOCATORS)]
+    return {"modules": modules, "lines": lines}
+
+
+def check_growth(args, baseline: dict, last: dict) -> List[str]:
+    """Сравнивает последний замер с базовым и возвращает превышения порогов."""
+    limits = [
+        ("rss_mb", args.max_rss_growth, "RSS, МБ"),
+        ("traced_mb", args.max_traced_growth, "tracemalloc, МБ"),
+        ("open_fds", args.max_fd_growth, "открытые дескрипторы"),
+        ("asyncio_tasks", args.max_task_growth, "задачи asyncio"),
+        ("voice_files", 0, "временные голосовые файлы"),
+    ]
+    failures = []
+    for key, limit, title in limits:
+        growth = last[key] - baseline[key]
+        if growth > limit:
+            failures.append(f"{title}: {baseline[key]} -> {last[key]} (рост {growth:g}, порог {limit:g})")
+    return failures
+
+
+async def run_soak(args) -> dict:
+    """
+    Гоняет бота args.soak секунд. Каждый раунд — args.users новых пользователей
+    (как при живом потоке новых людей). После прогрева снимается базовый замер,
+    затем раз в args.soak_sample_interval секунд — RSS, tracemalloc, дескрипторы,
+    задачи asyncio, записи FSM и оставшиеся временные файлы.
+    """
+    tracemalloc.start(SOAK_TRACEMALLOC_FRAMES)
+    harness = Harness(args)
+    await harness.start()
+    started = time.monotonic()
+    deadline = started + args.soak
+    samples: List[dict] = []
+    baseline_snapshot = None
+    next_user_id = FIRST_USER_ID
+    next_sample_at = 0.0
+    rounds = 0
+    try:
+        while True:
+            await harness.run_users(range(next_user_id, next_user_id + args.users))
+            next_user_id += args.users
+            rounds += 1
+            now = time.monotonic()
+            if rounds == args.soak_warmup_rounds:
+                # Прогрев: кэши, пулы соединений и ленивые импорты заполнены — дальше рост считается утечкой
+                gc.collect()
+                baseline_snapshot = tracemalloc.take_snapshot()
+                samples.append(take_sample(harness, started, rounds))
+                next_sample_at = now + args.soak_sample_interval
+            elif baseline_snapshot is not None and (now >= next_sample_at or now >= deadline):
+                gc.collect()
+                samples.append(take_sample(harness, started, rounds))
+                sample = samples[-1]
+                print(f"[{sample['elapsed']} с] раундов {rounds}, RSS {sample['rss_mb']} МБ, "
+                      f"tracemalloc {sample['traced_mb']} МБ, fd {sample['open_fds']}, "
+                      f"задач {sample['asyncio_tasks']}, записей FSM {sample['fsm_records']}", flush=True)
+                next_sample_at = now + args.soak_sample_interval
+            if now >= deadline and rounds >= args.soak_warmup_rounds + 1:
+                break
+        gc.collect()
+        final_snapshot = tracemalloc.take_snapshot()
+    finally:
+        await harness.stop()
+        tracemalloc.stop()
+
+    baseline, last = samples[0], samples[-1]
+    hours = max((last["elapsed"] - baseline["elapsed"]) / 3600, 1e-9)
+    return {
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "params": {**benchmark_params(args), "soak": args.soak},
+        "rounds": rounds,
+        "updates": sum(len(values) for values in harness.latencies.values()),
+        "errors": dict(harness.errors),
+        "samples": samples,
+        "growth_per_hour": {key: round((last[key] - baseline[key]) / hours, 1)
+                            for key in ("rss_mb", "traced_mb", "open_fds", "asyncio_tasks", "fsm_records")},
+        "allocators": top_allocators(baseline_snapshot, final_snapshot),
+        "failures": check_growth(args, baseline, last),
+    }
+
+
+def print_soak_report(result: dict):
+    baseline, last = result["samples"][0], result["samples"][-1]
+    print(f"Soak-тест, коммит {result['commit']}: {result['rounds']} раундов, {result['updates']} апдейтов "
+          f"за {last['elapsed']} сек.")
+    print(f"{'показатель':<16}{'после прогрева':>16}{'в конце':>12}{'рост в час':>12}")
+    for key in ("rss_mb", "traced_mb", "open_fds", "asyncio_tasks", "fsm_records", "voice_files"):
+        per_hour = result["growth_per_hour"].get(key, "")
+        print(f"{key:<16}{baseline[key]:>16}{last[key]:>12}{per_hour:>12}")
+    if result["errors"]:
+        print("Ошибки:", result["errors"])
+    print("Прирост памяти по модулям (tracemalloc):")
+    for entry in result["allocators"]["modules"]:
+        print(f"  {entry['module']:<40}{entry['growth_kb']:>10} КБ")
+    print("Строки с наибольшим приростом:")
+    for entry in result["allocators"]["lines"]:
+        print(f"  {entry['line']:<48}{entry['growth_kb']:>10} КБ  {entry['blocks']:>8} блоков")
+    for failure in result["failures"]:
+        print("УТЕЧКА:", failure)
+
+
+# --- Бюджет времени импорта ---
+
+IMPORT_BUDGET_RUNS = 3
+# Без этих библиотек бот может начать отвечать: они загружаются при первом обращении или в фоне
+LAZY_MODULES = ("google.generativeai", "pandas", "openpyxl")
+# Что импортируется при любом запуске aiogram-бота: это время в бюджет не входит
+IMPORT_BASELINE_PACKAGES = ("aiogram", "aiohttp")
+IMPORT_TARGET = "main"
+IMPORT_TOP_MODULES = 10
+
+
+def _parse_importtime(stderr: str) -> Tuple[int, int, Dict[str, int]]:
+    """
+    Разбирает вывод -X importtime одного процесса. Возвращает накопленное время импорта
+    IMPORT_TARGET, время поддеревьев aiogram/aiohttp внутри него (мкс) и накопленное время
+    модулей верхних уровней.
+    """
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((depth, int(cumulative), name.strip()))
+
+    total = baseline = 0
+    modules: Dict[str, int] = {}
+    # Вывод идет в порядке завершения импорта (дети раньше родителя); в обратном порядке
+    # родитель встречается раньше детей, и стек хранит, лежит ли модуль внутри aiogram/aiohttp
+    stack: List[Tuple[int, bool]] = []
+    for depth, cumulative, name in reversed(entries):
+        while stack and stack[-1][0] >= depth:
+            stack.pop()
+        inside_baseline = bool(stack) and stack[-1][1]
+        is_baseline = name.split(".")[0] in IMPORT_BASELINE_PACKAGES
+        # Поддерево aiogram/aiohttp считается один раз, по самому верхнему его модулю
+        if is_baseline and not inside_baseline:
+            baseline += cumulative
+        stack.append((depth, inside_baseline or is_baseline))
+        if depth == 0 and name == IMPORT_TARGET:
+            total = cumulative
+        if depth <= 1:
+            modules[name] = cumulative
+    return total, baseline, modules
+
+
+def measure_import() -> Tuple[float, float, Dict[str, int]]:
+    """
+    Импортирует IMPORT_TARGET в чистом интерпретаторе с -X importtime IMPORT_BUDGET_RUNS раз.
+    Время aiogram/aiohttp берется из того же процесса, поэтому разница не зависит от шума
+    между отдельными запусками. Возвращает лучшее время импорта бота и время aiogram/aiohttp
+    в этом запуске (сек.), а также накопленное время модулей верхних уровней (мкс).
+    """
+    best = None
+    for _ in range(IMPORT_BUDGET_RUNS):
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {IMPORT_TARGET}"],
+            capture_output=True, text=True, cwd=REPO_DIR, check=True,
+        )
+        total, baseline, modules = _parse_importtime(completed.stderr)
+        if best is None or total - baseline < best[0] - best[1]:
+            best = (total, baseline, modules)
+    total, baseline, modules = best
+    return total / 1e6, baseline / 1e6, modules
+
+
+def check_import_budget(budget: float) -> int:
+    """Сравнивает время импорта бота с импортом самого aiogram. Возвращает код завершения."""
+    total, baseline, modules = measure_import()
+    overhead = total - baseline
+    print(f"Импорт '{IMPORT_TARGET}': {total:.3f} с, из них aiogram/aiohttp {baseline:.3f} с, "
+          f"собственный код бота {overhead:.3f} с (бюджет {budget:.3f} с)")
+    print("Самые долгие импорты:")
+    for name, microseconds in sorted(modules.items(), key=lambda item: item[1], reverse=True)[:IMPORT_TOP_MODULES]:
+        print(f"  {name:<40}{microseconds / 1000:>10.1f} мс")
+
+    failures = []
+    eager = [name for name in LAZY_MODULES if name in modules or any(
+        module.startswith(name + ".") for module in modules)]
+    if eager:
+        failures.append("при старте загружаются библиотеки, которые должны загружаться лениво: " + ", ".join(eager))
+    if overhead > budget:
+        failures.append(f"импорт занимает на {overhead - budget:.3f} с больше бюджета")
+    for failure in failures:
+        print("ПРЕВЫШЕН БЮДЖЕТ:", failure)
+    return 1 if failures else 0
+
+
+# --- Задержки цикла событий из-за логов ---
+
+# Дочерний процесс пишет строки лога через print() или через очередь log_manager пачками по
+# LOG_STALL_BURST (столько строк пишет один апдейт), а пульс цикла событий замеряет, насколько
+# запись его задерживает. Читатель stdout нарочно медленный
+# (как pipe в journald под нагрузкой): когда буфер pipe заполнен, запись блокируется
+LOG_STALL_CHILD = """
+import asyncio, json, logging, sys, time
+import log_manager
+mode, lines, burst = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+if mode == "logger":
+    log_manager.setup_logging("INFO")
+logger = logging.getLogger("benchmark")
+worst = 0.0
+done = False
+
+async def heartbeat():
+    global worst
+    while not done:
+        before = time.perf_counter()
+        await asyncio.sleep(0.001)
+        worst = max(worst, time.perf_counter() - before - 0.001)
+
+async def main():
+    global done
+    beat = asyncio.create_task(heartbeat())
+    started = time.perf_counter()
+    for number in range(lines):
+        line = f"update {number // burst}: " + "x" * 200
+        if mode == "print":
+            print(line, flush=True)
+        else:
+            logger.info(line)
+        if number % burst == burst - 1:
+            await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+    done = True
+    await beat
+    log_manager.stop_logging()
+    sys.stderr.write(json.dumps({"max_stall": worst, "elapsed": elapsed}) + "\\n")
+
+asyncio.run(main())
+"""
+LOG_STALL_BURST = 20
+LOG_STALL_READ_SIZE = 4096
+LOG_STALL_READ_DELAY = 0.01
+# Сколько может длиться самая долгая задержка цикла с логом через очередь, сек.
+LOG_STALL_BUDGET = 0.02
+
+
+def _slow_reader(stream):
+    while stream.read(LOG_STALL_READ_SIZE):
+        time.sleep(LOG_STALL_READ_DELAY)
+
+
+def measure_log_stall(mode: str, lines: int) -> dict:
+    """Запускает дочерний процесс с логами в режиме mode ("print" или "logger") за медленным читателем."""
+    process = subprocess.Popen(
+        [sys.executable, "-c", LOG_STALL_CHILD, mode, str(lines), str(LOG_STALL_BURST)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=REPO_DIR,
+    )
+    reader = threading.Thread(target=_slow_reader, args=(process.stdout,), daemon=True)
+    reader.start()
+    stderr = process.stderr.read().decode()
+    process.wait()
+    reader.join()
+    if process.returncode != 0:
+        raise RuntimeError(f"дочерний процесс ({mode}) завершился с кодом {process.returncode}: {stderr}")
+    result = json.loads(stderr.strip().splitlines()[-1])
+    return {"max_stall_ms": round(result["max_stall"] * 1000, 2), "elapsed_ms": round(result["elapsed"] * 1000, 1)}
+
+
+def check_log_stall(lines: int) -> int:
+    """Сравнивает задержки цикла событий при print() и при логе через очередь. Возвращает код завершения."""
+    results = {mode: measure_log_stall(mode, lines) for mode in ("print", "logger")}
+    for mode, result in results.items():
+        print(f"{mode:<8} {lines} строк за {result['elapsed_ms']} мс, самая долгая задержка цикла "
+              f"{result['max_stall_ms']} мс")
+    failures = []
+    if results["logger"]["max_stall_ms"] > LOG_STALL_BUDGET * 1000:
+        failures.append(f"лог через очередь задержал цикл на {results['logger']['max_stall_ms']} мс "
+                        f"(бюджет {LOG_STALL_BUDGET * 1000:.0f} мс)")
+    if results["logger"]["max_stall_ms"] >= results["print"]["max_stall_ms"]:
+        failures.append("лог через очередь задерживает цикл не меньше, чем print()")
+    for failure in failures:
+        print("НАРУШЕНИЕ:", failure)
+    return 1 if failures else 0
+
+
+# --- Запросы по индексам на большой базе ---
+
+# У 15% пользователей была подписка; примерно у трети из них она еще идет (~5% базы)
+SCHEMA_SUBSCRIPTION_RATIO = 0.15
+SCHEMA_PENDING_RATIO = 0.01
+SCHEMA_FAST_REPEATS = 200
+SCHEMA_SLOW_REPEATS = 5
+# Запросы, ради которых заведены индексы (как в database.py). {hint} заменяется на NOT INDEXED
+# для сравнения с полным просмотром таблицы, как было до миграций
+SCHEMA_QUERIES = (
+    ("get_user_by_username", "SELECT user_id, username FROM users {hint} WHERE username = ?",
+     lambda rng, users, now: (f"user_{rng.randrange(users)}",)),
+    ("count_subscribed_users", "SELECT COUNT(*) FROM users {hint} WHERE subscription_end_date > ?",
+     lambda rng, users, now: (now,)),
+    ("get_subscribed_users", "SELECT user_id, username, subscription_end_date FROM users {hint} "
+     "WHERE subscription_end_date > ? ORDER BY subscription_end_date, user_id LIMIT 10 OFFSET ?",
+     lambda rng, users, now: (now, rng.randrange(100) * 10)),
+    ("get_expiring_subscriptions", "SELECT user_id, subscription_end_date FROM users {hint} "
+     "WHERE subscription_end_date > ? AND subscription_end_date <= ? "
+     "AND expiry_notified_end IS NOT subscription_end_date AND NOT is_blocked "
+     "AND (expiry_retry_at IS NULL OR expiry_retry_at <= ?) "
+     "ORDER BY subscription_end_date LIMIT 100",
+     lambda rng, users, now: (now, now + 24 * 60 * 60, now)),
+    ("cleanup_pending_payments", "SELECT invoice_id FROM pending_payments {hint} "
+     "WHERE created_at < ? ORDER BY created_at LIMIT 500",
+     lambda rng, users, now: (now - db.PENDING_PAYMENT_TTL,)),
+)
+
+
+def _time_query(connection, query: str, make_params, repeats: int) -> List[float]:
+    samples = []
+    for _ in range(repeats):
+        params = make_params()
+        started = time.perf_counter()
+        connection.execute(query, params).fetchall()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+async def run_schema_queries(args) -> dict:
+    rng = random.Random(args.seed)
+    users = args.schema_queries
+    workdir = tempfile.mkdtemp(prefix="egebot-schema-")
+    try:
+        db.DB_FILE = os.path.join(workdir, "users.db")
+        await db.db_start()
+        now = int(time.time())
+        started = time.perf_counter()
+        connection = sqlite3.connect(db.DB_FILE)
+        # Сводки статистики и журнал заданий к этим запросам не относятся, а заполнение без них в разы быстрее
+        connection.execute("DROP TRIGGER stats_new_users")
+        connection.execute("DROP TRIGGER credit_ledger_opening")
+        connection.executemany(
+            "INSERT INTO users (user_id, username, subscription_end_date) VALUES (?, ?, ?)",
+            _export_rows(users, lambda number: (
+                FIRST_USER_ID + number, f"user_{number}",
+                now + rng.randrange(-60, 30) * 86400 + rng.randrange(86400)
+                if rng.random() < SCHEMA_SUBSCRIPTION_RATIO else None))
+        )
+        connection.executemany(
+            "INSERT INTO pending_payments (user_id, tariff, amount, created_at) VALUES (?, ?, ?, ?)",
+            _export_rows(int(users * SCHEMA_PENDING_RATIO), lambda number: (
+                FIRST_USER_ID + rng.randrange(users), "week", 299, now - rng.randrange(3 * 86400)))
+        )
+        connection.commit()
+        connection.execute("ANALYZE")
+        fill_seconds = time.perf_counter() - started
+
+        queries = {}
+        for name, query, params in SCHEMA_QUERIES:
+            make_params = functools.partial(params, rng, users, now)
+            indexed = query.format(hint="")
+            plan = " / ".join(row[-1] for row in connection.execute("EXPLAIN QUERY PLAN " + indexed, make_params()))
+            queries[name] = {
+                "plan": plan,
+                "indexed": summarize(_time_query(connection, indexed, make_params, SCHEMA_FAST_REPEATS)),
+                "full_scan": summarize(_time_query(connection, query.format(hint="NOT INDEXED"), make_params,
+                                                   SCHEMA_SLOW_REPEATS)),
+            }
+        connection.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {"users": users, "fill_seconds": round(fill_seconds, 1), "queries": queries}
+
+
+def print_schema_queries_report(result: dict):
+    print(f"Запросы по индексам: {result['users']} пользователей, заполнение {result['fill_seconds']} сек.")
+    print(f"{'запрос':<28}{'индекс p50, мс':>16}{'индекс p99, мс':>16}{'без индекса p50, мс':>21}")
+    for name, stats in result["queries"].items():
+        print(f"{name:<28}{stats['indexed']['p50']:>16}{stats['indexed']['p99']:>16}{stats['full_scan']['p50']:>21}")
+        print(f"  план: {stats['plan']}")
+
+
+# --- История разборов: объем и скорость чтения на большой таблице ---
+
+HISTORY_BATCH_SIZE = 10_000
+# Разборы генерируются один раз и повторяются: для объема базы важен только их размер после сжатия
+HISTORY_POOL_SIZE = 2_000
+HISTORY_QUERIES = 2_000
+# Сколько страниц пользователь листает назад после открытия истории
+HISTORY_PAGES_PER_QUERY = 5
+HISTORY_SAVES = 500
+HISTORY_WORDS = (
+    "ответ", "ученик", "произношение", "интонация", "вопрос", "задание", "ошибка", "слово", "фраза",
+    "текст", "грамматика", "порядок", "слов", "правильно", "неверно", "звук", "ударение", "пауза",
+    "прочитан", "полностью", "содержание", "соответствует", "пункт", "плана", "прямой", "косвенный",
+    "the", "is", "are", "what", "how", "much", "does", "it", "cost", "location", "hotel", "students",
+)
+HISTORY_ERROR_KINDS = ("Пропуск слова", "Замена слова", "Фонетическая ошибка", "Грамматическая ошибка")
+
+
+def _history_sentence(rng, min_words: int, max_words: int) -> str:
+    words = rng.choices(HISTORY_WORDS, k=rng.randint(min_words, max_words))
+    return " ".join(words).capitalize() + "."
+
+
+def synthetic_review(rng) -> str:
+    """Разбор в формате из промптов: оценка, комментарий и ошибки с таймкодами."""
+    lines = [f"**Оценка:** {rng.randint(0, 1)}", "**Комментарий:** " + _history_sentence(rng, 20, 60)]
+    for number in range(1, rng.randint(2, 10)):
+        lines.append(
+            f"    {number}.  **{rng.choice(HISTORY_ERROR_KINDS)} ({rng.randint(0, 2):02d}:{rng.randint(0, 59):02d}):** "
+            + _history_sentence(rng, 10, 40)
+        )
+    return "\n".join(lines)
+
+
+async def run_history(args) -> dict:
+    rng = random.Random(args.seed)
+    pool = [synthetic_review(rng) for _ in range(HISTORY_POOL_SIZE)]
+    started = time.perf_counter()
+    blobs = [db.compress_review(review) for review in pool]
+    compress_us = (time.perf_counter() - started) / len(pool) * 1e6
+    raw_bytes = sum(len(review.encode("utf-8")) for review in pool) / len(pool)
+    stored_bytes = sum(len(blob) for blob in blobs) / len(blobs)
+
+    workdir = tempfile.mkdtemp(prefix="egebot-history-")
+    try:
+        db.DB_FILE = os.path.join(workdir, "users.db")
+        await db.db_start()
+        users = [FIRST_USER_ID + number for number in range(args.history_users)]
+        started = time.perf_counter()
+        connection = sqlite3.connect(db.DB_FILE)
+        created_at = int(time.time()) - args.history
+        for batch_start in range(0, args.history, HISTORY_BATCH_SIZE):
+            rows = [
+                (rng.choice(users), str(rng.randint(1, 500)), "Task 1", created_at + number, blobs[number % len(blobs)])
+                for number in range(batch_start, min(batch_start + HISTORY_BATCH_SIZE, args.history))
+            ]
+            connection.executemany(
+                "INSERT INTO review_history (user_id, task_id, task_type, created_at, review) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            connection.commit()
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.close()
+        fill_seconds = time.perf_counter() - started
+        db_bytes = os.path.getsize(db.DB_FILE)
+
+        first_pages, next_pages, saves = [], [], []
+        for _ in range(HISTORY_QUERIES):
+            user_id = rng.choice(users)
+            started = time.perf_counter()
+            page = await db.get_review_page(user_id)
+            first_pages.append(time.perf_counter() - started)
+            for _ in range(HISTORY_PAGES_PER_QUERY):
+                if page is None or page["older_id"] is None:
+                    break
+                started = time.perf_counter()
+                page = await db.get_review_page(user_id, page["older_id"])
+                next_pages.append(time.perf_counter() - started)
+        for number in range(HISTORY_SAVES):
+            started = time.perf_counter()
+            await db.save_review(rng.choice(users), "1", "Task 1", pool[number % len(pool)])
+            saves.append(time.perf_counter() - started)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "rows": args.history,
+        "users": args.history_users,
+        "fill_seconds": round(fill_seconds, 1),
+        "review_bytes": round(raw_bytes),
+        "stored_bytes": round(stored_bytes),
+        "compress_us": round(compress_us, 1),
+        "db_mb": round(db_bytes / 2**20, 1),
+        "db_bytes_per_row": round(db_bytes / max(args.history, 1)),
+        "latency_ms": {
+            "first_page": summarize(first_pages),
+            "next_page": summarize(next_pages),
+            "save": summarize(saves),
+        },
+    }
+
+
+def print_history_report(result: dict):
+    print(f"История: {result['rows']} разборов у {result['users']} пользователей, "
+          f"заполнение {result['fill_seconds']} сек.")
+    print(f"Разбор: {result['review_bytes']} байт текста -> {result['stored_bytes']} байт после zlib "
+          f"({result['review_bytes'] / max(result['stored_bytes'], 1):.1f}x, {result['compress_us']} мкс на сжатие)")
+    print(f"База: {result['db_mb']} МБ, {result['db_bytes_per_row']} байт на разбор с индексами")
+    print(f"{'запрос':<16}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, stats in result["latency_ms"].items():
+        print(f"{name:<16}{stats['count']:>8}{stats['p50']:>10}{stats['p95']:>10}{stats['p99']:>10}{stats['max']:>10}")
+
+
+# --- Выдача заданий без повторов ---
+
+SEEN_TASK_TYPE = "Bench"
+SEEN_BATCH_SIZE = 10_000
+SEEN_PICKS = 20_000
+SEEN_QUERIES = 2_000
+SEEN_FILL_LEVELS = (0.0, 0.5, 0.9, 0.99)
+# Какая доля заданий удаляется и добавляется при «изменении tasks.xlsx»
+SEEN_CATALOG_CHURN = 0.1
+
+
+def _bench_catalog(keys) -> dict:
+    tasks = [{"id": key, "task_text": f"Задание {key}", "time_limit": "60"} for key in keys]
+    return {"tasks": tasks, "prompt": "Промпт", "keys": list(keys), "fingerprint": tm.catalog_fingerprint(list(keys))}
+
+
+def _random_fill(rng, size: int, fill: float) -> int:
+    seen = 0
+    for index in rng.sample(range(size), int(size * fill)):
+        seen |= 1 << index
+    return seen
+
+
+async def run_seen_sets(args) -> dict:
+    rng = random.Random(args.seed)
+    size = args.seen_catalog
+    blob_bytes = len(seen_tasks.to_bytes((1 << size) - 1, size))
+    # В памяти: int с size битами против множества номеров, заполненного наполовину
+    int_bytes = sys.getsizeof((1 << size) - 1)
+    set_bytes = sys.getsizeof(set(range(size // 2)))
+
+    pick_us = {}
+    for fill in SEEN_FILL_LEVELS:
+        seen = _random_fill(rng, size, fill)
+        started = time.perf_counter()
+        scanned = 0
+        for _ in range(SEEN_PICKS):
+            scanned += seen_tasks.pick_unseen(seen, size, rng)[1]
+        pick_us[f"{fill:.0%}"] = {
+            "us": round((time.perf_counter() - started) / SEEN_PICKS * 1e6, 2),
+            "scanned": round(scanned / SEEN_PICKS, 3),
+        }
+
+    keys = [str(number) for number in range(1, size + 1)]
+    churn = int(size * SEEN_CATALOG_CHURN)
+    new_keys = keys[churn:] + [str(size + number) for number in range(1, churn + 1)]
+    rng.shuffle(new_keys)
+    half_full = _random_fill(rng, size, 0.5)
+    new_index = {key: index for index, key in enumerate(new_keys)}
+    started = time.perf_counter()
+    for _ in range(SEEN_QUERIES):
+        seen_tasks.remap(half_full, keys, new_index)
+    remap_us = (time.perf_counter() - started) / SEEN_QUERIES * 1e6
+
+    workdir = tempfile.mkdtemp(prefix="egebot-seen-")
+    try:
+        db.DB_FILE = os.path.join(workdir, "users.db")
+        await db.db_start()
+        tm.tasks_data[SEEN_TASK_TYPE] = _bench_catalog(keys)
+        tm._loaded = True
+        fingerprint = tm.tasks_data[SEEN_TASK_TYPE]["fingerprint"]
+        users = [FIRST_USER_ID + number for number in range(args.seen_sets)]
+        started = time.perf_counter()
+        connection = sqlite3.connect(db.DB_FILE)
+        for batch_start in range(0, len(users), SEEN_BATCH_SIZE):
+            rows = [
+                (user_id, SEEN_TASK_TYPE, fingerprint, seen_tasks.to_bytes(_random_fill(rng, size, rng.random()), size))
+                for user_id in users[batch_start:batch_start + SEEN_BATCH_SIZE]
+            ]
+            connection.executemany("INSERT INTO seen_tasks (user_id, task_type, fingerprint, seen) VALUES (?, ?, ?, ?)", rows)
+            connection.commit()
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.close()
+        fill_seconds = time.perf_counter() - started
+        db_bytes = os.path.getsize(db.DB_FILE)
+
+        picks = []
+        for _ in range(SEEN_QUERIES):
+            started = time.perf_counter()
+            await seen_tasks.pick_task(rng.choice(users), SEEN_TASK_TYPE)
+            picks.append(time.perf_counter() - started)
+        # Новый tasks.xlsx: первые наборы каждого пользователя переносятся на новые номера
+        tm.tasks_data[SEEN_TASK_TYPE] = _bench_catalog(new_keys)
+        remapped = []
+        for user_id in rng.sample(users, min(SEEN_QUERIES, len(users))):
+            started = time.perf_counter()
+            await seen_tasks.pick_task(user_id, SEEN_TASK_TYPE)
+            remapped.append(time.perf_counter() - started)
+    finally:
+        tm.tasks_data.pop(SEEN_TASK_TYPE, None)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "users": args.seen_sets,
+        "catalog": size,
+        "fill_seconds": round(fill_seconds, 1),
+        "blob_bytes": blob_bytes,
+        "db_mb": round(db_bytes / 2**20, 1),
+        "db_bytes_per_user": round(db_bytes / max(args.seen_sets, 1)),
+        "memory_mb": {
+            "bitset": round(int_bytes * args.seen_sets / 2**20, 1),
+            "python_set_half_full": round(set_bytes * args.seen_sets / 2**20, 1),
+        },
+        "pick_unseen_us": pick_us,
+        "remap_us": round(remap_us, 1),
+        "latency_ms": {"pick_task": summarize(picks), "pick_remapped": summarize(remapped)},
+    }
+
+
+def print_seen_sets_report(result: dict):
+    print(f"Наборы полученных заданий: {result['users']} пользователей x {result['catalog']} заданий, "
+          f"заполнение {result['fill_seconds']} сек.")
+    memory = result["memory_mb"]
+    print(f"Набор: {result['blob_bytes']} байт; база {result['db_mb']} МБ ({result['db_bytes_per_user']} байт на набор); "
+          f"в памяти {memory['bitset']} МБ битовыми наборами против {memory['python_set_half_full']} МБ "
+          f"множествами номеров, заполненными наполовину")
+    for fill, stats in result["pick_unseen_us"].items():
+        print(f"Выбор при заполнении {fill}: {stats['us']} мкс, перебором {stats['scanned']:.1%}")
+    print(f"Перенос наполовину заполненного набора на новый список заданий: {result['remap_us']} мкс")
+    print(f"{'запрос':<16}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, stats in result["latency_ms"].items():
+        print(f"{name:<16}{stats['count']:>8}{stats['p50']:>10}{stats['p95']:>10}{stats['p99']:>10}{stats['max']:>10}")
+
+
+# --- Сводная статистика ---
+
+STATS_SPAN_DAYS = 365
+STATS_TASK_TYPES = ("Task 1", "Task 2", "Task 3", "Task 4")
+# Одна оплата на столько разборов
+STATS_REVIEWS_PER_PAYMENT = 20
+STATS_SCREEN_QUERIES = 200
+STATS_ADHOC_QUERIES = 5
+STATS_EVENT_WRITES = 1_000
+# Те же цифры, что на экране, но по таблицам истории (так пришлось бы считать без сводок)
+STATS_ADHOC_SQL = (
+    "SELECT task_type, COUNT(*) FROM review_history WHERE created_at >= ? GROUP BY task_type",
+    "SELECT tariff, COUNT(*), SUM(amount) FROM payments WHERE paid_at >= ? GROUP BY tariff",
+)
+STATS_ADHOC_WINDOWS = (24 * 60 * 60, 24 * 60 * 60, 7 * 24 * 60 * 60, 30 * 24 * 60 * 60)
+
+
+async def run_stats(args) -> dict:
+    rng = random.Random(args.seed)
+    blobs = [db.compress_review(synthetic_review(rng)) for _ in range(HISTORY_POOL_SIZE // 10)]
+    workdir = tempfile.mkdtemp(prefix="egebot-stats-")
+    try:
+        db.DB_FILE = os.path.join(workdir, "users.db")
+        await db.db_start()
+        now = int(time.time())
+        span = STATS_SPAN_DAYS * 24 * 60 * 60
+        started = time.perf_counter()
+        connection = sqlite3.connect(db.DB_FILE)
+        for batch_start in range(0, args.stats, HISTORY_BATCH_SIZE):
+            batch = range(batch_start, min(batch_start + HISTORY_BATCH_SIZE, args.stats))
+            connection.executemany(
+                "INSERT INTO review_history (user_id, task_id, task_type, created_at, review) VALUES (?, ?, ?, ?, ?)",
+                [(FIRST_USER_ID + rng.randrange(50_000), "1", rng.choice(STATS_TASK_TYPES), now - rng.randrange(span),
+                  blobs[number % len(blobs)]) for number in batch]
+            )
+            connection.executemany(
+                "INSERT INTO payments (invoice_id, user_id, tariff, amount, created_at, paid_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(number, FIRST_USER_ID, tariff, amount, paid_at, paid_at)
+                 for number in batch if number % STATS_REVIEWS_PER_PAYMENT == 0
+                 for tariff, amount in [rng.choice((("week", 299), ("month", 799), ("single", 49)))]
+                 for paid_at in [now - rng.randrange(span)]]
+            )
+            connection.commit()
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        fill_seconds = time.perf_counter() - started
+        stats_rows = sum(connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                         for table, _, _ in db.STATS_PERIODS)
+
+        screen = []
+        for _ in range(STATS_SCREEN_QUERIES):
+            started = time.perf_counter()
+            summary = await db.get_stats_summary()
+            screen.append(time.perf_counter() - started)
+        adhoc = []
+        for _ in range(STATS_ADHOC_QUERIES):
+            started = time.perf_counter()
+            for window in STATS_ADHOC_WINDOWS:
+                for query in STATS_ADHOC_SQL:
+                    connection.execute(query, (now - window,)).fetchall()
+            adhoc.append(time.perf_counter() - started)
+
+        # Цена триггеров: запись разбора со сводками и без них
+        writes = {}
+        for mode in ("rollups", "no_rollups"):
+            if mode == "no_rollups":
+                connection.execute("DROP TRIGGER stats_reviews")
+                connection.commit()
+            samples = []
+            for _ in range(STATS_EVENT_WRITES):
+                started = time.perf_counter()
+                await db.save_review(FIRST_USER_ID, "1", rng.choice(STATS_TASK_TYPES), "Разбор")
+                samples.append(time.perf_counter() - started)
+            writes[mode] = summarize(samples)
+        connection.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "reviews": args.stats,
+        "payments": args.stats // STATS_REVIEWS_PER_PAYMENT,
+        "fill_seconds": round(fill_seconds, 1),
+        "stats_rows": stats_rows,
+        "reviews_30d": sum(summary["30d"].get("reviews", {}).values()),
+        "latency_ms": {
+            "screen": summarize(screen),
+            "adhoc_sql": summarize(adhoc),
+            "save_review": writes["rollups"],
+            "save_no_rollup": writes["no_rollups"],
+        },
+    }
+
+
+def print_stats_report(result: dict):
+    print(f"Статистика: {result['reviews']} разборов и {result['payments']} оплат за {STATS_SPAN_DAYS} дней, "
+          f"заполнение {result['fill_seconds']} сек.; строк в сводках {result['stats_rows']}, "
+          f"разборов за 30 дней {result['reviews_30d']}")
+    print(f"{'запрос':<16}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, stats in result["latency_ms"].items():
+        print(f"{name:<16}{stats['count']:>8}{stats['p50']:>10}{stats['p95']:>10}{stats['p99']:>10}{stats['max']:>10}")
+
+
+# --- Выгрузка для админов ---
+
+# Сколько неоплаченных счетов и оплат приходится на пользователя
+EXPORT_PENDING_RATIO = 0.1
+EXPORT_PAYMENTS_RATIO = 0.3
+EXPORT_SAMPLE_INTERVAL = 0.01
+
+
+def _export_rows(count: int, make_row):
+    for number in range(count):
+        yield make_row(number)
+
+
+async def _sample_loop(samples: dict, stop: asyncio.Event):
+    # Насколько позже положенного просыпается цикл событий, и RSS процесса
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(EXPORT_SAMPLE_INTERVAL)
+        samples["lag"].append(time.perf_counter() - started - EXPORT_SAMPLE_INTERVAL)
+        samples["rss"] = max(samples["rss"], read_rss_mb())
+
+
+async def run_export(args) -> dict:
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="egebot-export-")
+    try:
+        db.DB_FILE = os.path.join(workdir, "users.db")
+        export.EXPORT_DIR = os.path.join(workdir, "exports")
+        await db.db_start()
+        now = int(time.time())
+        pending = int(args.export * EXPORT_PENDING_RATIO)
+        paid = int(args.export * EXPORT_PAYMENTS_RATIO)
+        tariffs = (("week", 299), ("month", 799), ("single", 49))
+        started = time.perf_counter()
+        connection = sqlite3.connect(db.DB_FILE)
+        # Сводки статистики и журнал заданий к выгрузке не относятся, а заполнение без них в разы быстрее
+        connection.execute("DROP TRIGGER stats_new_users")
+        connection.execute("DROP TRIGGER credit_ledger_opening")
+        connection.execute("DROP TRIGGER stats_payments")
+        connection.executemany(
+            "INSERT INTO users (user_id, username, subscription_end_date, tasks_available) VALUES (?, ?, ?, ?)",
+            _export_rows(args.export, lambda number: (
+                FIRST_USER_ID + number, f"user_{number}",
+                now + rng.randrange(-90, 30) * 86400 if number % 3 == 0 else None, rng.randrange(0, 5)))
+        )
+        connection.executemany(
+            "INSERT INTO pending_payments (user_id, tariff, amount, created_at) VALUES (?, ?, ?, ?)",
+            _export_rows(pending, lambda number: (
+                FIRST_USER_ID + rng.randrange(args.export), *rng.choice(tariffs), now - rng.randrange(86400)))
+        )
+        connection.executemany(
+            "INSERT INTO payments (invoice_id, user_id, tariff, amount, created_at, paid_at) VALUES (?, ?, ?, ?, ?, ?)",
+            _export_rows(paid, lambda number: (
+                number + 1, FIRST_USER_ID + rng.randrange(args.export), *rng.choice(tariffs),
+                now - 400 - number, now - number))
+        )
+        connection.commit()
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.close()
+        fill_seconds = time.perf_counter() - started
+        db_bytes = os.path.getsize(db.DB_FILE)
+
+        gc.collect()
+        rss_before = read_rss_mb()
+        samples = {"lag": [], "rss": rss_before}
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(_sample_loop(samples, stop))
+        started = time.perf_counter()
+        path, counts = await export.build_export()
+        export_seconds = time.perf_counter() - started
+        stop.set()
+        await sampler
+        archive_bytes = os.path.getsize(path)
+        with zipfile.ZipFile(path) as archive:
+            csv_bytes = sum(info.file_size for info in archive.infolist())
+
+        # Для сравнения: те же пользователи одним fetchall, как в старом списке подписчиков
+        connection = sqlite3.connect(db.DB_FILE)
+        started_rss = read_rss_mb()
+        rows = connection.execute(db.EXPORT_TABLES[0][2]).fetchall()
+        fetchall_mb = read_rss_mb() - started_rss
+        del rows
+        connection.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    rows_total = sum(counts.values())
+    return {
+        "rows": counts,
+        "fill_seconds": round(fill_seconds, 1),
+        "db_mb": round(db_bytes / 2**20, 1),
+        "export_seconds": round(export_seconds, 1),
+        "rows_per_second": round(rows_total / max(export_seconds, 1e-9)),
+        "csv_mb": round(csv_bytes / 2**20, 1),
+        "archive_mb": round(archive_bytes / 2**20, 1),
+        "rss_before_mb": round(rss_before, 1),
+        "rss_peak_mb": round(samples["rss"], 1),
+        "users_fetchall_mb": round(fetchall_mb, 1),
+        "loop_lag_ms": summarize(samples["lag"]),
+    }
+
+
+def print_export_report(result: dict):
+    rows = result["rows"]
+    print(f"Выгрузка: пользователей {rows['users']}, неоплаченных счетов {rows['pending_payments']}, "
+          f"оплат {rows['payments']}; база {result['db_mb']} МБ, заполнение {result['fill_seconds']} сек.")
+    print(f"Архив за {result['export_seconds']} сек. ({result['rows_per_second']} строк/сек.): "
+          f"CSV {result['csv_mb']} МБ -> zip {result['archive_mb']} МБ")
+    print(f"RSS: {result['rss_before_mb']} МБ до выгрузки, пик во время выгрузки {result['rss_peak_mb']} МБ; "
+          f"те же пользователи одним fetchall — еще {result['users_fetchall_mb']} МБ")
+    lag = result["loop_lag_ms"]
+    print(f"Задержка цикла событий во время выгрузки: p50 {lag['p50']} мс, p99 {lag['p99']} мс, max {lag['max']} мс")
+
+
+# --- Хранилища: одинаковое поведение SQLite и PostgreSQL ---
+
+# Сколько параллельных вызовов бьют в один баланс, резерв или счет
+STORAGE_RACERS = 20
+STORAGE_SUITE_USER_ID = FIRST_USER_ID + 5_000_000
+
+
+class _HostLocks(dict):
+    """Словарь блокировок seen_tasks, который ничего не запоминает: каждая выдача как с отдельного хоста."""
+
+    def get(self, key, default=None):
+        return default
+
+    def __setitem__(self, key, value):
+        pass
+
+
+async def check_storage(store) -> Tuple[List[str], List[tuple]]:
+    """
+    Проверяет обещания интерфейса Storage на пустом хранилище. Возвращает список нарушений
+    и строки выгрузки пользователей (без дат) для сравнения бэкендов между собой.
+    """
+    failures = []
+
+    def expect(condition, message):
+        if not condition:
+            failures.append(message)
+
+    async def tasks_left(user_id):
+        return (await store.get_available_tasks(user_id))["tasks_left"]
+
+    user, payer, blocked, newcomer = range(STORAGE_SUITE_USER_ID, STORAGE_SUITE_USER_ID + 4)
+    for user_id in (user, payer, blocked):
+        await store.add_user(user_id, f"suite_{user_id}")
+    expect(await store.get_user_by_username(f"suite_{user}") == (user, f"suite_{user}"), "поиск по username")
+    usernames = await store.get_usernames([user, payer, newcomer])
+    expect(usernames == {user: f"suite_{user}", payer: f"suite_{payer}"}, f"get_usernames: {usernames}")
+    info = await store.get_available_tasks(newcomer)
+    expect(info == {"is_subscribed": False, "tasks_left": 2}, f"новый пользователь: {info}")
+    expect(await tasks_left(newcomer) == 2, "пользователь из get_available_tasks не сохранился")
+
+    # Параллельные резервы не уходят в минус, каждый резерв завершается один раз
+    await store.add_tasks(user, 3)
+    results = await asyncio.gather(*(store.reserve_task(user) for _ in range(STORAGE_RACERS)))
+    reservations = [reservation_id for allowed, reservation_id in results if allowed]
+    expect(len(reservations) == 5, f"параллельные резервы: разрешено {len(reservations)} при балансе 5")
+    expect(await tasks_left(user) == 0, "баланс после резервов не 0")
+    if len(reservations) >= 2:
+        expect(await store.commit_task_reservation(reservations[0]), "резерв не подтвердился")
+        expect(not await store.release_task_reservation(reservations[0]), "подтвержденный резерв вернулся")
+        released = await asyncio.gather(*(store.release_task_reservation(reservations[1])
+                                          for _ in range(STORAGE_RACERS)))
+        expect(sum(released) == 1, f"один резерв вернули {sum(released)} раз")
+        expect(await tasks_left(user) == 1, "баланс после возврата резерва")
+
+    # Оплата проводится и начисляется ровно один раз
+    invoice_id = await store.add_pending_payment(payer, "single", 49)
+    expect(await store.get_pending_payment(invoice_id) == (payer, "single", 49), "счет не найден")
+    settled = await asyncio.gather(*(store.settle_pending_payment(invoice_id) for _ in range(STORAGE_RACERS)))
+    settled = [result for result in settled if result is not None]
+    expect(settled == [(payer, "single", 49)], f"проводка счета: {settled}")
+    expect(await tasks_left(payer) == 3, "задание по оплате начислено не один раз")
+    expect(await store.get_pending_payment(invoice_id) is None, "проведенный счет остался")
+
+    # Подписка и предупреждение о ее окончании
+    await store.set_subscription(payer, 1)
+    is_subscribed, end_date = await store.check_subscription(payer)
+    expect(is_subscribed and isinstance(end_date, int), f"подписка: {is_subscribed}, {end_date}")
+    expect(await store.reserve_task(payer) == (True, None), "подписчику нужен резерв")
+    expect(await store.count_subscribed_users() == 1, "число подписчиков")
+    expect(await store.get_subscribed_users(limit=10) == [(payer, f"suite_{payer}", end_date)], "список подписчиков")
+    until = db.now_ts() + 2 * db.SECONDS_IN_DAY
+    expect((payer, end_date) in await store.get_expiring_subscriptions(until, 100), "нет в списке истекающих")
+    await store.postpone_expiry_notifications([payer], db.now_ts() + 60)
+    expect((payer, end_date) not in await store.get_expiring_subscriptions(until, 100), "отложенное предупреждение выдано")
+    await store.postpone_expiry_notifications([payer], db.now_ts() - 1)
+    expect((payer, end_date) in await store.get_expiring_subscriptions(until, 100), "предупреждение не вернулось")
+    await store.mark_expiry_notified([(payer, end_date)], [])
+    expect((payer, end_date) not in await store.get_expiring_subscriptions(until, 100), "предупреждение повторится")
+    # Проверка окончания подписок идет на каждом хосте: одновременные claim выдают пользователя один раз
+    await store.set_subscription(user, 1)
+    claims = await asyncio.gather(*(store.claim_expiring_subscriptions(until, 100, db.now_ts() + 60)
+                                    for _ in range(STORAGE_RACERS)))
+    claimed = [row for rows in claims for row in rows]
+    expect([user_id for user_id, _ in claimed] == [user], f"claim_expiring_subscriptions: {claimed}")
+    expect(not await store.get_expiring_subscriptions(until, 100), "взятый в работу пользователь снова в списке")
+    await store.mark_expiry_notified(claimed, [])
+
+    # Админы: супер-админа удалить нельзя
+    await store.add_admin(user)
+    expect(user in await store.get_admins(), "админ не добавился")
+    expect(await store.check_subscription(user) == (True, "admin"), "админ без доступа")
+    await store.remove_admin(SUPER_ADMIN_ID)
+    await store.remove_admin(user)
+    admins = await store.get_admins()
+    expect(SUPER_ADMIN_ID in admins and user not in admins, f"админы после удаления: {admins}")
+
+    # Заблокировавшие бота пропускаются рассылкой, пока снова не напишут боту
+    await store.mark_users_blocked([blocked])
+    recipients = await store.get_broadcast_recipients(STORAGE_SUITE_USER_ID - 1, 100)
+    expect(blocked not in recipients and user in recipients, f"получатели рассылки: {recipients}")
+    await store.add_user(blocked, f"suite_{blocked}")
+    expect(blocked in await store.get_broadcast_recipients(STORAGE_SUITE_USER_ID - 1, 100), "блокировка не снялась")
+
+    # Очистка удаляет только просроченные счета
+    stale = await store.add_pending_payment(user, "week", 299)
+    ttl = db.PENDING_PAYMENT_TTL
+    db.PENDING_PAYMENT_TTL = -1
+    try:
+        deleted = await store.cleanup_old_pending_payments()
+    finally:
+        db.PENDING_PAYMENT_TTL = ttl
+    fresh = await store.add_pending_payment(user, "month", 799)
+    expect(deleted == 1 and await store.get_pending_payment(stale) is None, f"очистка удалила {deleted}")
+    expect(await store.cleanup_old_pending_payments() == 0 and await store.get_pending_payment(fresh) is not None,
+           "очистка удалила свежий счет")
+
+    # История разборов листается по review_id
+    first = await store.save_review(user, "1", "Task 1", "Первый разбор")
+    second = await store.save_review(user, "2", "Task 2", "Второй разбор")
+    page = await store.get_review_page(user)
+    expect(page is not None and (page["review_id"], page["review"], page["older_id"], page["newer_id"])
+           == (second, "Второй разбор", first, None), f"последний разбор: {page}")
+    page = await store.get_review_page(user, first)
+    expect(page is not None and (page["task_id"], page["review"], page["newer_id"]) == ("1", "Первый разбор", second),
+           f"первый разбор: {page}")
+    expect(await store.get_review_page(payer) is None, "история чужого пользователя")
+
+    # Наборы полученных заданий и списки заданий листа
+    await store.save_task_catalog("suite", ["a", "b"])
+    await store.save_task_catalog("suite", ["c"])
+    expect(await store.get_task_catalog("suite") == ["a", "b"], "список заданий перезаписан")
+    expect(await store.get_task_catalog("missing") is None, "неизвестный список заданий")
+    # Набор сохраняется, только если не изменился с чтения: хосты не перезаписывают выдачу друг друга
+    expect(await store.save_seen_tasks(user, "Task 1", "suite", b"\x01", None), "первый набор не сохранился")
+    expect(not await store.save_seen_tasks(user, "Task 1", "suite", b"\x02", None), "набор перезаписан вторым созданием")
+    saved = await asyncio.gather(*(store.save_seen_tasks(user, "Task 1", "suite", bytes([3 + number]), ("suite", b"\x01"))
+                                   for number in range(STORAGE_RACERS)))
+    expect(sum(saved) == 1, f"набор по одному прочитанному значению сохранили {sum(saved)} раз")
+    row = await store.get_seen_tasks(user, "Task 1")
+    expect(row is not None and row[0] == "suite" and row[1] != b"\x01", f"набор полученных заданий: {row}")
+    expect(await store.get_seen_tasks(payer, "Task 1") is None, "набор чужого пользователя")
+
+    # Выдача без повторов: одновременные нажатия одного пользователя и выдача с нескольких хостов
+    await tm.ensure_loaded_async()
+    tm.tasks_data[SEEN_TASK_TYPE] = _bench_catalog([f"suite-{number}" for number in range(4 * STORAGE_RACERS)])
+    locks = seen_tasks._locks
+    try:
+        picked = await asyncio.gather(*(seen_tasks.pick_task(user, SEEN_TASK_TYPE) for _ in range(STORAGE_RACERS)))
+        ids = [task["id"] for _, task in picked]
+        expect(len(set(ids)) == len(ids), f"одновременные нажатия: {len(ids) - len(set(ids))} повторов")
+        # Каждая выдача со своей блокировкой, как на разных хостах: повторы отсекает только сравнение при сохранении.
+        # За раунд сохраняется хотя бы одна выдача, поэтому SAVE_ATTEMPTS хостов всегда укладываются в попытки
+        seen_tasks._locks = _HostLocks()
+        picked = await asyncio.gather(*(seen_tasks.pick_task(payer, SEEN_TASK_TYPE)
+                                        for _ in range(seen_tasks.SAVE_ATTEMPTS)))
+        ids = [task["id"] for _, task in picked]
+        expect(len(set(ids)) == len(ids), f"выдача с нескольких хостов: {len(ids) - len(set(ids))} повторов")
+    finally:
+        seen_tasks._locks = locks
+        tm.tasks_data.pop(SEEN_TASK_TYPE, None)
+
+    # Сводки статистики и выгрузка из одного снимка
+    today = (await store.get_stats_summary()).get("today", {})
+    expect(today.get("reviews") == {"Task 1": 1, "Task 2": 1}, f"разборов за сегодня: {today.get('reviews')}")
+    expect(sum(today.get("new_users", {}).values()) == 4, f"новых пользователей за сегодня: {today.get('new_users')}")
+    expect(today.get("payments", {}).get("single") == 1 and today.get("revenue", {}).get("single") == 49,
+           f"оплаты за сегодня: {today.get('payments')}, {today.get('revenue')}")
+    batches = [batch async for batch in store.export_rows()]
+    counts = Counter()
+    users = []
+    for name, columns, rows in batches:
+        counts[name] += len(rows)
+        if name == "users":
+            users.extend((row[0], row[1], row[3], row[4]) for row in rows)
+    expect([name for name, _, _ in batches] == [name for name, _, _ in db.EXPORT_TABLES],
+           "выгрузка: таблицы не по порядку")
+    expect(counts == {"users": 4, "pending_payments": 1, "payments": 1}, f"выгрузка: {dict(counts)}")
+    return failures, users
+
+
+async def measure_storage(store, args) -> dict:
+    """Сессии пользователей (старт, задание, оплата) поверх хранилища: операции в секунду и задержки."""
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def step(name, call):
+        started = time.perf_counter()
+        result = await call
+        latencies[name].append(time.perf_counter() - started)
+        return result
+
+    async def session(user_id: int):
+        async with semaphore:
+            await step("add_user", store.add_user(user_id, f"user_{user_id}"))
+            await step("get_available_tasks", store.get_available_tasks(user_id))
+            allowed, reservation_id = await step("reserve_task", store.reserve_task(user_id))
+            if allowed:
+                await step("commit_task_reservation", store.commit_task_reservation(reservation_id))
+            invoice_id = await step("add_pending_payment", store.add_pending_payment(user_id, "single", 49))
+            await step("get_pending_payment", store.get_pending_payment(invoice_id))
+            await step("settle_pending_payment", store.settle_pending_payment(invoice_id))
+            await step("check_subscription", store.check_subscription(user_id))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(session(FIRST_USER_ID + number) for number in range(args.users)))
+    elapsed = time.perf_counter() - started
+    operations = sum(len(values) for values in latencies.values())
+    return {
+        "operations": operations,
+        "seconds": round(elapsed, 2),
+        "ops_per_second": round(operations / max(elapsed, 1e-9)),
+        "latency_ms": {name: summarize(values) for name, values in latencies.items()},
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _embedded_postgres_dsn() -> str:
+    # Встроенный PostgreSQL из пакета pgserver (pip install pgserver), если --postgres-dsn не указан;
+    # один сервер на весь прогон
+    import pgserver
+    server = pgserver.get_server(tempfile.mkdtemp(prefix="egebot-pg-"), cleanup_mode="delete")
+    return server.get_uri()
+
+
+async def _drop_schema(dsn: str, schema: str):
+    import asyncpg
+    connection = await asyncpg.connect(dsn)
+    try:
+        await connection.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+    finally:
+        await connection.close()
+
+
+def _storage_backends(args) -> List[str]:
+    if args.storage_backend == "both":
+        return [storage.BACKEND_SQLITE, storage.BACKEND_POSTGRES]
+    return [args.storage_backend]
+
+
+@contextlib.asynccontextmanager
+async def _bench_storage(backend: str, args, workdir: str):
+    """Пустое хранилище backend, установленное как текущее; после прогона закрывается и удаляется."""
+    # Локальные таблицы (рассылки) у каждого прогона свои
+    db.DB_FILE = os.path.join(workdir, f"{backend}.db")
+    dsn = schema = None
+    if backend == storage.BACKEND_POSTGRES:
+        from storage_postgres import PostgresStorage
+        dsn = args.postgres_dsn or await asyncio.to_thread(_embedded_postgres_dsn)
+        # Отдельная схема: прогон не трогает рабочие таблицы и удаляется после себя
+        schema = f"egebot_bench_{os.getpid()}"
+        store = PostgresStorage(dsn, schema=schema)
+    else:
+        store = storage.create_storage(backend)
+    storage.set_storage(store)
+    try:
+        await store.start()
+        yield store
+    finally:
+        await store.close()
+        storage.set_storage(None)
+        if schema:
+            await _drop_schema(dsn, schema)
+
+
+async def check_import(args, workdir: str) -> List[str]:
+    """
+    Переносит users.db, заполненный check_storage, в пустую схему PostgreSQL (import_sqlite) дважды
+    и сравнивает данные с исходными. Возвращает список нарушений.
+    """
+    from storage_postgres import PostgresStorage
+    failures = []
+
+    def expect(condition, message):
+        if not condition:
+            failures.append(f"перенос из users.db: {message}")
+
+    user = STORAGE_SUITE_USER_ID
+    local_file = db.DB_FILE
+    source_path = db.DB_FILE = os.path.join(workdir, "import.db")
+    source = storage.SQLiteStorage()
+    try:
+        await source.start()
+        _, expected_users = await check_storage(source)
+        expected_page = await source.get_review_page(user)
+        expected_seen = await source.get_seen_tasks(user, "Task 1")
+        expected_today = (await source.get_stats_summary())["today"]
+        last_invoice = max([row[0] async for name, _, rows in source.export_rows() if name != "users" for row in rows])
+    finally:
+        db.DB_FILE = local_file
+
+    dsn = args.postgres_dsn or await asyncio.to_thread(_embedded_postgres_dsn)
+    schema = f"egebot_bench_import_{os.getpid()}"
+    target = PostgresStorage(dsn, schema=schema)
+    try:
+        await target.start()
+        counts = await target.import_sqlite(source_path)
+        expect(counts.get("users") == len(expected_users) and counts.get("review_history") == 2, f"перенесено {counts}")
+        again = await target.import_sqlite(source_path)
+        expect("users" not in again and again["review_history"] == 0, f"повторный перенос: {again}")
+        users = [(row[0], row[1], row[3], row[4])
+                 async for name, _, rows in target.export_rows() if name == "users" for row in rows]
+        expect(users == expected_users, "пользователи отличаются от users.db")
+        expect(await target.count_ledger_mismatches() == 0, "журнал заданий не сходится с балансом")
+        page = await target.get_review_page(user)
+        expect(page is not None and page["review"] == expected_page["review"] and page["older_id"] is not None,
+               f"история разборов: {page}")
+        expect(await target.get_seen_tasks(user, "Task 1") == expected_seen, "набор полученных заданий")
+        today = (await target.get_stats_summary())["today"]
+        for metric in ("reviews", "payments", "revenue"):
+            expect(today.get(metric) == expected_today.get(metric), f"сводка {metric}: {today.get(metric)}")
+        expect("new_users" not in today, f"перенесенные пользователи посчитаны новыми: {today.get('new_users')}")
+        invoice_id = await target.add_pending_payment(user, "single", 49)
+        expect(invoice_id > last_invoice, f"номер нового счета {invoice_id} уже был в users.db")
+    finally:
+        await target.close()
+        await _drop_schema(dsn, schema)
+    return failures
+
+
+async def run_storage_suite(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="egebot-storage-")
+    results, exported = {}, {}
+    try:
+        for backend in _storage_backends(args):
+            async with _bench_storage(backend, args, workdir) as store:
+                failures, exported[backend] = await check_storage(store)
+                results[backend] = {"failures": failures, **await measure_storage(store, args)}
+            if backend == storage.BACKEND_POSTGRES:
+                results[backend]["failures"].extend(await check_import(args, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if len(exported) == 2 and exported[storage.BACKEND_SQLITE] != exported[storage.BACKEND_POSTGRES]:
+        results[storage.BACKEND_POSTGRES]["failures"].append("выгрузка пользователей отличается от SQLite")
+    return results
+
+
+def print_storage_report(result: dict):
+    for backend, stats in result.items():
+        status = "OK" if not stats["failures"] else f"ОШИБОК: {len(stats['failures'])}"
+        print(f"Хранилище {backend}: проверки {status}; {stats['operations']} операций за {stats['seconds']} сек. "
+              f"({stats['ops_per_second']} операций/сек.)")
+        for failure in stats["failures"]:
+            print("  НАРУШЕНИЕ:", failure)
+        print(f"  {'операция':<26}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+        for name, latency in stats["latency_ms"].items():
+            print(f"  {name:<26}{latency['count']:>8}{latency['p50']:>10}{latency['p95']:>10}"
+                  f"{latency['p99']:>10}{latency['max']:>10}")
+
+
+# --- Журнал заданий: одновременные проверки одного пользователя ---
+
+CREDIT_STRESS_USERS = 50
+# 2 пробных задания плюс купленные
+CREDIT_STRESS_GRANT = 3
+CREDIT_STRESS_FAILURE_RATIO = 0.3
+CREDIT_STRESS_REVIEW_SECONDS = 0.02
+# SQLite-функции database.py синхронны внутри корутин, поэтому гонку между соединениями
+# создают потоки, каждый со своим циклом событий (как несколько процессов бота)
+CREDIT_STRESS_THREADS = 8
+
+
+async def _fire_reviews(store, user_ids: List[int], seed: int) -> Counter:
+    """Одновременные проверки: резерв, «генерация», затем подтверждение или возврат задания."""
+    rng = random.Random(seed)
+    outcomes = Counter()
+
+    async def review(user_id: int):
+        allowed, reservation_id = await store.reserve_task(user_id)
+        if not allowed:
+            outcomes["denied"] += 1
+            return
+        await asyncio.sleep(rng.random() * CREDIT_STRESS_REVIEW_SECONDS)
+        # Результат await сначала сохраняется: «outcomes[...] += await» потерял бы параллельные прибавки
+        if rng.random() < CREDIT_STRESS_FAILURE_RATIO:
+            settled = await store.release_task_reservation(reservation_id)
+            outcomes["released"] += settled
+        else:
+            settled = await store.commit_task_reservation(reservation_id)
+            outcomes[("committed", user_id)] += settled
+        # Повторное завершение того же резерва ничего не меняет
+        settled_again = await store.release_task_reservation(reservation_id)
+        outcomes["double_settled"] += settled_again
+
+    await asyncio.gather(*(review(user_id) for user_id in user_ids))
+    return outcomes
+
+
+async def run_credit_stress(args) -> dict:
+    """Каждый пользователь одновременно отправляет --credit-stress ответов при балансе 5 заданий."""
+    workdir = tempfile.mkdtemp(prefix="egebot-credits-")
+    results = {}
+    try:
+        for backend in _storage_backends(args):
+            async with _bench_storage(backend, args, workdir) as store:
+                user_ids = [FIRST_USER_ID + number for number in range(CREDIT_STRESS_USERS)]
+                for user_id in user_ids:
+                    await store.add_user(user_id, f"user_{user_id}")
+                    await store.add_tasks(user_id, CREDIT_STRESS_GRANT)
+                credits = (await store.get_available_tasks(user_ids[0]))["tasks_left"]
+                reviews = user_ids * args.credit_stress
+                random.Random(args.seed).shuffle(reviews)
+
+                started = time.perf_counter()
+                if backend == storage.BACKEND_SQLITE:
+                    loop = asyncio.get_running_loop()
+                    chunks = [reviews[index::CREDIT_STRESS_THREADS] for index in range(CREDIT_STRESS_THREADS)]
+                    with concurrent.futures.ThreadPoolExecutor(CREDIT_STRESS_THREADS) as pool:
+                        parts = await asyncio.gather(*(
+                            loop.run_in_executor(pool, asyncio.run, _fire_reviews(store, chunk, args.seed + index))
+                            for index, chunk in enumerate(chunks)
+                        ))
+                    outcomes = sum(parts, Counter())
+                else:
+                    outcomes = await _fire_reviews(store, reviews, args.seed)
+                elapsed = time.perf_counter() - started
+
+                failures = []
+                for user_id in user_ids:
+                    committed = outcomes[("committed", user_id)]
+                    balance = (await store.get_available_tasks(user_id))["tasks_left"]
+                    if committed > credits or balance < 0 or committed + balance != credits:
+                        failures.append(f"user {user_id}: баланс {credits}, списано {committed}, осталось {balance}")
+                if outcomes["double_settled"]:
+                    failures.append(f"резервы завершены повторно: {outcomes['double_settled']}")
+                mismatches = await store.count_ledger_mismatches()
+                if mismatches:
+                    failures.append(f"баланс не сходится с журналом у {mismatches} пользователей")
+                committed_total = sum(value for key, value in outcomes.items() if isinstance(key, tuple))
+                results[backend] = {
+                    "reviews": len(reviews),
+                    "credits": credits * len(user_ids),
+                    "committed": committed_total,
+                    "released": outcomes["released"],
+                    "denied": outcomes["denied"],
+                    "seconds": round(elapsed, 2),
+                    "failures": failures,
+                }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def print_credit_stress_report(result: dict):
+    for backend, stats in result.items():
+        status = "OK" if not stats["failures"] else f"ОШИБОК: {len(stats['failures'])}"
+        print(f"Журнал заданий ({backend}): {stats['reviews']} одновременных проверок за {stats['seconds']} сек., "
+              f"заданий {stats['credits']}; списано {stats['committed']}, возвращено {stats['released']}, "
+              f"отказано {stats['denied']} — {status}")
+        for failure in stats["failures"][:20]:
+            print("  НАРУШЕНИЕ:", failure)
+
+
+# --- Проверка оплаты: много нажатий подряд ---
+
+PAYMENT_TAPS_TARIFF = "single"
+
+
+async def _tap_payment_check(harness: "Harness", builder: TraceBuilder, taps: int) -> Tuple[int, Counter]:
+    """Одновременно нажимает «проверить оплату» taps раз; возвращает число запросов OpState и ошибки."""
+    calls_before = harness.services.calls["robokassa.op_state"]
+    errors = Counter()
+
+    async def tap():
+        try:
+            await harness.dp.feed_update(harness.bot, builder.callback("check_robokassa_payment"))
+        except Exception as e:
+            errors[type(e).__name__] += 1
+
+    await asyncio.gather(*(tap() for _ in range(taps)))
+    return harness.services.calls["robokassa.op_state"] - calls_before, errors
+
+
+async def run_payment_taps(args) -> dict:
+    """
+    Один пользователь покупает задание и --payment-taps раз одновременно жмет «проверить оплату»:
+    сначала при сбое Robokassa, затем пока счет не оплачен, затем после оплаты.
+    """
+    args.throttle = False
+    harness = Harness(args)
+    await harness.start()
+    failures = []
+    rounds = {}
+    user_id = FIRST_USER_ID
+    builder = TraceBuilder(user_id)
+    services = harness.services
+    try:
+        for update in (builder.text("/start"), builder.callback("show_subscribe_options"),
+                       builder.callback(f"buy_{PAYMENT_TAPS_TARIFF}")):
+            await harness.dp.feed_update(harness.bot, update)
+        balance_before = (await storage.get().get_available_tasks(user_id))["tasks_left"]
+
+        # Сбой Robokassa: один запрос на всю пачку, но ошибка не запоминается как «не оплачено»
+        services.robokassa_error_status = 503
+        rounds["error"], errors = await _tap_payment_check(harness, builder, args.payment_taps)
+        rounds["after_error"], more_errors = await _tap_payment_check(harness, builder, 1)
+        errors += more_errors
+        services.robokassa_error_status = None
+        if rounds["error"] != 1:
+            failures.append(f"при сбое {args.payment_taps} нажатий дали {rounds['error']} запросов OpState вместо 1")
+        if rounds["after_error"] != 1:
+            failures.append("сбой Robokassa запомнен как «не оплачено»: повторная проверка не пошла в OpState")
+
+        # Не оплачено: один запрос, следующие нажатия отвечают из кэша отрицательных ответов
+        services.paid_ratio = 0.0
+        rounds["unpaid"], more_errors = await _tap_payment_check(harness, builder, args.payment_taps)
+        errors += more_errors
+        rounds["unpaid_cached"], more_errors = await _tap_payment_check(harness, builder, args.payment_taps)
+        errors += more_errors
+        if rounds["unpaid"] != 1:
+            failures.append(f"неоплаченный счет: {rounds['unpaid']} запросов OpState вместо 1")
+        if rounds["unpaid_cached"] != 0:
+            failures.append(f"ответ «не оплачено» не запомнен: еще {rounds['unpaid_cached']} запросов OpState")
+
+        # Оплачено: один запрос, счет проводится и задание начисляется ровно один раз
+        robokassa_api._negative_results.clear()
+        services.paid_ratio = 1.0
+        rounds["paid"], more_errors = await _tap_payment_check(harness, builder, args.payment_taps)
+        errors += more_errors
+        if rounds["paid"] != 1:
+            failures.append(f"оплаченный счет: {rounds['paid']} запросов OpState вместо 1")
+        balance_after = (await storage.get().get_available_tasks(user_id))["tasks_left"]
+        credited = balance_after - balance_before
+        if credited != db.TARIFF_TASKS[PAYMENT_TAPS_TARIFF]:
+            failures.append(f"начислено заданий: {credited} вместо {db.TARIFF_TASKS[PAYMENT_TAPS_TARIFF]}")
+        with sqlite3.connect(db.DB_FILE) as conn:
+            payments = conn.execute("SELECT COUNT(*) FROM payments WHERE user_id = ?", (user_id,)).fetchone()[0]
+            pending = conn.execute("SELECT COUNT(*) FROM pending_payments WHERE user_id = ?", (user_id,)).fetchone()[0]
+        if payments != 1 or pending != 0:
+            failures.append(f"счетов проведено {payments}, в ожидании {pending} (ожидалось 1 и 0)")
+        if errors:
+            failures.append(f"ошибки в хендлере: {dict(errors)}")
+    finally:
+        await harness.stop()
+    return {"taps": args.payment_taps, "op_state_requests": rounds, "credited": credited, "failures": failures}
+
+
+def print_payment_taps_report(result: dict):
+    requests = result["op_state_requests"]
+    status = "OK" if not result["failures"] else f"ОШИБОК: {len(result['failures'])}"
+    print(f"Проверка оплаты, {result['taps']} одновременных нажатий — запросов OpState: "
+          f"при сбое {requests.get('error')} (+{requests.get('after_error')} на повторное нажатие), "
+          f"не оплачено {requests.get('unpaid')} (+{requests.get('unpaid_cached')} из кэша), "
+          f"оплачено {requests.get('paid')}; начислено заданий {result['credited']} — {status}")
+    for failure in result["failures"]:
+        print("  НАРУШЕНИЕ:", failure)
+
+
+# --- Рассылка: лимиты Telegram, заблокировавшие бота, перезапуск ---
+
+# Каждый BROADCAST_BLOCKED_EVERY-й пользователь заблокировал бота, каждому BROADCAST_FLOOD_EVERY-му
+# Telegram один раз отвечает 429, а одному — 429 на каждую попытку
+BROADCAST_BLOCKED_EVERY = 10
+BROADCAST_FLOOD_EVERY = 25
+BROADCAST_RATE = 500
+
+
+async def run_broadcast_check(args) -> dict:
+    """
+    Рассылка --broadcast пользователям через заглушку Bot API. На середине задача рассылки
+    отменяется (как при перезапуске бота) и запускается снова с сохраненной позиции.
+    """
+    services = FakeServices(args.telegram_latency, 0, 0, 0)
+    await services.start()
+    workdir = tempfile.mkdtemp(prefix="egebot-broadcast-")
+    db.DB_FILE = os.path.join(workdir, "users.db")
+    await db.db_start()
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f"{services.base_url}/tg"))
+    bot = Bot(token=TELEGRAM_TOKEN, session=session)
+    rate_limiter = broadcast.rate_limiter
+    broadcast.rate_limiter = broadcast.RateLimiter(BROADCAST_RATE)
+    try:
+        user_ids = [FIRST_USER_ID + number for number in range(args.broadcast)]
+        for user_id in user_ids:
+            await storage.get().add_user(user_id, f"user_{user_id}")
+        services.blocked_chats = set(user_ids[::BROADCAST_BLOCKED_EVERY])
+        flooded = [user_id for user_id in user_ids[1::BROADCAST_FLOOD_EVERY] if user_id not in services.blocked_chats]
+        services.flood_chats.update({user_id: 1 for user_id in flooded})
+        always_flooded = user_ids[-1]
+        services.flood_chats[always_flooded] = 10 ** 9
+        expected = [user_id for user_id in user_ids
+                    if user_id not in services.blocked_chats and user_id != always_flooded]
+
+        broadcast_id = await db.create_broadcast(SUPER_ADMIN_ID, 1, SUPER_ADMIN_ID)
+        started = time.perf_counter()
+        # Первый запуск прерывается на середине, как при перезапуске бота
+        first_run = asyncio.create_task(broadcast.run_broadcast(bot, broadcast_id))
+        while sum(services.copied.values()) < len(expected) // 2 and not first_run.done():
+            await asyncio.sleep(0.005)
+        first_run.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await first_run
+        copied_before_restart = sum(services.copied.values())
+        await broadcast.run_broadcast(bot, broadcast_id)
+        elapsed = time.perf_counter() - started
+
+        row = await db.get_broadcast(broadcast_id)
+        with sqlite3.connect(db.DB_FILE) as conn:
+            marked_blocked = {user_id for (user_id,) in conn.execute("SELECT user_id FROM users WHERE is_blocked")}
+        duplicates = sum(count - 1 for count in services.copied.values() if count > 1)
+        missing = [user_id for user_id in expected if not services.copied[user_id]]
+
+        failures = []
+        if row["status"] != "finished":
+            failures.append(f"статус рассылки {row['status']}")
+        if missing:
+            failures.append(f"не получили сообщение: {len(missing)} пользователей")
+        # Повторно может уйти только сообщение, отправка которого прервалась перезапуском
+        if duplicates > 1:
+            failures.append(f"после перезапуска повторно отправлено {duplicates} сообщений")
+        if services.copied[always_flooded]:
+            failures.append("сообщение с бесконечным 429 считается доставленным")
+        if row["sent"] != len(expected) or row["failed"] != 1 or row["blocked"] != len(services.blocked_chats):
+            failures.append(f"счетчики рассылки: отправлено {row['sent']}, ошибок {row['failed']}, "
+                            f"заблокировали {row['blocked']} (ожидалось {len(expected)}, 1, "
+                            f"{len(services.blocked_chats)})")
+        if marked_blocked != services.blocked_chats:
+            failures.append(f"помечено заблокировавшими {len(marked_blocked)} из {len(services.blocked_chats)}")
+    finally:
+        broadcast.rate_limiter = rate_limiter
+        await bot.session.close()
+        await services.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "users": args.broadcast,
+        "seconds": round(elapsed, 2),
+        "copied_before_restart": copied_before_restart,
+        "duplicates": duplicates,
+        "sent": row["sent"],
+        "failed": row["failed"],
+        "blocked": row["blocked"],
+        "flood_retries": len(flooded),
+        "failures": failures,
+    }
+
+
+def print_broadcast_report(result: dict):
+    status = "OK" if not result["failures"] else f"ОШИБОК: {len(result['failures'])}"
+    print(f"Рассылка на {result['users']} пользователей за {result['seconds']} сек. с перезапуском после "
+          f"{result['copied_before_restart']} сообщений: отправлено {result['sent']}, ошибок {result['failed']}, "
+          f"заблокировали {result['blocked']}, повторов после перезапуска {result['duplicates']}, "
+          f"пауз по 429 {result['flood_retries']} — {status}")
+    for failure in result["failures"]:
+        print("  НАРУШЕНИЕ:", failure)
+
+
+# --- Профилировщик: накладные расходы и разбивка времени ---
+
+PROFILER_CHECK_CALLS = 200
+PROFILER_CHECK_OVERLAP = 0.05
+
+
+async def _check_dependency_attribution(user_id: int) -> dict:
+    """
+    Время базы по профилировщику против фактического: get_available_tasks вызывает
+    check_subscription, а та — is_admin_db, и все три обернуты в @timed("db").
+    Затем два одновременных вызова Gemini: по профилировщику это PROFILER_CHECK_OVERLAP, а не вдвое больше.
+    """
+    timings = metrics.DependencyTimings()
+    token = metrics.dependency_timings_var.set(timings)
+    try:
+        started = time.perf_counter()
+        for _ in range(PROFILER_CHECK_CALLS):
+            await storage.get().get_available_tasks(user_id)
+        db_wall = time.perf_counter() - started
+
+        async def call_gemini():
+            with metrics.measure("gemini", "generate"):
+                await asyncio.sleep(PROFILER_CHECK_OVERLAP)
+
+        started = time.perf_counter()
+        await asyncio.gather(call_gemini(), call_gemini())
+        gemini_wall = time.perf_counter() - started
+    finally:
+        metrics.dependency_timings_var.reset(token)
+    return {
+        "db_wall": db_wall,
+        "db_profiled": timings.totals.get("db", 0.0),
+        "gemini_wall": gemini_wall,
+        "gemini_profiled": timings.totals.get("gemini", 0.0),
+    }
+
+
+async def run_profiler_check(args) -> dict:
+    """
+    Один и тот же сценарий на --profiler-check пользователях без профилировщика и с ним
+    (каждый апдейт записывается как медленный), плюс проверка разбивки времени.
+    """
+    args.throttle = False
+    harness = Harness(args)
+    await harness.start()
+    slow_updates = profiler._slow_updates
+    threshold = profiler.SLOW_UPDATE_THRESHOLD
+    try:
+        await storage.get().add_user(FIRST_USER_ID, "profiler_check")
+        attribution = await _check_dependency_attribution(FIRST_USER_ID)
+
+        # Первый раунд прогревает кэши и не учитывается
+        latencies = {}
+        for round_number, name in enumerate(("warmup", "off", "on")):
+            first_user = FIRST_USER_ID + 1 + round_number * args.profiler_check
+            harness.latencies.clear()
+            if name == "on":
+                profiler._slow_updates = deque(maxlen=args.profiler_check * 10)
+                profiler.SLOW_UPDATE_THRESHOLD = 0.0
+                profiler.start()
+            try:
+                await harness.run_users(range(first_user, first_user + args.profiler_check))
+            finally:
+                profiler.stop()
+            latencies[name] = [value for values in harness.latencies.values() for value in values]
+        updates = list(profiler._slow_updates)
+    finally:
+        profiler._slow_updates = slow_updates
+        profiler.SLOW_UPDATE_THRESHOLD = threshold
+        await harness.stop()
+
+    failures = []
+    # Допуск на сам замер: perf_counter вокруг цикла и вокруг каждого вызова
+    if attribution["db_profiled"] > attribution["db_wall"] * 1.05:
+        failures.append(f"время базы завышено: {attribution['db_profiled'] * 1000:.1f} мс по профилировщику "
+                        f"при {attribution['db_wall'] * 1000:.1f} мс фактических")
+    if attribution["gemini_profiled"] > attribution["gemini_wall"] * 1.05:
+        failures.append(f"параллельные вызовы Gemini посчитаны дважды: {attribution['gemini_profiled'] * 1000:.1f} мс "
+                        f"при {attribution['gemini_wall'] * 1000:.1f} мс фактических")
+    overstated = [update for update in updates if update["db"] + update["external"] > update["duration"] * 1.05 + 0.001]
+    if overstated:
+        failures.append(f"у {len(overstated)} апдейтов база и внешние вызовы дольше самого апдейта")
+    duration = sum(update["duration"] for update in updates) or 1e-9
+    db_time = sum(update["db"] for update in updates)
+    external_time = sum(update["external"] for update in updates)
+    mean_off = statistics.fmean(latencies["off"]) if latencies["off"] else 0.0
+    mean_on = statistics.fmean(latencies["on"]) if latencies["on"] else 0.0
+    return {
+        "users": args.profiler_check,
+        "updates": len(updates),
+        "mean_off_ms": round(mean_off * 1000, 2),
+        "mean_on_ms": round(mean_on * 1000, 2),
+        "overhead_pct": round((mean_on / mean_off - 1) * 100, 1) if mean_off else 0.0,
+        "db_share": round(db_time / duration * 100, 1),
+        "external_share": round(external_time / duration * 100, 1),
+        "other_share": round(max(duration - db_time - external_time, 0.0) / duration * 100, 1),
+        "attribution": {key: round(value * 1000, 2) for key, value in attribution.items()},
+        "failures": failures,
+    }
+
+
+def print_profiler_check_report(result: dict):
+    status = "OK" if not result["failures"] else f"ОШИБОК: {len(result['failures'])}"
+    attribution = result["attribution"]
+    print(f"Профилировщик, {result['users']} пользователей: средняя задержка {result['mean_off_ms']} мс без него, "
+          f"{result['mean_on_ms']} мс с ним ({result['overhead_pct']:+}%)")
+    print(f"  {result['updates']} апдейтов: база {result['db_share']}%, внешние вызовы {result['external_share']}%, "
+          f"прочее {result['other_share']}%")
+    print(f"  {PROFILER_CHECK_CALLS} x get_available_tasks: база {attribution['db_profiled']} мс по профилировщику, "
+          f"{attribution['db_wall']} мс фактически; 2 параллельных вызова Gemini: {attribution['gemini_profiled']} мс "
+          f"при {attribution['gemini_wall']} мс — {status}")
+    for failure in result["failures"]:
+        print("  НАРУШЕНИЕ:", failure)
+
+
+# --- Накладные расходы защиты от флуда ---
+
+async def _noop_handler(event, data):
+    return None
+
+
+async def measure_throttle_overhead(updates: int) -> dict:
+    """
+    Сколько микросекунд на апдейт добавляет ThrottlingMiddleware, когда апдейт пропускается
+    (без Telegram и хендлеров). Каждый апдейт — от нового пользователя, общий предел снят:
+    так замеряется худший путь пропуска — с созданием корзин и ростом словаря.
+    """
+    throttling.ENABLED = True
+    global_limits = throttling.GLOBAL_RATE, throttling.GLOBAL_BURST
+    throttling.GLOBAL_RATE = throttling.GLOBAL_BURST = float(updates)
+    events = []
+    for number in range(updates):
+        builder = TraceBuilder(FIRST_USER_ID + number)
+        update = builder.callback("show_info") if number % 2 else builder.text("/start")
+        event = update.callback_query or update.message
+        events.append((event, {"event_from_user": event.from_user}))
+    middleware = throttling.ThrottlingMiddleware()
+    # Заранее созданные события не должны попадать в замер через сборку мусора
+    gc.collect()
+    gc.freeze()
+
+    results = {}
+    try:
+        for name in ("baseline", "throttling"):
+            started = time.perf_counter()
+            for event, data in events:
+                if name == "baseline":
+                    await _noop_handler(event, data)
+                else:
+                    await middleware(_noop_handler, event, data)
+            results[name] = (time.perf_counter() - started) / updates * 1e6
+    finally:
+        gc.unfreeze()
+        throttling.GLOBAL_RATE, throttling.GLOBAL_BURST = global_limits
+    return {
+        "updates": updates,
+        "baseline_us": round(results["baseline"], 2),
+        "throttling_us": round(results["throttling"], 2),
+        "overhead_us": round(results["throttling"] - results["baseline"], 2),
+        "rejected": dict(throttling.throttle_stats),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота с локальными заглушками сервисов.")
+    parser.add_argument("--scenario", choices=["start", "task", "voice", "payment", "mixed", "flood"], default="mixed")
+    parser.add_argument("--users", type=int, default=200, help="сколько синтетических пользователей")
+    parser.add_argument("--concurrency", type=int, default=50, help="сколько пользователей активны одновременно")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="задержка ответа Bot API, сек.")
+    parser.add_argument("--gemini-latency", type=float, default=1.0, help="задержка генерации Gemini, сек.")
+    parser.add_argument("--gemini-slow-ratio", type=float, default=0.0,
+                        help="доля генераций Gemini, которые отвечают с задержкой --gemini-slow-latency")
+    parser.add_argument("--gemini-slow-latency", type=float, default=10.0, help="задержка медленных генераций, сек.")
+    parser.add_argument("--hedge", action="store_true", help="включить дублирующие запросы к Gemini")
+    parser.add_argument("--hedge-min-delay", type=float, default=None,
+                        help="не дублировать раньше этого времени, сек. (по умолчанию как в hedging.py)")
+    parser.add_argument("--pressure-threshold", type=int, default=None,
+                        help="сколько рецензий в работе считать нагрузкой (по умолчанию как в config.py)")
+    parser.add_argument("--robokassa-latency", type=float, default=0.1, help="задержка OpState, сек.")
+    parser.add_argument("--paid-ratio", type=float, default=0.5, help="доля счетов, которые OpState считает оплаченными")
+    parser.add_argument("--voice-duration", type=int, default=20, help="длительность голосовых, сек.")
+    parser.add_argument("--voice-corpus", action="store_true",
+                        help="присылать синтетические голосовые (тишина, нажатие, речь с паузами); нужны numpy и ffmpeg")
+    parser.add_argument("--prescreen", action="store_true",
+                        help="включить проверку голосовых перед Gemini (в боте по умолчанию выключена, VOICE_PRESCREEN)")
+    parser.add_argument("--no-prompt-cache", action="store_true", help="отправлять промпт целиком, без кэша контекста")
+    parser.add_argument("--think-time", type=float, default=0.0, help="пауза пользователя между шагами, сек.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--soak", type=float, default=0,
+                        help="soak-тест: сколько секунд гонять бота раунд за раундом (0 — обычный прогон)")
+    parser.add_argument("--soak-sample-interval", type=float, default=60, help="как часто снимать замеры, сек.")
+    parser.add_argument("--soak-warmup-rounds", type=int, default=2, help="раунды прогрева до базового замера")
+    parser.add_argument("--max-rss-growth", type=float, default=64, help="допустимый рост RSS за soak-тест, МБ")
+    parser.add_argument("--max-traced-growth", type=float, default=32,
+                        help="допустимый рост памяти по tracemalloc, МБ")
+    parser.add_argument("--max-fd-growth", type=int, default=16, help="допустимый рост числа открытых дескрипторов")
+    parser.add_argument("--max-task-growth", type=int, default=16, help="допустимый рост числа задач asyncio")
+    parser.add_argument("--history", type=int, default=0,
+                        help="только замерить историю разборов: сколько записей создать (например, 1000000)")
+    parser.add_argument("--history-users", type=int, default=50_000, help="между сколькими пользователями распределить историю")
+    parser.add_argument("--schema-queries", type=int, default=0,
+                        help="только замерить запросы по индексам на базе из N пользователей (например, 1000000)")
+    parser.add_argument("--seen-sets", type=int, default=0,
+                        help="только замерить наборы полученных заданий для N пользователей")
+    parser.add_argument("--seen-catalog", type=int, default=1000, help="сколько заданий на листе для --seen-sets")
+    parser.add_argument("--stats", type=int, default=0,
+                        help="только сравнить экран статистики по сводкам с запросами по истории из N разборов")
+    parser.add_argument("--export", type=int, default=0,
+                        help="только замерить выгрузку для админов на базе из N пользователей")
+    parser.add_argument("--storage-suite", action="store_true",
+                        help="только проверить хранилища (SQLite/PostgreSQL) и замерить операции в секунду")
+    parser.add_argument("--storage-backend", choices=["sqlite", "postgres", "both"], default="both",
+                        help="какие хранилища проверять в --storage-suite")
+    parser.add_argument("--postgres-dsn", default=None,
+                        help="PostgreSQL для --storage-suite (по умолчанию встроенный сервер из пакета pgserver)")
+    parser.add_argument("--credit-stress", type=int, default=0,
+                        help="только проверить журнал заданий: сколько одновременных проверок на пользователя")
+    parser.add_argument("--payment-taps", type=int, default=0,
+                        help="только проверить кнопку «проверить оплату»: сколько одновременных нажатий")
+    parser.add_argument("--broadcast", type=int, default=0,
+                        help="только проверить рассылку через заглушку Bot API на N пользователях")
+    parser.add_argument("--profiler-check", type=int, default=0,
+                        help="только замерить профилировщик: накладные расходы и разбивку времени на N пользователях")
+    parser.add_argument("--throttle", action="store_true", help="включить защиту от флуда в прогоне")
+    parser.add_argument("--throttle-overhead", type=int, default=0,
+                        help="только замерить накладные расходы защиты от флуда на N апдейтах")
+    parser.add_argument("--import-budget", type=float, default=None,
+                        help="только проверить время импорта бота: сколько секунд сверх импорта aiogram допустимо")
+    parser.add_argument("--log-stall", type=int, default=0,
+                        help="только сравнить задержки цикла событий от N строк лога: print() против очереди")
+    parser.add_argument("--no-save", action="store_true", help="не дописывать результат в " + RESULTS_FILE)
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help="завершиться с кодом 1, если результат хуже прошлого прогона с теми же параметрами")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    random.seed(args.seed)
+    if args.voice_corpus and (shutil.which(FFMPEG_BINARY) is None or importlib.util.find_spec("numpy") is None):
+        stop_logging()
+        print(f"Для --voice-corpus нужны ffmpeg ('{FFMPEG_BINARY}', путь задается FFMPEG_BINARY) и numpy: "
+              "установите их или запустите без --voice-corpus.")
+        return 1
+    if args.import_budget is not None:
+        stop_logging()
+        return check_import_budget(args.import_budget)
+    if args.log_stall:
+        stop_logging()
+        return check_log_stall(args.log_stall)
+    if args.schema_queries:
+        try:
+            result = asyncio.run(run_schema_queries(args))
+        finally:
+            stop_logging()
+        print_schema_queries_report(result)
+        return 0
+    if args.seen_sets:
+        try:
+            result = asyncio.run(run_seen_sets(args))
+        finally:
+            stop_logging()
+        print_seen_sets_report(result)
+        return 0
+    if args.stats:
+        try:
+            result = asyncio.run(run_stats(args))
+        finally:
+            stop_logging()
+        print_stats_report(result)
+        return 0
+    if args.export:
+        try:
+            result = asyncio.run(run_export(args))
+        finally:
+            stop_logging()
+        print_export_report(result)
+        return 0
+    if args.storage_suite:
+        try:
+            result = asyncio.run(run_storage_suite(args))
+        finally:
+            stop_logging()
+        print_storage_report(result)
+        return 1 if any(stats["failures"] for stats in result.values()) else 0
+    if args.credit_stress:
+        try:
+            result = asyncio.run(run_credit_stress(args))
+        finally:
+            stop_logging()
+        print_credit_stress_report(result)
+        return 1 if any(stats["failures"] for stats in result.values()) else 0
+    if args.payment_taps:
+        try:
+            result = asyncio.run(run_payment_taps(args))
+        finally:
+            stop_logging()
+        print_payment_taps_report(result)
+        return 1 if result["failures"] else 0
+    if args.broadcast:
+        try:
+            result = asyncio.run(run_broadcast_check(args))
+        finally:
+            stop_logging()
+        print_broadcast_report(result)
+        return 1 if result["failures"] else 0
+    if args.profiler_check:
+        try:
+            result = asyncio.run(run_profiler_check(args))
+        finally:
+            stop_logging()
+        print_profiler_check_report(result)
+        return 1 if result["failures"] else 0
+    if args.throttle_overhead:
+        try:
+            result = asyncio.run(measure_throttle_overhead(args.throttle_overhead))
+        finally:
+            stop_logging()
+        print(f"Защита от флуда: {result['throttling_us']} мкс на апдейт против {result['baseline_us']} мкс "
+              f"без нее, накладные расходы {result['overhead_us']} мкс ({result['updates']} апдейтов, "
+              f"отказов {result['rejected'] or 0})")
+        return 0
+    if args.history:
+        try:
+            result = asyncio.run(run_history(args))
+        finally:
+            stop_logging()
+        print_history_report(result)
+        return 0
+    if args.soak:
+        try:
+            result = asyncio.run(run_soak(args))
+        finally:
+            stop_logging()
+        print_soak_report(result)
+        return 1 if result["failures"] else 0
+
+    try:
+        result = asyncio.run(run_benchmark(args))
+    finally:
+        stop_logging()
+
+    previous = load_previous(result["params"])
+    print_report(result, previous)
+    regressions = compare(result, previous) if previous is not None else []
+    for regression in regressions:
+        print("РЕГРЕССИЯ:", regression)
+
+    if not args.no_save:
+        with open(RESULTS_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
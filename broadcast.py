@@ -0,0 +1,198 @@
+# broadcast.py
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
+
+import database as db
+import storage
+from text_manager import get_text
+
+logger = logging.getLogger(__name__)
+
+# Telegram разрешает ботам около 30 сообщений в секунду разным пользователям.
+# Берем с запасом, чтобы оставить место для обычных ответов бота.
+MESSAGES_PER_SECOND = 25
+# Сколько получателей читать из базы за раз. Позиция сохраняется после каждой отправки,
+# поэтому после перезапуска повторно может уйти только сообщение, отправка которого прервалась
+BATCH_SIZE = 50
+# Сколько раз пытаться отправить одно сообщение при сетевых ошибках
+MAX_SEND_ATTEMPTS = 3
+# Сколько раз подряд выполнять RetryAfter для одного сообщения и сколько всего ждать, сек.;
+# дальше сообщение считается неотправленным, а общий лимит скорости все равно выдерживает паузу
+MAX_RETRY_AFTER_ATTEMPTS = 5
+MAX_RETRY_AFTER_WAIT = 600
+
+SEND_OK = "sent"
+SEND_BLOCKED = "blocked"
+SEND_FAILED = "failed"
+
+
+class RateLimiter:
+    """Равномерно распределяет отправки: не чаще rate раз в секунду на весь процесс."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            if delay > 0:
+                await asyncio.sleep(delay)
+                now = time.monotonic()
+            self._next_slot = max(now, self._next_slot) + self.interval
+
+    def pause(self, seconds: float):
+        """Откладывает все отправки на seconds секунд (после RetryAfter от Telegram)."""
+        self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+
+rate_limiter = RateLimiter(MESSAGES_PER_SECOND)
+
+# broadcast_id -> задача рассылки
+_running: Dict[int, asyncio.Task] = {}
+# broadcast_id -> счетчики текущего запуска (для отчета о скорости)
+_progress: Dict[int, dict] = {}
+
+
+async def send_rate_limited(send: Callable[[], Awaitable]) -> str:
+    """
+    Отправляет одно сообщение с учетом общего лимита скорости.
+    При RetryAfter ждет указанное Telegram время и повторяет попытку, но не больше
+    MAX_RETRY_AFTER_ATTEMPTS раз и не дольше MAX_RETRY_AFTER_WAIT секунд в сумме.
+    Возвращает SEND_OK, SEND_BLOCKED (пользователь заблокировал бота) или SEND_FAILED.
+    """
+    attempts = 0
+    flood_retries = 0
+    flood_wait = 0
+    while attempts < MAX_SEND_ATTEMPTS:
+        await rate_limiter.wait()
+        try:
+            await send()
+            return SEND_OK
+        except TelegramRetryAfter as e:
+            # Это не ошибка сообщения: ждем и пробуем снова, сетевую попытку не считаем
+            logger.warning("Flood control, пауза %s сек.", e.retry_after)
+            rate_limiter.pause(e.retry_after)
+            flood_retries += 1
+            flood_wait += e.retry_after
+            if flood_retries >= MAX_RETRY_AFTER_ATTEMPTS or flood_wait > MAX_RETRY_AFTER_WAIT:
+                logger.warning("Сообщение не отправлено: RetryAfter %s раз подряд, %s сек. ожидания.",
+                               flood_retries, flood_wait)
+                return SEND_FAILED
+        except TelegramForbiddenError:
+            return SEND_BLOCKED
+        except TelegramBadRequest as e:
+            if "chat not found" in str(e).lower():
+                return SEND_BLOCKED
+            logger.warning("Ошибка отправки: %s", e)
+            return SEND_FAILED
+        except Exception as e:
+            attempts += 1
+            logger.warning("Сетевая ошибка (%s/%s): %s", attempts, MAX_SEND_ATTEMPTS, e)
+            await asyncio.sleep(attempts)
+    return SEND_FAILED
+
+
+async def run_broadcast(bot: Bot, broadcast_id: int, report_chat_id: Optional[int] = None):
+    """Рассылает сообщение всем пользователям, продолжая с сохраненной позиции."""
+    broadcast = await db.get_broadcast(broadcast_id)
+    if broadcast is None or broadcast["status"] != "running":
+        return
+
+    last_user_id = broadcast["last_user_id"]
+    progress = _progress[broadcast_id] = {
+        "sent": broadcast["sent"],
+        "failed": broadcast["failed"],
+        "blocked": broadcast["blocked"],
+        "processed_this_run": 0,
+        "started_at": time.monotonic(),
+    }
+    logger.info("Рассылка #%s запущена с user_id > %s.", broadcast_id, last_user_id)
+
+    while True:
+        recipients = await storage.get().get_broadcast_recipients(last_user_id, BATCH_SIZE)
+        if not recipients:
+            break
+        for user_id in recipients:
+            result = await send_rate_limited(lambda: bot.copy_message(
+                chat_id=user_id,
+                from_chat_id=broadcast["source_chat_id"],
+                message_id=broadcast["source_message_id"],
+            ))
+            progress[result] += 1
+            progress["processed_this_run"] += 1
+            if result == SEND_BLOCKED:
+                await storage.get().mark_users_blocked([user_id])
+            last_user_id = user_id
+            await db.save_broadcast_progress(
+                broadcast_id, last_user_id,
+                progress["sent"], progress["failed"], progress["blocked"]
+            )
+
+    await db.finish_broadcast(broadcast_id)
+    stats = get_progress(broadcast_id)
+    logger.info("Рассылка #%s завершена: %s", broadcast_id, stats)
+    if report_chat_id:
+        await send_rate_limited(lambda: bot.send_message(
+            report_chat_id,
+            get_text('admin_broadcast_finished', broadcast_id=broadcast_id, **stats)
+        ))
+
+
+def get_progress(broadcast_id: int) -> Optional[dict]:
+    """Счетчики рассылки и скорость (сообщений в секунду) текущего запуска."""
+    progress = _progress.get(broadcast_id)
+    if progress is None:
+        return None
+    elapsed = max(time.monotonic() - progress["started_at"], 1e-6)
+    return {
+        "sent": progress["sent"],
+        "failed": progress["failed"],
+        "blocked": progress["blocked"],
+        "elapsed": round(elapsed),
+        "rate": round(progress["processed_this_run"] / elapsed, 1),
+    }
+
+
+def is_running(broadcast_id: int) -> bool:
+    task = _running.get(broadcast_id)
+    return task is not None and not task.done()
+
+
+def start_broadcast(bot: Bot, broadcast_id: int, report_chat_id: Optional[int] = None):
+    if is_running(broadcast_id):
+        return
+    task = asyncio.create_task(run_broadcast(bot, broadcast_id, report_chat_id))
+    _running[broadcast_id] = task
+    task.add_done_callback(lambda done: _forget_task(broadcast_id, done))
+
+
+def _forget_task(broadcast_id: int, task: asyncio.Task):
+    if _running.get(broadcast_id) is task:
+        del _running[broadcast_id]
+
+
+async def cancel_broadcast(broadcast_id: int):
+    task = _running.get(broadcast_id)
+    if task is not None:
+        task.cancel()
+    await db.finish_broadcast(broadcast_id, status="cancelled")
+
+
+async def resume_broadcasts(bot: Bot):
+    """Продолжает рассылки, прерванные перезапуском бота."""
+    for broadcast_id in await db.get_unfinished_broadcasts():
+        broadcast = await db.get_broadcast(broadcast_id)
+        start_broadcast(bot, broadcast_id, broadcast["created_by"])
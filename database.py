@@ -1,44 +1,417 @@
 # database.py
 
+import asyncio
+import json
+import logging
 import sqlite3 as sq
-from datetime import datetime, timedelta
-from typing import Tuple, Optional, List
+import time
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Tuple, Optional, List, Dict, Union
 from config import SUPER_ADMIN_ID
+from metrics import timed
+
+logger = logging.getLogger(__name__)
 
 DB_FILE = 'users.db'
 TIMEOUT = 20
 
-async def cleanup_old_pending_payments():
-    """Удаляет из pending_payments счета, созданные более 24 часов назад."""
+SECONDS_IN_DAY = 24 * 60 * 60
+
+def now_ts() -> int:
+    """Текущее время в секундах Unix. Все даты в базе хранятся в этом формате."""
+    return int(time.time())
+
+# Неоплаченные счета старше PENDING_PAYMENT_TTL удаляются небольшими пачками,
+# чтобы одна очистка никогда не блокировала базу надолго.
+PENDING_PAYMENT_TTL = SECONDS_IN_DAY
+CLEANUP_BATCH_SIZE = 500
+
+# Счетчики очистки для админки и логов
+cleanup_stats = {
+    "runs": 0,
+    "deleted_total": 0,
+    "deleted_last_run": 0,
+    "last_run_at": None,
+}
+
+def _delete_expired_payments_batch(threshold: int, batch_size: int) -> int:
+    """
+    Удаляет одну пачку просроченных счетов (по индексу created_at) и добавляет
+    их в дневную сводку expired_payments_daily. Возвращает число удаленных строк.
+    """
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
     cur = db.cursor()
-    
     try:
-        cur.execute("ALTER TABLE pending_payments ADD COLUMN created_at TEXT")
-    except sq.OperationalError:
-        pass
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute(
+            "SELECT invoice_id FROM pending_payments WHERE created_at < ? ORDER BY created_at LIMIT ?",
+            (threshold, batch_size)
+        )
+        invoice_ids = [row[0] for row in cur.fetchall()]
+        if invoice_ids:
+            placeholders = ",".join("?" * len(invoice_ids))
+            cur.execute(f"""
+                INSERT INTO expired_payments_daily (day, tariff, invoices, amount)
+                SELECT date(created_at, 'unixepoch', 'localtime'), tariff, COUNT(*), COALESCE(SUM(amount), 0)
+                FROM pending_payments WHERE invoice_id IN ({placeholders})
+                GROUP BY 1, 2
+                ON CONFLICT (day, tariff) DO UPDATE SET
+                    invoices = invoices + excluded.invoices,
+                    amount = amount + excluded.amount
+            """, invoice_ids)
+            cur.execute(f"DELETE FROM pending_payments WHERE invoice_id IN ({placeholders})", invoice_ids)
+        db.commit()
+        return len(invoice_ids)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
 
-    cur.execute("UPDATE pending_payments SET created_at = ? WHERE created_at IS NULL", (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),))
-    
-    cleanup_time_threshold = (datetime.now() - timedelta(hours=24)).strftime("%Y-%m-%d %H:%M:%S")
-    
-    cur.execute("DELETE FROM pending_payments WHERE created_at < ?", (cleanup_time_threshold,))
-    
-    deleted_rows = cur.rowcount
+@timed("db")
+async def cleanup_old_pending_payments(batch_size: int = CLEANUP_BATCH_SIZE) -> int:
+    """
+    Удаляет из pending_payments счета, созданные более 24 часов назад.
+    Работа идет пачками в отдельном потоке, между пачками управление возвращается боту.
+    """
+    threshold = now_ts() - PENDING_PAYMENT_TTL
+    deleted_rows = 0
+    while True:
+        deleted = await asyncio.to_thread(_delete_expired_payments_batch, threshold, batch_size)
+        deleted_rows += deleted
+        if deleted < batch_size:
+            break
+        await asyncio.sleep(0)
+
+    cleanup_stats["runs"] += 1
+    cleanup_stats["deleted_total"] += deleted_rows
+    cleanup_stats["deleted_last_run"] = deleted_rows
+    cleanup_stats["last_run_at"] = now_ts()
     if deleted_rows > 0:
-        print(f"Автоматическая очистка: удалено {deleted_rows} старых записей из pending_payments.")
-        
-    db.commit()
+        logger.info("Автоматическая очистка: удалено %s старых записей из pending_payments.", deleted_rows)
+    return deleted_rows
+
+def get_cleanup_stats() -> dict:
+    return dict(cleanup_stats)
+
+@timed("db")
+async def get_expired_payments_summary(days: int = 7) -> List[tuple]:
+    """Возвращает сводку (день, тариф, число счетов, сумма) по удаленным неоплаченным счетам."""
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.execute(
+        "SELECT day, tariff, invoices, amount FROM expired_payments_daily "
+        "WHERE day >= date('now', 'localtime', ?) ORDER BY day DESC, tariff",
+        (f"-{days} days",)
+    )
+    summary = cur.fetchall()
     db.close()
+    return summary
+
+# --- МИГРАЦИИ ---
+# Каждая миграция выполняется один раз в отдельной транзакции.
+# Номер последней примененной миграции хранится в PRAGMA user_version.
+# Новые миграции добавляются только в конец списка MIGRATIONS.
+
+def _column_exists(cur, table: str, column: str) -> bool:
+    cur.execute(f"PRAGMA table_info({table})")
+    return any(row[1] == column for row in cur.fetchall())
+
+def _migration_legacy_columns(cur):
+    """Колонки, которые раньше добавлялись через ALTER TABLE при каждом запуске."""
+    if not _column_exists(cur, "users", "tasks_available"):
+        cur.execute("ALTER TABLE users ADD COLUMN tasks_available INTEGER DEFAULT 2")
+    if not _column_exists(cur, "pending_payments", "created_at"):
+        cur.execute("ALTER TABLE pending_payments ADD COLUMN created_at TEXT")
+
+def _migration_integer_timestamps(cur):
+    """Переводит текстовые даты (локальное время) в целые секунды Unix."""
+    cur.execute("""
+        CREATE TABLE users_new (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            subscription_end_date INTEGER,
+            tasks_available INTEGER DEFAULT 2
+        )
+    """)
+    cur.execute("""
+        INSERT INTO users_new (user_id, username, subscription_end_date, tasks_available)
+        SELECT user_id, username, CAST(strftime('%s', subscription_end_date, 'utc') AS INTEGER), tasks_available
+        FROM users
+    """)
+    cur.execute("DROP TABLE users")
+    cur.execute("ALTER TABLE users_new RENAME TO users")
+
+    # Номера счетов не должны повторяться даже после пересоздания таблицы,
+    # поэтому сохраняем счетчик AUTOINCREMENT.
+    cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'pending_payments'")
+    row = cur.fetchone()
+    last_invoice_id = row[0] if row else 0
+    cur.execute("""
+        CREATE TABLE pending_payments_new (
+            invoice_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            tariff TEXT,
+            amount INTEGER,
+            created_at INTEGER
+        )
+    """)
+    cur.execute("""
+        INSERT INTO pending_payments_new (invoice_id, user_id, tariff, amount, created_at)
+        SELECT invoice_id, user_id, tariff, amount,
+               COALESCE(CAST(strftime('%s', created_at, 'utc') AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER))
+        FROM pending_payments
+    """)
+    cur.execute("DROP TABLE pending_payments")
+    cur.execute("ALTER TABLE pending_payments_new RENAME TO pending_payments")
+    cur.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'pending_payments'", (last_invoice_id,))
+    if cur.rowcount == 0 and last_invoice_id:
+        cur.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('pending_payments', ?)", (last_invoice_id,))
+
+def _migration_indexes(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_subscription_end ON users (subscription_end_date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_created_at ON pending_payments (created_at)")
+
+def _migration_expired_payments_summary(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS expired_payments_daily (
+            day TEXT,
+            tariff TEXT,
+            invoices INTEGER DEFAULT 0,
+            amount INTEGER DEFAULT 0,
+            PRIMARY KEY (day, tariff)
+        )
+    """)
+
+def _migration_credit_ledger(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS credit_ledger (
+            entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            delta INTEGER NOT NULL,
+            reservation_id INTEGER,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_credit_ledger_reservation ON credit_ledger (reservation_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_credit_ledger_user ON credit_ledger (user_id, entry_id)")
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS credit_ledger_balance AFTER INSERT ON credit_ledger
+        BEGIN
+            UPDATE users SET tasks_available = tasks_available + NEW.delta WHERE user_id = NEW.user_id;
+        END
+    """)
+
+def _migration_payments(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS payments (
+            invoice_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            tariff TEXT,
+            amount INTEGER,
+            created_at INTEGER,
+            paid_at INTEGER
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_payments_paid_at ON payments (paid_at)")
+
+def _migration_broadcasts(cur):
+    if not _column_exists(cur, "users", "is_blocked"):
+        cur.execute("ALTER TABLE users ADD COLUMN is_blocked INTEGER DEFAULT 0")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source_chat_id INTEGER,
+            source_message_id INTEGER,
+            created_by INTEGER,
+            status TEXT DEFAULT 'running',
+            last_user_id INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            started_at INTEGER,
+            finished_at INTEGER
+        )
+    """)
+
+def _migration_expiry_notifications(cur):
+    # Дата окончания подписки, о которой пользователь уже предупрежден.
+    # При продлении дата меняется, и предупреждение придет снова.
+    if not _column_exists(cur, "users", "expiry_notified_end"):
+        cur.execute("ALTER TABLE users ADD COLUMN expiry_notified_end INTEGER")
+
+def _migration_review_history(cur):
+    # Текст рецензии хранится сжатым zlib; история листается курсором по review_id
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS review_history (
+            review_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            task_id TEXT,
+            task_type TEXT,
+            created_at INTEGER NOT NULL,
+            review BLOB NOT NULL
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_review_history_user ON review_history (user_id, review_id)")
+
+def _migration_seen_tasks(cur):
+    # Какие задания листа пользователь уже получал: битовый набор по номерам заданий на листе.
+    # fingerprint — отпечаток списка заданий, по которому набор построен; сами списки хранятся
+    # в task_catalogs, чтобы после изменения tasks.xlsx перенести биты на новые номера
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS seen_tasks (
+            user_id INTEGER NOT NULL,
+            task_type TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            seen BLOB NOT NULL,
+            PRIMARY KEY (user_id, task_type)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS task_catalogs (
+            fingerprint TEXT PRIMARY KEY,
+            task_keys TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    """)
+
+# Сводная статистика для админки: счетчики по часам и по дням (местное время), которые
+# триггеры увеличивают в той же транзакции, где происходит событие. Экран статистики
+# читает только эти сводки, поэтому его цена не зависит от размера истории.
+STATS_PERIODS = (
+    ("stats_hourly", "hour", "strftime('%Y-%m-%d %H:00', {ts}, 'unixepoch', 'localtime')"),
+    ("stats_daily", "day", "date({ts}, 'unixepoch', 'localtime')"),
+)
+# Триггер, событие, время события, [(счетчик, разрез, прибавка)]
+STATS_TRIGGERS = (
+    ("stats_new_users", "INSERT ON users", "strftime('%s', 'now')", [("new_users", "''", "1")]),
+    ("stats_reviews", "INSERT ON review_history", "NEW.created_at",
+     [("reviews", "COALESCE(NEW.task_type, '')", "1")]),
+    ("stats_payments", "INSERT ON payments", "NEW.paid_at",
+     [("payments", "COALESCE(NEW.tariff, '')", "1"), ("revenue", "COALESCE(NEW.tariff, '')", "COALESCE(NEW.amount, 0)")]),
+)
+
+def _stats_upserts(ts: str, counters) -> str:
+    statements = []
+    for table, column, bucket in STATS_PERIODS:
+        for metric, dimension, delta in counters:
+            statements.append(
+                f"INSERT INTO {table} ({column}, metric, dimension, value) "
+                f"VALUES ({bucket.format(ts=ts)}, '{metric}', {dimension}, {delta}) "
+                f"ON CONFLICT ({column}, metric, dimension) DO UPDATE SET value = value + excluded.value;"
+            )
+    return "\n".join(statements)
+
+def _migration_stats_rollups(cur):
+    for table, column, bucket in STATS_PERIODS:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                {column} TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                dimension TEXT NOT NULL,
+                value INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY ({column}, metric, dimension)
+            ) WITHOUT ROWID
+        """)
+        # Разовое заполнение из уже накопленной истории (у пользователей даты регистрации нет)
+        cur.execute(f"""
+            INSERT INTO {table} ({column}, metric, dimension, value)
+            SELECT {bucket.format(ts="created_at")}, 'reviews', COALESCE(task_type, ''), COUNT(*)
+            FROM review_history GROUP BY 1, 3
+        """)
+        cur.execute(f"""
+            INSERT INTO {table} ({column}, metric, dimension, value)
+            SELECT {bucket.format(ts="paid_at")}, 'payments', COALESCE(tariff, ''), COUNT(*)
+            FROM payments WHERE paid_at IS NOT NULL GROUP BY 1, 3
+        """)
+        cur.execute(f"""
+            INSERT INTO {table} ({column}, metric, dimension, value)
+            SELECT {bucket.format(ts="paid_at")}, 'revenue', COALESCE(tariff, ''), COALESCE(SUM(amount), 0)
+            FROM payments WHERE paid_at IS NOT NULL GROUP BY 1, 3
+        """)
+    for name, event, ts, counters in STATS_TRIGGERS:
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} BEGIN\n{_stats_upserts(ts, counters)}\nEND")
+
+def _migration_ledger_opening_balances(cur):
+    # Начальный баланс (DEFAULT 2 при создании пользователя или баланс, накопленный до журнала)
+    # записывается в журнал строкой 'opening'. Он уже лежит в users.tasks_available, поэтому
+    # триггер баланса такие строки пропускает, а сумма журнала сходится с балансом
+    cur.execute("DROP TRIGGER IF EXISTS credit_ledger_balance")
+    cur.execute("""
+        CREATE TRIGGER credit_ledger_balance AFTER INSERT ON credit_ledger WHEN NEW.kind != 'opening'
+        BEGIN
+            UPDATE users SET tasks_available = tasks_available + NEW.delta WHERE user_id = NEW.user_id;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS credit_ledger_opening AFTER INSERT ON users
+        BEGIN
+            INSERT INTO credit_ledger (user_id, kind, delta, created_at)
+            VALUES (NEW.user_id, 'opening', COALESCE(NEW.tasks_available, 0), strftime('%s', 'now'));
+        END
+    """)
+    cur.execute("""
+        INSERT INTO credit_ledger (user_id, kind, delta, created_at)
+        SELECT u.user_id, 'opening', COALESCE(u.tasks_available, 0) - COALESCE(l.total, 0), strftime('%s', 'now')
+        FROM users u
+        LEFT JOIN (SELECT user_id, SUM(delta) AS total FROM credit_ledger GROUP BY user_id) l ON l.user_id = u.user_id
+        WHERE COALESCE(u.tasks_available, 0) != COALESCE(l.total, 0)
+    """)
+
+def _migration_expiry_retry(cur):
+    # Если предупреждение не удалось отправить, пользователь откладывается до expiry_retry_at,
+    # чтобы не занимать первые места в очереди и не мешать остальным
+    if not _column_exists(cur, "users", "expiry_retry_at"):
+        cur.execute("ALTER TABLE users ADD COLUMN expiry_retry_at INTEGER")
 
+MIGRATIONS = [
+    _migration_legacy_columns,
+    _migration_integer_timestamps,
+    _migration_indexes,
+    _migration_expired_payments_summary,
+    _migration_credit_ledger,
+    _migration_payments,
+    _migration_broadcasts,
+    _migration_expiry_notifications,
+    _migration_review_history,
+    _migration_seen_tasks,
+    _migration_stats_rollups,
+    _migration_ledger_opening_balances,
+    _migration_expiry_retry,
+]
+
+def _apply_migrations(db: sq.Connection):
+    cur = db.cursor()
+    cur.execute("PRAGMA user_version")
+    current_version = cur.fetchone()[0]
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if version <= current_version:
+            continue
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            migration(cur)
+            cur.execute(f"PRAGMA user_version = {version}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        logger.info("Миграция %s (%s) применена.", version, migration.__name__)
+
+@timed("db")
 async def db_start():
     """
-    Инициализирует базу данных и создает таблицы, если они не существуют.
+    Инициализирует базу данных: создает исходные таблицы и применяет недостающие миграции.
     """
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
     cur = db.cursor()
+    # WAL: читатели не блокируют запись, а каждый коммит стоит один fsync вместо нескольких
+    cur.execute("PRAGMA journal_mode=WAL")
     
-    # ИЗМЕНЕНО: Поля trial_tasks_used и single_tasks_purchased заменены на одно tasks_available
+    # Исходная схема (версия 0). Все дальнейшие изменения делаются миграциями.
     # DEFAULT 2 автоматически дает 2 пробные попытки каждому новому пользователю.
     cur.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -64,38 +437,37 @@ async def db_start():
             created_at TEXT 
         )
     """)
-    
-    # Код для миграции со старой структуры (можно удалить после первого запуска)
-    try:
-        cur.execute("ALTER TABLE users ADD COLUMN tasks_available INTEGER DEFAULT 2")
-        print("Миграция: Добавлена колонка tasks_available.")
-        db.commit()
-    except sq.OperationalError:
-        pass # Колонка уже существует
+    db.commit()
 
+    _apply_migrations(db)
+
+    released = _release_stale_reservations(cur)
+    if released:
+        logger.info("Возвращено заданий по незавершенным проверкам: %s.", released)
 
     cur.execute("SELECT 1 FROM admins")
     if cur.fetchone() is None:
         cur.execute("INSERT INTO admins (user_id) VALUES (?)", (SUPER_ADMIN_ID,))
-        print(f"Super admin with ID {SUPER_ADMIN_ID} added to the database.")
+        logger.info("Super admin with ID %s added to the database.", SUPER_ADMIN_ID)
 
     db.commit()
     db.close()
 
+@timed("db")
 async def add_pending_payment(user_id: int, tariff: str, amount: int) -> int:
     """Добавляет информацию о новом счете в базу данных и возвращает ID счета."""
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
     cur = db.cursor()
-    creation_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     cur.execute(
         "INSERT INTO pending_payments (user_id, tariff, amount, created_at) VALUES (?, ?, ?, ?)",
-        (user_id, tariff, amount, creation_time)
+        (user_id, tariff, amount, now_ts())
     )
     invoice_id = cur.lastrowid
     db.commit()
     db.close()
     return invoice_id
 
+@timed("db")
 async def get_pending_payment(invoice_id: int) -> Optional[tuple]:
     """Получает информацию о счете из базы данных."""
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
@@ -105,6 +477,7 @@ async def get_pending_payment(invoice_id: int) -> Optional[tuple]:
     db.close()
     return payment_data
 
+@timed("db")
 async def remove_pending_payment(invoice_id: int):
     """Удаляет информацию о счете после успешной оплаты."""
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
@@ -113,18 +486,168 @@ async def remove_pending_payment(invoice_id: int):
     db.commit()
     db.close()
 
-async def add_user(user_id, username):
+# Что получает пользователь за каждый тариф
+TARIFF_SUBSCRIPTION_DAYS = {"week": 7, "month": 30}
+TARIFF_TASKS = {"single": 1}
+
+@timed("db")
+async def settle_pending_payment(invoice_id: int) -> Optional[tuple]:
+    """
+    Проводит оплаченный счет: переносит его в payments, удаляет из pending_payments
+    и начисляет подписку или задания — все в одной транзакции.
+    Возвращает (user_id, tariff, amount) или None, если счет уже проведен или не найден.
+    Повторный вызов для того же счета ничего не начисляет.
+    """
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
     cur = db.cursor()
-    cur.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
-    if cur.fetchone() is None:
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("SELECT user_id, tariff, amount FROM pending_payments WHERE invoice_id = ?", (invoice_id,))
+        payment_data = cur.fetchone()
+        if payment_data is None:
+            db.rollback()
+            return None
+        cur.execute(
+            "INSERT OR IGNORE INTO payments (invoice_id, user_id, tariff, amount, created_at, paid_at) "
+            "SELECT invoice_id, user_id, tariff, amount, created_at, ? FROM pending_payments WHERE invoice_id = ?",
+            (now_ts(), invoice_id)
+        )
+        if cur.rowcount == 0:
+            db.rollback()
+            return None
+        cur.execute("DELETE FROM pending_payments WHERE invoice_id = ?", (invoice_id,))
+
+        user_id, tariff, _ = payment_data
+        if tariff in TARIFF_SUBSCRIPTION_DAYS:
+            end_date = now_ts() + TARIFF_SUBSCRIPTION_DAYS[tariff] * SECONDS_IN_DAY
+            cur.execute("UPDATE users SET subscription_end_date = ? WHERE user_id = ?", (end_date, user_id))
+        elif tariff in TARIFF_TASKS:
+            cur.execute(
+                "INSERT INTO credit_ledger (user_id, kind, delta, created_at) "
+                "SELECT user_id, 'grant', ?, ? FROM users WHERE user_id = ?",
+                (TARIFF_TASKS[tariff], now_ts(), user_id)
+            )
+        db.commit()
+        return payment_data
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+# --- ОТЛОЖЕННАЯ ЗАПИСЬ ПОЛЬЗОВАТЕЛЕЙ ---
+# /start вызывается очень часто, а username меняется редко. Поэтому:
+# - повторный вызов с тем же username не обращается к базе вообще;
+# - новые пользователи и смена username копятся USER_WRITE_FLUSH_DELAY секунд
+#   и записываются одной транзакцией (group commit);
+# - создание пользователя (с его бесплатными заданиями) дожидается коммита,
+#   а смена username — косметическая и пишется в фоне без ожидания.
+# Кредиты и подписки сюда не попадают и по-прежнему коммитятся сразу.
+USER_WRITE_FLUSH_DELAY = 0.005
+KNOWN_USERS_CACHE_SIZE = 100_000
+
+_KEEP_USERNAME = object()  # маркер: создать пользователя, не трогая username
+
+_known_usernames: "OrderedDict[int, Optional[str]]" = OrderedDict()
+_pending_user_inserts: Dict[int, object] = {}
+_pending_username_updates: Dict[int, Optional[str]] = {}
+_pending_user_waiters: List[asyncio.Future] = []
+_user_flush_task: Optional[asyncio.Task] = None
+_user_flush_lock = asyncio.Lock()
+
+def _remember_username(user_id: int, username: Optional[str]):
+    _known_usernames[user_id] = username
+    _known_usernames.move_to_end(user_id)
+    while len(_known_usernames) > KNOWN_USERS_CACHE_SIZE:
+        _known_usernames.popitem(last=False)
+
+def _write_user_batch(inserts: Dict[int, object], username_updates: Dict[int, Optional[str]]):
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        cur.executemany(
+            "INSERT OR IGNORE INTO users (user_id) VALUES (?)",
+            [(user_id,) for user_id, username in inserts.items() if username is _KEEP_USERNAME]
+        )
         # При создании нового пользователя tasks_available автоматически станет 2 (DEFAULT 2)
-        cur.execute("INSERT INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
-    else:
-        cur.execute("UPDATE users SET username = ? WHERE user_id = ?", (username, user_id))
-    db.commit()
-    db.close()
+        cur.executemany(
+            "INSERT INTO users (user_id, username) VALUES (?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, is_blocked = 0 "
+            "WHERE users.username IS NOT excluded.username OR users.is_blocked",
+            [(user_id, username) for user_id, username in inserts.items() if username is not _KEEP_USERNAME]
+        )
+        cur.executemany(
+            "UPDATE users SET username = ? WHERE user_id = ?",
+            [(username, user_id) for user_id, username in username_updates.items()]
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def _schedule_user_flush():
+    global _user_flush_task
+    if _user_flush_task is None:
+        _user_flush_task = asyncio.get_running_loop().create_task(_flush_user_writes_later())
 
+async def _flush_user_writes_later():
+    global _user_flush_task
+    await asyncio.sleep(USER_WRITE_FLUSH_DELAY)
+    _user_flush_task = None
+    await flush_user_writes()
+
+@timed("db")
+async def flush_user_writes():
+    """Записывает все накопленные изменения пользователей одной транзакцией."""
+    global _pending_user_inserts, _pending_username_updates, _pending_user_waiters
+    async with _user_flush_lock:
+        inserts, updates, waiters = _pending_user_inserts, _pending_username_updates, _pending_user_waiters
+        _pending_user_inserts, _pending_username_updates, _pending_user_waiters = {}, {}, []
+        if not inserts and not updates:
+            return
+        try:
+            await asyncio.to_thread(_write_user_batch, inserts, updates)
+        except Exception as e:
+            logger.error("ОШИБКА записи пользователей в базу: %s", e)
+            # Косметические изменения не повторяем сразу: забываем их,
+            # чтобы следующий /start записал username заново.
+            for user_id in updates:
+                _known_usernames.pop(user_id, None)
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            return
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+async def _enqueue_user_insert(user_id: int, username):
+    if _pending_user_inserts.get(user_id, _KEEP_USERNAME) is _KEEP_USERNAME:
+        _pending_user_inserts[user_id] = username
+    waiter = asyncio.get_running_loop().create_future()
+    _pending_user_waiters.append(waiter)
+    _schedule_user_flush()
+    await waiter
+
+@timed("db")
+async def add_user(user_id, username):
+    """Создает пользователя или обновляет его username. Не пишет в базу, если ничего не изменилось."""
+    if user_id in _known_usernames:
+        if _known_usernames[user_id] == username:
+            _known_usernames.move_to_end(user_id)
+            return
+        _remember_username(user_id, username)
+        _pending_username_updates[user_id] = username
+        _schedule_user_flush()
+        return
+
+    await _enqueue_user_insert(user_id, username)
+    _remember_username(user_id, username)
+
+@timed("db")
 async def get_user_by_username(username: str) -> Optional[tuple]:
     """Находит пользователя в таблице users по его username."""
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
@@ -134,32 +657,36 @@ async def get_user_by_username(username: str) -> Optional[tuple]:
     db.close()
     return user
 
+@timed("db")
 async def set_subscription(user_id: int, days: int):
-    end_date = datetime.now() + timedelta(days=days)
-    end_date_str = end_date.strftime("%Y-%m-%d %H:%M:%S")
+    end_date = now_ts() + days * SECONDS_IN_DAY
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
     cur = db.cursor()
-    cur.execute("UPDATE users SET subscription_end_date = ? WHERE user_id = ?", (end_date_str, user_id))
+    cur.execute("UPDATE users SET subscription_end_date = ? WHERE user_id = ?", (end_date, user_id))
     db.commit()
     db.close()
 
-async def check_subscription(user_id: int) -> Tuple[bool, Optional[str]]:
+@timed("db")
+async def check_subscription(user_id: int) -> Tuple[bool, Optional[Union[int, str]]]:
+    """Возвращает (True, дата окончания в секундах Unix) для активной подписки и (True, "admin") для админов."""
     if await is_admin_db(user_id):
         return True, "admin"
 
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
     cur = db.cursor()
-    cur.execute("SELECT subscription_end_date FROM users WHERE user_id = ?", (user_id,))
+    cur.execute(
+        "SELECT subscription_end_date FROM users WHERE user_id = ? AND subscription_end_date > ?",
+        (user_id, now_ts())
+    )
     result = cur.fetchone()
     db.close()
 
-    if result and result[0]:
-        end_date = datetime.strptime(result[0], "%Y-%m-%d %H:%M:%S")
-        if datetime.now() < end_date:
-            return True, result[0]
+    if result:
+        return True, result[0]
             
     return False, None
 
+@timed("db")
 async def get_available_tasks(user_id: int) -> dict:
     """
     Получает информацию о доступных заданиях.
@@ -170,14 +697,13 @@ async def get_available_tasks(user_id: int) -> dict:
     cur.execute("SELECT tasks_available FROM users WHERE user_id = ?", (user_id,))
     result = cur.fetchone()
 
+    db.close()
+
     if not result:
         # Если пользователь не найден, создаем его. tasks_available по умолчанию станет 2.
-        cur.execute("INSERT INTO users (user_id) VALUES (?)", (user_id,))
-        db.commit()
+        await _enqueue_user_insert(user_id, _KEEP_USERNAME)
         result = (2,) # У нового пользователя 2 попытки
 
-    db.close()
-
     is_subscribed, _ = await check_subscription(user_id)
     tasks_left = result[0]
     
@@ -187,37 +713,148 @@ async def get_available_tasks(user_id: int) -> dict:
     }
 
 
-async def use_task(user_id: int):
-    """Списывает одно доступное задание, если нет подписки."""
-    is_subscribed, _ = await check_subscription(user_id)
-    if is_subscribed:
-        return
+# --- ЖУРНАЛ ЗАДАНИЙ (КРЕДИТОВ) ---
+# Все изменения баланса записываются в журнал credit_ledger только добавлением строк.
+# Триггер credit_ledger_balance поддерживает users.tasks_available (материализованный баланс).
+# Проверка ответа идет в три шага, каждый — одна атомарная SQL-команда:
+#   reserve — списывает задание, только если баланс > 0;
+#   commit  — подтверждает списание после успешной проверки;
+#   release — возвращает задание, если проверка не удалась.
+# Уникальный индекс по reservation_id не дает подтвердить или вернуть резерв дважды.
+# Начальный баланс пользователя записывается строкой 'opening', так что сумма журнала
+# всегда равна tasks_available (см. count_ledger_mismatches).
 
+@timed("db")
+async def reserve_task(user_id: int) -> Tuple[bool, Optional[int]]:
+    """
+    Резервирует одно задание для проверки ответа.
+    Возвращает (разрешено ли, id резерва). Для подписчиков и админов резерв не нужен — id будет None.
+    """
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
     cur = db.cursor()
-    # ИЗМЕНЕНО: Логика списания упрощена
-    cur.execute("UPDATE users SET tasks_available = tasks_available - 1 WHERE user_id = ? AND tasks_available > 0", (user_id,))
+    try:
+        cur.execute(
+            "SELECT EXISTS (SELECT 1 FROM admins WHERE user_id = ?), "
+            "EXISTS (SELECT 1 FROM users WHERE user_id = ? AND subscription_end_date > ?)",
+            (user_id, user_id, now_ts())
+        )
+        is_admin, is_subscribed = cur.fetchone()
+        if is_admin or is_subscribed:
+            return True, None
+        cur.execute(
+            "INSERT INTO credit_ledger (user_id, kind, delta, created_at) "
+            "SELECT user_id, 'reserve', -1, ? FROM users WHERE user_id = ? AND tasks_available > 0",
+            (now_ts(), user_id)
+        )
+        db.commit()
+        if cur.rowcount == 1:
+            return True, cur.lastrowid
+        return False, None
+    finally:
+        db.close()
+
+def _settle_reservation(reservation_id: int, kind: str, delta: int) -> bool:
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.execute(
+        "INSERT OR IGNORE INTO credit_ledger (user_id, kind, delta, reservation_id, created_at) "
+        "SELECT user_id, ?, ?, entry_id, ? FROM credit_ledger WHERE entry_id = ? AND kind = 'reserve'",
+        (kind, delta, now_ts(), reservation_id)
+    )
+    settled = cur.rowcount == 1
     db.commit()
     db.close()
+    return settled
+
+@timed("db")
+async def commit_task_reservation(reservation_id: Optional[int]) -> bool:
+    """Окончательно списывает зарезервированное задание. Повторный вызов ничего не делает."""
+    if reservation_id is None:
+        return False
+    return _settle_reservation(reservation_id, "commit", 0)
+
+@timed("db")
+async def release_task_reservation(reservation_id: Optional[int]) -> bool:
+    """Возвращает зарезервированное задание пользователю. Повторный вызов ничего не делает."""
+    if reservation_id is None:
+        return False
+    return _settle_reservation(reservation_id, "release", 1)
 
+def _release_stale_reservations(cur) -> int:
+    """Возвращает задания по резервам, которые остались незавершенными (например, бот перезапустился во время проверки)."""
+    cur.execute("""
+        INSERT OR IGNORE INTO credit_ledger (user_id, kind, delta, reservation_id, created_at)
+        SELECT r.user_id, 'release', 1, r.entry_id, ?
+        FROM credit_ledger r
+        WHERE r.kind = 'reserve'
+          AND NOT EXISTS (SELECT 1 FROM credit_ledger s WHERE s.reservation_id = r.entry_id)
+    """, (now_ts(),))
+    return cur.rowcount
+
+@timed("db")
 async def add_tasks(user_id: int, count: int):
     """Добавляет купленные задания пользователю."""
     # ИЗМЕНЕНО: add_single_tasks переименована в add_tasks
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
     cur = db.cursor()
-    cur.execute("UPDATE users SET tasks_available = tasks_available + ? WHERE user_id = ?", (count, user_id))
+    cur.execute(
+        "INSERT INTO credit_ledger (user_id, kind, delta, created_at) "
+        "SELECT user_id, 'grant', ?, ? FROM users WHERE user_id = ?",
+        (count, now_ts(), user_id)
+    )
     db.commit()
     db.close()
 
-async def get_subscribed_users() -> List[tuple]:
+@timed("db")
+async def count_ledger_mismatches() -> int:
+    """Сколько пользователей с балансом, который не сходится с суммой журнала (должно быть 0)."""
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.execute("""
+        SELECT COUNT(*) FROM users u
+        WHERE COALESCE(u.tasks_available, 0) != (SELECT COALESCE(SUM(delta), 0) FROM credit_ledger l WHERE l.user_id = u.user_id)
+    """)
+    mismatches = cur.fetchone()[0]
+    db.close()
+    return mismatches
+
+@timed("db")
+async def get_subscribed_users(limit: Optional[int] = None, offset: int = 0) -> List[tuple]:
+    """Возвращает пользователей с активной подпиской. limit/offset позволяют читать список постранично."""
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
     cur = db.cursor()
-    now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cur.execute("SELECT user_id, username, subscription_end_date FROM users WHERE subscription_end_date > ?", (now_str,))
+    query = "SELECT user_id, username, subscription_end_date FROM users WHERE subscription_end_date > ? ORDER BY subscription_end_date, user_id"
+    if limit is not None:
+        cur.execute(query + " LIMIT ? OFFSET ?", (now_ts(), limit, offset))
+    else:
+        cur.execute(query, (now_ts(),))
     users = cur.fetchall()
     db.close()
     return users
 
+@timed("db")
+async def count_subscribed_users() -> int:
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.execute("SELECT COUNT(*) FROM users WHERE subscription_end_date > ?", (now_ts(),))
+    count = cur.fetchone()[0]
+    db.close()
+    return count
+
+@timed("db")
+async def get_usernames(user_ids: List[int]) -> Dict[int, Optional[str]]:
+    """Возвращает сохраненные username для списка пользователей."""
+    if not user_ids:
+        return {}
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    placeholders = ",".join("?" * len(user_ids))
+    cur.execute(f"SELECT user_id, username FROM users WHERE user_id IN ({placeholders})", list(user_ids))
+    usernames = dict(cur.fetchall())
+    db.close()
+    return usernames
+
+@timed("db")
 async def is_admin_db(user_id: int) -> bool:
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
     cur = db.cursor()
@@ -226,6 +863,7 @@ async def is_admin_db(user_id: int) -> bool:
     db.close()
     return result is not None
 
+@timed("db")
 async def get_admins() -> List[int]:
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
     cur = db.cursor()
@@ -234,6 +872,7 @@ async def get_admins() -> List[int]:
     db.close()
     return admins
 
+@timed("db")
 async def add_admin(user_id: int):
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
     cur = db.cursor()
@@ -241,13 +880,350 @@ async def add_admin(user_id: int):
     db.commit()
     db.close()
 
+@timed("db")
 async def remove_admin(user_id: int):
     if user_id == SUPER_ADMIN_ID:
-        print("Attempt to remove super admin was blocked.")
+        logger.warning("Attempt to remove super admin was blocked.")
         return
         
     db = sq.connect(DB_FILE, timeout=TIMEOUT)
     cur = db.cursor()
     cur.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
     db.commit()
-    db.close()
\ No newline at end of file
+    db.close()
+
+# --- РАССЫЛКИ ---
+
+@timed("db")
+async def create_broadcast(source_chat_id: int, source_message_id: int, created_by: int) -> int:
+    """Создает рассылку сообщения source_message_id всем пользователям и возвращает ее ID."""
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.execute(
+        "INSERT INTO broadcasts (source_chat_id, source_message_id, created_by, started_at) VALUES (?, ?, ?, ?)",
+        (source_chat_id, source_message_id, created_by, now_ts())
+    )
+    broadcast_id = cur.lastrowid
+    db.commit()
+    db.close()
+    return broadcast_id
+
+@timed("db")
+async def get_broadcast(broadcast_id: int) -> Optional[dict]:
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    db.row_factory = sq.Row
+    cur = db.cursor()
+    cur.execute("SELECT * FROM broadcasts WHERE broadcast_id = ?", (broadcast_id,))
+    row = cur.fetchone()
+    db.close()
+    return dict(row) if row else None
+
+@timed("db")
+async def get_unfinished_broadcasts() -> List[int]:
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.execute("SELECT broadcast_id FROM broadcasts WHERE status = 'running' ORDER BY broadcast_id")
+    broadcast_ids = [row[0] for row in cur.fetchall()]
+    db.close()
+    return broadcast_ids
+
+@timed("db")
+async def get_broadcast_recipients(after_user_id: int, limit: int) -> List[int]:
+    """Следующая порция получателей рассылки: курсор по user_id, заблокировавшие бота пропускаются."""
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.execute(
+        "SELECT user_id FROM users WHERE user_id > ? AND NOT is_blocked ORDER BY user_id LIMIT ?",
+        (after_user_id, limit)
+    )
+    user_ids = [row[0] for row in cur.fetchall()]
+    db.close()
+    return user_ids
+
+@timed("db")
+async def mark_users_blocked(user_ids: List[int]):
+    """Помечает пользователей, заблокировавших бота: рассылки и предупреждения их пропускают."""
+    if not user_ids:
+        return
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.executemany("UPDATE users SET is_blocked = 1 WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+    db.commit()
+    db.close()
+    # Следующий /start такого пользователя должен дойти до базы и снять отметку
+    for user_id in user_ids:
+        _known_usernames.pop(user_id, None)
+
+@timed("db")
+async def save_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked: int):
+    """Сохраняет позицию рассылки."""
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.execute(
+        "UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, blocked = ? WHERE broadcast_id = ?",
+        (last_user_id, sent, failed, blocked, broadcast_id)
+    )
+    db.commit()
+    db.close()
+
+@timed("db")
+async def finish_broadcast(broadcast_id: int, status: str = "finished"):
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.execute(
+        "UPDATE broadcasts SET status = ?, finished_at = ? WHERE broadcast_id = ?",
+        (status, now_ts(), broadcast_id)
+    )
+    db.commit()
+    db.close()
+
+# --- ПРЕДУПРЕЖДЕНИЯ ОБ ОКОНЧАНИИ ПОДПИСКИ ---
+
+@timed("db")
+async def get_expiring_subscriptions(until: int, limit: int) -> List[tuple]:
+    """
+    Пользователи, чья подписка закончится до until и которых еще не предупредили.
+    Отложенные после неудачной отправки пропускаются до expiry_retry_at.
+    Диапазонный запрос идет по индексу idx_users_subscription_end, поэтому
+    читаются только подписки из окна, а не вся таблица.
+    """
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.execute(
+        "SELECT user_id, subscription_end_date FROM users "
+        "WHERE subscription_end_date > ? AND subscription_end_date <= ? "
+        "AND expiry_notified_end IS NOT subscription_end_date AND NOT is_blocked "
+        "AND (expiry_retry_at IS NULL OR expiry_retry_at <= ?) "
+        "ORDER BY subscription_end_date LIMIT ?",
+        (now_ts(), until, now_ts(), limit)
+    )
+    users = cur.fetchall()
+    db.close()
+    return users
+
+@timed("db")
+async def claim_expiring_subscriptions(until: int, limit: int, lease_until: int) -> List[tuple]:
+    """
+    То же, что get_expiring_subscriptions, но выданные пользователи сразу откладываются до lease_until
+    (в той же транзакции): следующий вызов их не вернет, пока предупреждение не отправлено.
+    """
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    cur.execute(
+        "SELECT user_id, subscription_end_date FROM users "
+        "WHERE subscription_end_date > ? AND subscription_end_date <= ? "
+        "AND expiry_notified_end IS NOT subscription_end_date AND NOT is_blocked "
+        "AND (expiry_retry_at IS NULL OR expiry_retry_at <= ?) "
+        "ORDER BY subscription_end_date LIMIT ?",
+        (now_ts(), until, now_ts(), limit)
+    )
+    users = cur.fetchall()
+    cur.executemany("UPDATE users SET expiry_retry_at = ? WHERE user_id = ?", [(lease_until, user_id) for user_id, _ in users])
+    db.commit()
+    db.close()
+    return users
+
+@timed("db")
+async def mark_expiry_notified(notified: List[tuple], blocked_user_ids: List[int]):
+    """Запоминает, о какой дате окончания предупрежден пользователь: [(user_id, subscription_end_date), ...]."""
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.executemany(
+        "UPDATE users SET expiry_notified_end = ?, expiry_retry_at = NULL WHERE user_id = ?",
+        [(end_date, user_id) for user_id, end_date in notified]
+    )
+    cur.executemany("UPDATE users SET is_blocked = 1 WHERE user_id = ?", [(user_id,) for user_id in blocked_user_ids])
+    db.commit()
+    db.close()
+    for user_id in blocked_user_ids:
+        _known_usernames.pop(user_id, None)
+
+@timed("db")
+async def postpone_expiry_notifications(user_ids: List[int], retry_at: int):
+    """Откладывает предупреждение пользователям, которым его не удалось отправить."""
+    if not user_ids:
+        return
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.executemany("UPDATE users SET expiry_retry_at = ? WHERE user_id = ?", [(retry_at, user_id) for user_id in user_ids])
+    db.commit()
+    db.close()
+
+# --- ИСТОРИЯ РЕЦЕНЗИЙ ---
+
+# Уровень сжатия zlib: рецензия в 2-4 КБ сжимается за десятки микросекунд, выше уровни почти не дают выигрыша
+REVIEW_COMPRESSION_LEVEL = 6
+
+def compress_review(review: str) -> bytes:
+    return zlib.compress(review.encode("utf-8"), REVIEW_COMPRESSION_LEVEL)
+
+def decompress_review(data: bytes) -> str:
+    return zlib.decompress(data).decode("utf-8")
+
+@timed("db")
+async def save_review(user_id: int, task_id: Optional[str], task_type: Optional[str], review: str) -> int:
+    """Сохраняет рецензию в историю пользователя и возвращает ее ID."""
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.execute(
+        "INSERT INTO review_history (user_id, task_id, task_type, created_at, review) VALUES (?, ?, ?, ?, ?)",
+        (user_id, task_id, task_type, now_ts(), compress_review(review))
+    )
+    review_id = cur.lastrowid
+    db.commit()
+    db.close()
+    return review_id
+
+@timed("db")
+async def get_review_page(user_id: int, review_id: Optional[int] = None) -> Optional[dict]:
+    """
+    Одна рецензия из истории пользователя и ID соседних (курсор по review_id): без review_id —
+    самая новая. Читается только эта запись, а не вся история. Возвращает None, если истории нет.
+    """
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    query = """
+        SELECT r.review_id, r.task_id, r.task_type, r.created_at, r.review,
+               (SELECT o.review_id FROM review_history o
+                WHERE o.user_id = r.user_id AND o.review_id < r.review_id ORDER BY o.review_id DESC LIMIT 1),
+               (SELECT n.review_id FROM review_history n
+                WHERE n.user_id = r.user_id AND n.review_id > r.review_id ORDER BY n.review_id LIMIT 1)
+        FROM review_history r
+    """
+    row = None
+    if review_id is not None:
+        cur.execute(query + " WHERE r.user_id = ? AND r.review_id = ?", (user_id, review_id))
+        row = cur.fetchone()
+    if row is None:
+        cur.execute(query + " WHERE r.user_id = ? ORDER BY r.review_id DESC LIMIT 1", (user_id,))
+        row = cur.fetchone()
+    db.close()
+    if row is None:
+        return None
+    review_id, task_id, task_type, created_at, data, older_id, newer_id = row
+    return {
+        "review_id": review_id,
+        "task_id": task_id,
+        "task_type": task_type,
+        "created_at": created_at,
+        "review": decompress_review(data),
+        "older_id": older_id,
+        "newer_id": newer_id,
+    }
+
+# --- ПОЛУЧЕННЫЕ ЗАДАНИЯ ---
+
+@timed("db")
+async def get_seen_tasks(user_id: int, task_type: str) -> Optional[Tuple[str, bytes]]:
+    """Отпечаток списка заданий и битовый набор полученных заданий листа или None."""
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.execute("SELECT fingerprint, seen FROM seen_tasks WHERE user_id = ? AND task_type = ?", (user_id, task_type))
+    row = cur.fetchone()
+    db.close()
+    return row
+
+@timed("db")
+async def save_seen_tasks(user_id: int, task_type: str, fingerprint: str, seen: bytes,
+                          previous: Optional[Tuple[str, bytes]]) -> bool:
+    """
+    Сохраняет набор, только если в базе все еще previous (то, что вернул get_seen_tasks).
+    False — набор успел изменить параллельный запрос, его нужно перечитать.
+    """
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    if previous is None:
+        cur.execute(
+            "INSERT INTO seen_tasks (user_id, task_type, fingerprint, seen) VALUES (?, ?, ?, ?) ON CONFLICT DO NOTHING",
+            (user_id, task_type, fingerprint, seen)
+        )
+    else:
+        cur.execute(
+            "UPDATE seen_tasks SET fingerprint = ?, seen = ? "
+            "WHERE user_id = ? AND task_type = ? AND fingerprint = ? AND seen = ?",
+            (fingerprint, seen, user_id, task_type, *previous)
+        )
+    saved = cur.rowcount == 1
+    db.commit()
+    db.close()
+    return saved
+
+@timed("db")
+async def save_task_catalog(fingerprint: str, task_keys: List[str]):
+    """Запоминает список заданий листа под его отпечатком (если он еще не сохранен)."""
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.execute(
+        "INSERT OR IGNORE INTO task_catalogs (fingerprint, task_keys, created_at) VALUES (?, ?, ?)",
+        (fingerprint, json.dumps(task_keys, ensure_ascii=False), now_ts())
+    )
+    db.commit()
+    db.close()
+
+@timed("db")
+async def get_task_catalog(fingerprint: str) -> Optional[List[str]]:
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    cur.execute("SELECT task_keys FROM task_catalogs WHERE fingerprint = ?", (fingerprint,))
+    row = cur.fetchone()
+    db.close()
+    return json.loads(row[0]) if row else None
+
+# --- СТАТИСТИКА ---
+
+# Периоды экрана статистики: название -> (таблица, столбец, начало периода).
+# Каждый период — диапазон первичного ключа сводки: не больше 30 дней (или 24 часов) на счетчик и разрез
+STATS_WINDOWS = (
+    ("24h", "stats_hourly", "hour", "strftime('%Y-%m-%d %H:00', 'now', 'localtime', '-23 hours')"),
+    ("today", "stats_daily", "day", "date('now', 'localtime')"),
+    ("7d", "stats_daily", "day", "date('now', 'localtime', '-6 days')"),
+    ("30d", "stats_daily", "day", "date('now', 'localtime', '-29 days')"),
+)
+
+@timed("db")
+async def get_stats_summary() -> Dict[str, Dict[str, Dict[str, int]]]:
+    """
+    Сводка для экрана статистики: период -> счетчик -> разрез (тип задания, тариф) -> значение.
+    Читаются только сводные таблицы stats_hourly и stats_daily.
+    """
+    db = sq.connect(DB_FILE, timeout=TIMEOUT)
+    cur = db.cursor()
+    summary = {}
+    for name, table, column, start in STATS_WINDOWS:
+        cur.execute(
+            f"SELECT metric, dimension, SUM(value) FROM {table} WHERE {column} >= {start} GROUP BY metric, dimension"
+        )
+        period = summary[name] = {}
+        for metric, dimension, value in cur.fetchall():
+            period.setdefault(metric, {})[dimension] = value
+    db.close()
+    return summary
+
+# --- ВЫГРУЗКА ДЛЯ АДМИНОВ ---
+
+# Файл выгрузки -> (заголовок CSV, запрос). Даты переводятся в текст самим SQLite
+EXPORT_TABLES = (
+    ("users", ["user_id", "username", "subscription_end", "tasks_available", "is_blocked"],
+     "SELECT user_id, username, datetime(subscription_end_date, 'unixepoch', 'localtime'), tasks_available, "
+     "is_blocked FROM users ORDER BY user_id"),
+    ("pending_payments", ["invoice_id", "user_id", "tariff", "amount", "created_at"],
+     "SELECT invoice_id, user_id, tariff, amount, datetime(created_at, 'unixepoch', 'localtime') "
+     "FROM pending_payments ORDER BY invoice_id"),
+    ("payments", ["invoice_id", "user_id", "tariff", "amount", "created_at", "paid_at"],
+     "SELECT invoice_id, user_id, tariff, amount, datetime(created_at, 'unixepoch', 'localtime'), "
+     "datetime(paid_at, 'unixepoch', 'localtime') FROM payments ORDER BY invoice_id"),
+)
+# Сколько строк читать из курсора за раз: в памяти никогда не больше одной такой пачки
+EXPORT_FETCH_SIZE = 5_000
+
+def open_export_snapshot() -> sq.Connection:
+    """
+    Соединение только для чтения с одной транзакцией на всю выгрузку: все таблицы читаются
+    из одного снимка базы, а в режиме WAL чтение не блокирует запись бота.
+    Пачки читаются из потоков asyncio.to_thread по очереди, поэтому проверка потока отключена.
+    Закрывать соединение (close) должен вызывающий.
+    """
+    db = sq.connect(Path(DB_FILE).resolve().as_uri() + "?mode=ro", uri=True, timeout=TIMEOUT, check_same_thread=False)
+    db.execute("BEGIN")
+    return db
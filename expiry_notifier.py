@@ -0,0 +1,74 @@
+# expiry_notifier.py
+
+import asyncio
+import logging
+from datetime import datetime
+
+from aiogram import Bot
+
+import database as db
+import keyboards as kb
+import storage
+from broadcast import send_rate_limited, SEND_OK, SEND_BLOCKED
+from text_manager import get_text
+
+logger = logging.getLogger(__name__)
+
+# За сколько часов до окончания подписки предупреждать пользователя
+NOTICE_HOURS = 24
+# Как часто проверять (секунды)
+CHECK_INTERVAL = 10 * 60
+# Сколько пользователей обрабатывать за один запрос к базе
+BATCH_SIZE = 100
+# Через сколько секунд повторить предупреждение, которое не удалось отправить
+RETRY_DELAY = 60 * 60
+# Проверка идет на каждом хосте бота. Взятые в работу пользователи откладываются на это время,
+# чтобы другой хост не отправил им то же предупреждение; если хост упал, не успев отправить,
+# предупреждение отправится после этого срока
+CLAIM_LEASE = 60 * 60
+
+
+async def notify_expiring_subscriptions(bot: Bot) -> int:
+    """
+    Предупреждает пользователей, у которых подписка закончится в ближайшие NOTICE_HOURS часов.
+    Отправка идет через общий лимит скорости рассылок. Возвращает число отправленных уведомлений.
+    """
+    until = db.now_ts() + NOTICE_HOURS * 60 * 60
+    sent = 0
+    while True:
+        due_users = await storage.get().claim_expiring_subscriptions(until, BATCH_SIZE, db.now_ts() + CLAIM_LEASE)
+        if not due_users:
+            break
+        notified, blocked_user_ids, failed_user_ids = [], [], []
+        for user_id, end_date in due_users:
+            text = get_text('subscription_expiring', end_date=datetime.fromtimestamp(end_date).strftime("%d.%m.%Y %H:%M"))
+            result = await send_rate_limited(
+                lambda: bot.send_message(user_id, text, reply_markup=kb.subscribe_menu_keyboard())
+            )
+            if result == SEND_OK:
+                sent += 1
+                notified.append((user_id, end_date))
+            elif result == SEND_BLOCKED:
+                blocked_user_ids.append(user_id)
+            else:
+                failed_user_ids.append(user_id)
+        await storage.get().mark_expiry_notified(notified, blocked_user_ids)
+        # Неудачные откладываются, иначе они каждый раз занимали бы начало очереди и остальные
+        # пользователи не получали бы предупреждений
+        await storage.get().postpone_expiry_notifications(failed_user_ids, db.now_ts() + RETRY_DELAY)
+        # Если отправить не удалось никому (Telegram недоступен), не крутимся в цикле до следующей проверки
+        if not notified and not blocked_user_ids:
+            break
+    if sent:
+        logger.info("Отправлено предупреждений об окончании подписки: %s.", sent)
+    return sent
+
+
+async def scheduled_expiry_notifications(bot: Bot, wait_for_seconds: int = CHECK_INTERVAL):
+    """Запускает проверку окончания подписок каждые N секунд."""
+    while True:
+        try:
+            await notify_expiring_subscriptions(bot)
+        except Exception as e:
+            logger.exception("Ошибка при отправке предупреждений об окончании подписки: %s", e)
+        await asyncio.sleep(wait_for_seconds)
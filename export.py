@@ -0,0 +1,99 @@
+# export.py
+
+import asyncio
+import csv
+import io
+import logging
+import os
+import zipfile
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from metrics import measure
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Выгрузка пользователей и счетов для админов: каждая таблица пишется в свой CSV внутри zip-архива.
+# Строки приходят из хранилища пачками из одного снимка данных и сразу сжимаются в файл, поэтому
+# память не зависит от размера базы. Сжатие и запись идут в отдельном потоке, бот в это время
+# продолжает отвечать.
+# XLSX не подходит: в лист помещается не больше 1 048 576 строк.
+EXPORT_DIR = 'exports'
+COMPRESSION_LEVEL = 6
+# Telegram принимает от бота документы до 50 МБ
+MAX_DOCUMENT_BYTES = 50 * 1024 * 1024
+
+_running = False
+
+
+def is_running() -> bool:
+    return _running
+
+
+class ExportArchive:
+    """Zip-архив выгрузки: пачки строк дописываются в CSV текущей таблицы (синхронно)."""
+
+    def __init__(self, path: str):
+        self._archive = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=COMPRESSION_LEVEL)
+        self._name: Optional[str] = None
+        self._text: Optional[io.TextIOWrapper] = None
+        self._writer = None
+        self.counts: Dict[str, int] = {}
+
+    def write(self, name: str, columns: List[str], rows: List[tuple]):
+        if name != self._name:
+            self._close_entry()
+            # utf-8-sig: Excel открывает такой CSV с кириллицей без ручного выбора кодировки
+            raw = self._archive.open(f"{name}.csv", "w", force_zip64=True)
+            self._text = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+            self._writer = csv.writer(self._text)
+            self._writer.writerow(columns)
+            self._name = name
+            self.counts[name] = 0
+        self._writer.writerows(rows)
+        self.counts[name] += len(rows)
+
+    def _close_entry(self):
+        if self._text is not None:
+            self._text.close()
+            self._text = None
+
+    def close(self):
+        self._close_entry()
+        self._archive.close()
+
+
+async def write_export(path: str) -> Dict[str, int]:
+    """Пишет архив выгрузки в path. Возвращает число строк по таблицам."""
+    archive = ExportArchive(path)
+    try:
+        async for name, columns, rows in storage.get().export_rows():
+            await asyncio.to_thread(archive.write, name, columns, rows)
+    finally:
+        await asyncio.to_thread(archive.close)
+    return archive.counts
+
+
+async def build_export() -> Optional[Tuple[str, Dict[str, int]]]:
+    """
+    Собирает архив выгрузки в EXPORT_DIR и возвращает (путь, число строк по таблицам).
+    Возвращает None, если другая выгрузка еще не закончилась.
+    """
+    global _running
+    if _running:
+        return None
+    _running = True
+    path = os.path.join(EXPORT_DIR, f"export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip")
+    try:
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        with measure("db", "export"):
+            counts = await write_export(path)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    finally:
+        _running = False
+    logger.info("Выгрузка %s готова: %s, %s байт.", path, counts, os.path.getsize(path))
+    return path, counts
@@ -2,6 +2,7 @@
 
 import asyncio
 import contextlib
+import logging
 import os
 import re
 from datetime import datetime
@@ -10,19 +11,32 @@ from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import Message, CallbackQuery, FSInputFile, InputMediaPhoto
+from aiogram.types import Message, CallbackQuery, FSInputFile, InputMediaPhoto, BufferedInputFile
 
 import keyboards as kb
 import database as db
 import ai_processing
+import audio_processing
 import robokassa_api
 import task_manager as tm
+import seen_tasks
+import profile_resolver
+import broadcast
+import profiler
+import export
+import storage
 from config import ADMIN_PASSWORD, SUPER_ADMIN_ID
 from text_manager import get_text
-from price_manager import load_prices, save_prices
+from price_manager import load_prices, save_prices, get_price
+
+logger = logging.getLogger(__name__)
 
 router = Router()
 
+SUBSCRIBED_USERS_PAGE_SIZE = 20
+# Часть разбора на странице истории: запас под заголовок до лимита Telegram в 4096 символов
+HISTORY_CHUNK_SIZE = 3800
+
 # Классы состояний
 class UserState(StatesGroup):
     waiting_for_voice = State()
@@ -39,6 +53,7 @@ class AdminState(StatesGroup):
     adding_tasks_getting_count = State()
     editing_prompt_selection = State()
     editing_prompt_waiting_for_text = State()
+    waiting_for_broadcast_message = State()
 
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
@@ -73,19 +88,19 @@ def clean_ai_response(text: str) -> str:
     return cleaned_text
 
 async def is_admin(user_id: int) -> bool:
-    admins = await db.get_admins()
+    admins = await storage.get().get_admins()
     return user_id in admins
 
 async def get_user_status_text(user_id: int) -> str:
     if await is_admin(user_id):
         return get_text('status_admin')
         
-    tasks_info = await db.get_available_tasks(user_id)
+    tasks_info = await storage.get().get_available_tasks(user_id)
     
     if tasks_info["is_subscribed"]:
-        is_subscribed, end_date = await db.check_subscription(user_id)
+        is_subscribed, end_date = await storage.get().check_subscription(user_id)
         if end_date and end_date != "admin":
-            formatted_date = datetime.strptime(end_date, "%Y-%m-%d %H:%M:%S").strftime("%d.%m.%Y")
+            formatted_date = datetime.fromtimestamp(end_date).strftime("%d.%m.%Y")
             return get_text('status_subscribed', end_date=formatted_date)
         return get_text('status_subscribed_no_date')
 
@@ -101,10 +116,12 @@ async def send_main_menu(message: types.Message, user_id: int):
         reply_markup=kb.main_menu_keyboard()
     )
 
-async def send_task(message: types.Message, state: FSMContext, task_data: dict, prompt: str):
+async def send_task(message: types.Message, state: FSMContext, task_data: dict, prompt: str, task_type: str):
     await state.update_data(
         current_task_text=task_data.get('task_text'),
         current_prompt=prompt,
+        current_task_type=task_type,
+        current_task_id=task_data.get('id'),
         time_limit=task_data.get('time_limit')
     )
     await state.set_state(UserState.waiting_for_voice)
@@ -129,13 +146,13 @@ async def send_task(message: types.Message, state: FSMContext, task_data: dict,
             await message.answer_photo(photo=image1)
         await message.answer(full_task_text, parse_mode="MarkdownV2")
     except TelegramBadRequest as e:
-        print(f"Ошибка отправки медиа: {e}. Отправляю только текст.")
+        logger.warning("Ошибка отправки медиа: %s. Отправляю только текст.", e)
         await message.answer(full_task_text, parse_mode="MarkdownV2")
 
 @router.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
     await state.clear()
-    await db.add_user(message.from_user.id, message.from_user.username)
+    await storage.get().add_user(message.from_user.id, message.from_user.username)
     await send_main_menu(message, message.from_user.id)
 
 @router.callback_query(F.data == "main_menu")
@@ -169,13 +186,52 @@ async def show_offer_text(callback: CallbackQuery):
     except FileNotFoundError:
         await callback.answer(get_text('offer_unavailable'), show_alert=True)
         
+@router.callback_query(F.data == "history")
+async def show_history(callback: CallbackQuery):
+    await show_history_page(callback, None, 0)
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("history_"))
+async def show_history_part(callback: CallbackQuery):
+    fields = callback.data[len("history_"):].split("_")
+    if len(fields) == 2 and all(field.isdigit() for field in fields):
+        await show_history_page(callback, int(fields[0]), int(fields[1]))
+    else:
+        # Кнопка с испорченными данными: показываем самый новый разбор, а не оставляем часики
+        await show_history_page(callback, None, 0)
+    await callback.answer()
+
+async def show_history_page(callback: CallbackQuery, review_id, part: int):
+    """Показывает одну часть одного разбора из истории (без review_id — самого нового)."""
+    page = await storage.get().get_review_page(callback.from_user.id, review_id)
+    if page is None:
+        await callback.message.edit_text(get_text('history_empty'), reply_markup=kb.back_to_main_menu_keyboard())
+        return
+    chunks = list(split_message(page["review"], HISTORY_CHUNK_SIZE))
+    part = min(max(part, 0), len(chunks) - 1)
+    header = get_text(
+        'history_header',
+        date=datetime.fromtimestamp(page["created_at"]).strftime("%d.%m.%Y %H:%M"),
+        task_id=page["task_id"] or "—",
+        part=part + 1,
+        parts=len(chunks)
+    )
+    text = f"{header}\n\n{chunks[part]}"
+    markup = kb.history_keyboard(page["review_id"], part, len(chunks), page["older_id"], page["newer_id"])
+    try:
+        await callback.message.edit_text(text, reply_markup=markup, parse_mode="Markdown")
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return
+        # Разбор с невалидной разметкой показываем обычным текстом, как и при отправке
+        await callback.message.edit_text(text, reply_markup=markup)
+
 @router.callback_query(F.data == "show_subscribe_options")
 async def show_subscribe_menu(callback: CallbackQuery, state: FSMContext):
     await state.clear()
-    prices = load_prices()
     await callback.message.edit_text(
         get_text('subscribe_prompt'),
-        reply_markup=kb.subscribe_menu_keyboard(prices)
+        reply_markup=kb.subscribe_menu_keyboard()
     )
     await callback.answer()
 
@@ -183,12 +239,11 @@ async def show_subscribe_menu(callback: CallbackQuery, state: FSMContext):
 async def buy_handler(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     tariff = callback.data.split("_")[1]
-    prices = load_prices()
-    amount = prices.get(tariff)
+    amount = get_price(tariff)
     if not amount:
         return await callback.answer("Тариф не найден.", show_alert=True)
 
-    invoice_id = await db.add_pending_payment(user_id, tariff, amount)
+    invoice_id = await storage.get().add_pending_payment(user_id, tariff, amount)
     if not invoice_id:
         return await callback.answer("Не удалось создать счет.", show_alert=True)
 
@@ -215,7 +270,7 @@ async def check_robokassa_payment_handler(callback: CallbackQuery, state: FSMCon
         await show_subscribe_menu(callback, state)
         return
 
-    payment_data = await db.get_pending_payment(invoice_id)
+    payment_data = await storage.get().get_pending_payment(invoice_id)
     if not payment_data:
         await callback.answer("Счет не найден или уже обработан.", show_alert=True)
         await state.clear()
@@ -225,20 +280,31 @@ async def check_robokassa_payment_handler(callback: CallbackQuery, state: FSMCon
     user_id, tariff, _ = payment_data
     await callback.answer(get_text('payment_check_started'), show_alert=False)
 
-    is_paid = await robokassa_api.check_payment(invoice_id=invoice_id)
-    
+    try:
+        is_paid = await robokassa_api.check_payment(invoice_id=invoice_id)
+    except robokassa_api.PaymentCheckError:
+        # Статус неизвестен: счет остается в ожидании, пользователь может проверить еще раз
+        with contextlib.suppress(TelegramBadRequest):
+            await callback.message.delete()
+        await callback.message.answer(
+            get_text('payment_check_error'),
+            reply_markup=kb.payment_failed_keyboard()
+        )
+        return
+
     with contextlib.suppress(TelegramBadRequest):
         await callback.message.delete()
 
     if is_paid:
         await state.clear()
-        await db.remove_pending_payment(invoice_id)
-        if tariff in ["week", "month"]:
-            days = 7 if tariff == "week" else 30
-            await db.set_subscription(user_id, days)
+        settled = await storage.get().settle_pending_payment(invoice_id)
+        if settled is None:
+            # Счет уже проведен параллельной проверкой — она и сообщит пользователю
+            return
+        if tariff in db.TARIFF_SUBSCRIPTION_DAYS:
+            days = db.TARIFF_SUBSCRIPTION_DAYS[tariff]
             await callback.message.answer(get_text('payment_success_subscription', days=days))
-        elif tariff == "single":
-            await db.add_tasks(user_id, 1)
+        elif tariff in db.TARIFF_TASKS:
             await callback.message.answer(get_text('payment_success_single'))
         await send_main_menu(callback.message, user_id)
     else:
@@ -248,14 +314,13 @@ async def check_robokassa_payment_handler(callback: CallbackQuery, state: FSMCon
         )
 
 async def check_user_can_get_task(user_id: int, message: types.Message) -> bool:
-    tasks_info = await db.get_available_tasks(user_id)
+    tasks_info = await storage.get().get_available_tasks(user_id)
     if not (tasks_info["is_subscribed"] or tasks_info["tasks_left"] > 0):
-        prices = load_prices()
         if isinstance(message, CallbackQuery):
-            await message.message.edit_text(get_text('no_tasks_left'), reply_markup=kb.subscribe_menu_keyboard(prices))
+            await message.message.edit_text(get_text('no_tasks_left'), reply_markup=kb.subscribe_menu_keyboard())
             await message.answer()
         else:
-            await message.answer(get_text('no_tasks_left'), reply_markup=kb.subscribe_menu_keyboard(prices))
+            await message.answer(get_text('no_tasks_left'), reply_markup=kb.subscribe_menu_keyboard())
         return False
     return True
 
@@ -263,6 +328,7 @@ async def check_user_can_get_task(user_id: int, message: types.Message) -> bool:
 async def get_task_handler(callback: CallbackQuery, state: FSMContext):
     if not await check_user_can_get_task(callback.from_user.id, callback):
         return
+    await tm.ensure_loaded_async()
     task_types = tm.get_task_types()
     if not task_types:
         await callback.answer("Не удалось загрузить типы заданий.", show_alert=True)
@@ -274,11 +340,11 @@ async def get_task_handler(callback: CallbackQuery, state: FSMContext):
 async def task_type_selected_handler(callback: CallbackQuery, state: FSMContext):
     task_type = callback.data[len("select_task_"):]
     await callback.message.edit_text("🔄 Загружаю ваше задание...")
-    prompt, task_data = tm.get_random_task(task_type)
+    prompt, task_data = await seen_tasks.pick_task(callback.from_user.id, task_type)
     if not prompt or not task_data:
         await callback.message.edit_text("Не удалось загрузить задание.", reply_markup=kb.back_to_main_menu_keyboard())
         return
-    await send_task(callback, state, task_data, prompt)
+    await send_task(callback, state, task_data, prompt, task_type)
 
 @router.callback_query(F.data == "get_task_by_id_prompt")
 async def get_task_by_id_prompt_handler(callback: CallbackQuery, state: FSMContext):
@@ -292,12 +358,13 @@ async def get_task_by_id_finish_handler(message: Message, state: FSMContext):
     if not await check_user_can_get_task(message.from_user.id, message):
         await state.clear()
         return
+    await tm.ensure_loaded_async()
     prompt, task_data = tm.get_task_by_id(task_id)
     if not task_data:
         await message.answer(get_text('task_not_found'), reply_markup=kb.back_to_main_menu_keyboard())
         await state.clear()
         return
-    await send_task(message, state, task_data, prompt)
+    await send_task(message, state, task_data, prompt, tm.get_task_type_by_id(task_id))
 
 @router.message(UserState.waiting_for_voice, F.voice)
 async def voice_message_handler(message: Message, state: FSMContext):
@@ -306,18 +373,42 @@ async def voice_message_handler(message: Message, state: FSMContext):
     if time_limit and message.voice.duration > time_limit:
         await message.answer(get_text('voice_too_long', limit=time_limit, duration=message.voice.duration))
         return
-    await message.answer(get_text('voice_accepted'))
-    voice_ogg_path = f"voice_{message.from_user.id}.ogg"
+    # Задание резервируется до обращения к AI: параллельные ответы не смогут потратить больше, чем оплачено
+    allowed, reservation_id = await storage.get().reserve_task(message.from_user.id)
+    if not allowed:
+        await state.clear()
+        await message.answer(get_text('no_tasks_left'), reply_markup=kb.subscribe_menu_keyboard())
+        return
+    # Все после резерва — внутри try: если пользователь уже заблокировал бота и ответ не отправится,
+    # finally вернет задание
     try:
+        review_done = False
+        # Если в записи нет речи, задание остается активным и можно прислать ответ заново
+        keep_task = False
+        voice_ogg_path = f"voice_{message.from_user.id}_{message.message_id}.ogg"
+        audio_path = voice_ogg_path
+        await message.answer(get_text('voice_accepted'))
         voice_file_info = await message.bot.get_file(message.voice.file_id)
         await message.bot.download_file(voice_file_info.file_path, voice_ogg_path)
+        # Тишину и случайные нажатия отсекаем до Gemini: не тратим ни запрос, ни задание
+        screening = await audio_processing.prescreen_voice(voice_ogg_path)
+        if screening["status"] == audio_processing.VOICE_EMPTY:
+            keep_task = True
+            await message.answer(get_text('voice_no_speech'))
+            return
+        audio_path = screening["path"]
         task_text = user_data.get('current_task_text', 'Задание не найдено.')
         prompt = user_data.get('current_prompt', 'Промпт не найден.')
-        review = await ai_processing.get_ai_review(prompt, task_text, voice_ogg_path)
+        # После обрезки тишины в Gemini уходит только речь, по ней и выбирается модель
+        duration = screening.get("speech_seconds") or message.voice.duration
+        review = await ai_processing.get_ai_review(
+            prompt, task_text, audio_path, duration=duration, task_type=user_data.get('current_task_type')
+        )
         if "Бот сейчас перегружен" in review:
             await message.answer(review)
         else:
-            await db.use_task(message.from_user.id)
+            review_done = True
+            await storage.get().commit_task_reservation(reservation_id)
             await message.answer("📝 **Ваш разбор ответа:**", parse_mode="Markdown")
             try:
                 # --- НАЧАЛО ИСПРАВЛЕНИЯ ---
@@ -332,11 +423,23 @@ async def voice_message_handler(message: Message, state: FSMContext):
                     await message.answer(chunk)
                     await asyncio.sleep(0.5)
             # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
+            # Разбор сохраняется, чтобы его можно было перечитать в «Истории» без нового запроса к Gemini.
+            # Сохраняем после отправки: за разбор уже списано задание, и ошибка базы не должна его потерять
+            try:
+                await storage.get().save_review(
+                    message.from_user.id, user_data.get('current_task_id'), user_data.get('current_task_type'), review
+                )
+            except Exception as e:
+                logger.exception("Не удалось сохранить разбор пользователя %s в историю: %s", message.from_user.id, e)
         await send_main_menu(message, message.from_user.id)
     finally:
-        await state.clear()
-        if os.path.exists(voice_ogg_path):
-            os.remove(voice_ogg_path)
+        if not review_done:
+            await storage.get().release_task_reservation(reservation_id)
+        if not keep_task:
+            await state.clear()
+        for path in {voice_ogg_path, audio_path}:
+            if os.path.exists(path):
+                os.remove(path)
 
 @router.message(UserState.waiting_for_voice)
 async def incorrect_message_handler(message: Message):
@@ -388,7 +491,7 @@ async def admin_receive_new_price(message: Message, state: FSMContext):
     tariff = user_data.get('tariff_to_edit')
     prices = load_prices()
     prices[tariff] = new_price
-    save_prices(prices)
+    await save_prices(prices)
     await state.clear()
     await message.answer(f"Цена для тарифа '{tariff}' успешно изменена на {new_price} RUB.", reply_markup=kb.admin_menu_keyboard())
 
@@ -400,20 +503,17 @@ async def admin_management_menu(callback: CallbackQuery):
 
 @router.callback_query(F.data == "admin_view_admins")
 async def view_admins(callback: CallbackQuery):
-    admins_ids = await db.get_admins()
+    admins_ids = await storage.get().get_admins()
     if not admins_ids:
         await callback.message.edit_text("Список администраторов пуст.", reply_markup=kb.back_to_admins_menu_keyboard())
         await callback.answer()
         return
 
+    profiles = await profile_resolver.resolve_profiles(callback.bot, admins_ids)
     text_lines = ["*Список администраторов:*"]
     for admin_id in admins_ids:
-        try:
-            chat = await callback.bot.get_chat(admin_id)
-            display_name = escape_markdown(chat.full_name or chat.username or f"User {admin_id}")
-            line = f"• [{display_name}](tg://user?id={admin_id}) \\(`{admin_id}`\\)"
-        except Exception:
-            line = f"• [User {admin_id}](tg://user?id={admin_id}) \\(ID не найден\\)"
+        display_name = escape_markdown(profiles[admin_id][0])
+        line = f"• [{display_name}](tg://user?id={admin_id}) \\(`{admin_id}`\\)"
         if admin_id == SUPER_ADMIN_ID:
             line += " \\(⭐ Супер\\-админ\\)"
         text_lines.append(line)
@@ -425,7 +525,7 @@ async def view_admins(callback: CallbackQuery):
             reply_markup=kb.back_to_admins_menu_keyboard()
         )
     except TelegramBadRequest as e:
-        print(f"Ошибка при отображении списка админов: {e}")
+        logger.warning("Ошибка при отображении списка админов: %s", e)
         simple_text = "Список администраторов:\n" + "\n".join([f"ID: {admin_id}" for admin_id in admins_ids])
         await callback.message.edit_text(simple_text, reply_markup=kb.back_to_admins_menu_keyboard())
 
@@ -442,7 +542,7 @@ async def add_admin_start(callback: CallbackQuery, state: FSMContext):
 async def add_admin_finish(message: Message, state: FSMContext):
     user_id = await get_user_id_from_input(message)
     if user_id:
-        await db.add_admin(user_id)
+        await storage.get().add_admin(user_id)
         await state.clear()
         await message.answer(get_text('admin_add_success', id=user_id), reply_markup=kb.admin_management_keyboard())
 
@@ -462,29 +562,43 @@ async def remove_admin_finish(message: Message, state: FSMContext):
         await message.answer(get_text('admin_remove_super_admin_error'), reply_markup=kb.admin_management_keyboard())
         await state.clear()
         return
-    await db.remove_admin(admin_id)
+    await storage.get().remove_admin(admin_id)
     await state.clear()
     await message.answer(get_text('admin_remove_success', id=admin_id), reply_markup=kb.admin_management_keyboard())
 
 # --- Просмотр подписчиков ---
 @router.callback_query(F.data == "admin_view_subscribed")
 async def view_subscribed_users(callback: CallbackQuery):
-    users = await db.get_subscribed_users()
+    await show_subscribed_users_page(callback, 0)
+
+@router.callback_query(F.data.startswith("admin_subscribed_page_"))
+async def view_subscribed_users_page(callback: CallbackQuery):
+    page = int(callback.data[len("admin_subscribed_page_"):])
+    await show_subscribed_users_page(callback, page)
+
+async def show_subscribed_users_page(callback: CallbackQuery, page: int):
+    total = await storage.get().count_subscribed_users()
+    total_pages = max(1, -(-total // SUBSCRIBED_USERS_PAGE_SIZE))
+    page = min(max(page, 0), total_pages - 1)
+    users = await storage.get().get_subscribed_users(limit=SUBSCRIBED_USERS_PAGE_SIZE, offset=page * SUBSCRIBED_USERS_PAGE_SIZE)
     if not users:
         text = "Нет пользователей с активной подпиской."
     else:
-        text = "*Пользователи с активной подпиской:*\n\n"
-        for user_id, username, end_date_str in users:
-            end_date = datetime.strptime(end_date_str, "%Y-%m-%d %H:%M:%S").strftime("%d.%m.%Y")
-            try:
-                chat = await callback.bot.get_chat(user_id)
-                display_name = escape_markdown(chat.full_name or chat.username or f"User {user_id}")
-            except Exception:
-                display_name = escape_markdown(username or f"User {user_id}")
+        profiles = await profile_resolver.resolve_profiles(callback.bot, [user[0] for user in users])
+        text = f"*Пользователи с активной подпиской* \\({total}\\):\n\n"
+        for user_id, username, end_date_ts in users:
+            end_date = datetime.fromtimestamp(end_date_ts).strftime("%d.%m.%Y")
+            display_name = escape_markdown(profiles[user_id][0])
             safe_end_date = escape_markdown(end_date)
             text += f"• [{display_name}](tg://user?id={user_id}) \\(`{user_id}`\\)\n"
             text += f"  *Подписка до:* {safe_end_date}\n\n"
-    await callback.message.edit_text(text, parse_mode='MarkdownV2', reply_markup=kb.back_to_admin_menu_keyboard())
+    # Повторное нажатие на текущую страницу не меняет сообщение — Telegram отвечает ошибкой
+    with contextlib.suppress(TelegramBadRequest):
+        await callback.message.edit_text(
+            text,
+            parse_mode='MarkdownV2',
+            reply_markup=kb.subscribed_users_keyboard(page, total_pages)
+        )
     await callback.answer()
 
 # --- УПРАВЛЕНИЕ ПОЛЬЗОВАТЕЛЯМИ ВРУЧНУЮ ---
@@ -496,7 +610,7 @@ async def get_user_id_from_input(message: Message) -> int | None:
         return int(user_input)
     elif user_input.startswith('@'):
         username = user_input[1:]
-        user_data = await db.get_user_by_username(username)
+        user_data = await storage.get().get_user_by_username(username)
         if user_data:
             return user_data[0]
         else:
@@ -538,7 +652,7 @@ async def give_subscription_get_days(message: Message, state: FSMContext):
     user_data = await state.get_data()
     user_id = user_data.get('target_user_id')
     
-    await db.set_subscription(user_id, days)
+    await storage.get().set_subscription(user_id, days)
     await state.clear()
     await message.answer(
         get_text('admin_subscription_success', days=days, user_id=user_id),
@@ -569,7 +683,7 @@ async def add_tasks_get_count(message: Message, state: FSMContext):
     user_data = await state.get_data()
     user_id = user_data.get('target_user_id')
     
-    await db.add_tasks(user_id, count)
+    await storage.get().add_tasks(user_id, count)
     await state.clear()
     await message.answer(
         get_text('admin_tasks_success', count=count, user_id=user_id),
@@ -579,6 +693,7 @@ async def add_tasks_get_count(message: Message, state: FSMContext):
 # --- РЕДАКТОР ПРОМПТОВ ---
 @router.callback_query(F.data == "admin_edit_prompts")
 async def edit_prompts_start(callback: CallbackQuery, state: FSMContext):
+    await tm.ensure_loaded_async()
     task_types = tm.get_task_types()
     await state.set_state(AdminState.editing_prompt_selection)
     await callback.message.edit_text(
@@ -591,6 +706,7 @@ async def edit_prompts_start(callback: CallbackQuery, state: FSMContext):
 async def edit_prompt_select_type(callback: CallbackQuery, state: FSMContext):
     task_type = callback.data[len("edit_prompt_"):]
     
+    await tm.ensure_loaded_async()
     current_prompt = tm.tasks_data.get(task_type, {}).get('prompt', 'Промпт не найден.')
     
     await state.update_data(prompt_task_type=task_type)
@@ -613,6 +729,7 @@ async def edit_prompt_receive_text(message: Message, state: FSMContext):
     user_data = await state.get_data()
     task_type = user_data.get('prompt_task_type')
     
+    await tm.ensure_loaded_async()
     if tm.save_prompt(task_type, new_prompt):
         await message.answer(
             get_text('admin_prompt_updated', task_type=task_type),
@@ -626,6 +743,202 @@ async def edit_prompt_receive_text(message: Message, state: FSMContext):
     await state.clear()
 
 
+# --- РАССЫЛКА ---
+BROADCAST_STATUS_NAMES = {"running": "идет", "finished": "завершена", "cancelled": "остановлена"}
+
+async def show_broadcast_status(callback: CallbackQuery, broadcast_id: int):
+    broadcast_data = await db.get_broadcast(broadcast_id)
+    if broadcast_data is None:
+        await callback.answer("Рассылка не найдена.", show_alert=True)
+        return
+    progress = broadcast.get_progress(broadcast_id) or {
+        "sent": broadcast_data["sent"],
+        "failed": broadcast_data["failed"],
+        "blocked": broadcast_data["blocked"],
+        "rate": 0,
+    }
+    text = get_text(
+        'admin_broadcast_status',
+        broadcast_id=broadcast_id,
+        status=BROADCAST_STATUS_NAMES.get(broadcast_data["status"], broadcast_data["status"]),
+        sent=progress["sent"],
+        failed=progress["failed"],
+        blocked=progress["blocked"],
+        rate=progress["rate"],
+    )
+    with contextlib.suppress(TelegramBadRequest):
+        await callback.message.edit_text(
+            text,
+            reply_markup=kb.broadcast_status_keyboard(broadcast_id, broadcast.is_running(broadcast_id))
+        )
+    await callback.answer()
+
+@router.callback_query(F.data == "admin_broadcast")
+async def broadcast_start(callback: CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+    # Одновременно идет не больше одной рассылки: если она есть, показываем ее ход
+    for broadcast_id in await db.get_unfinished_broadcasts():
+        if broadcast.is_running(broadcast_id):
+            await show_broadcast_status(callback, broadcast_id)
+            return
+    await state.set_state(AdminState.waiting_for_broadcast_message)
+    await callback.message.edit_text(get_text('admin_broadcast_prompt'), reply_markup=kb.back_to_admin_menu_keyboard())
+    await callback.answer()
+
+@router.message(AdminState.waiting_for_broadcast_message)
+async def broadcast_receive_message(message: Message, state: FSMContext):
+    await state.update_data(broadcast_chat_id=message.chat.id, broadcast_message_id=message.message_id)
+    await message.answer(get_text('admin_broadcast_confirm'), reply_markup=kb.broadcast_confirm_keyboard())
+
+@router.callback_query(F.data == "admin_broadcast_confirm", AdminState.waiting_for_broadcast_message)
+async def broadcast_confirm(callback: CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+    user_data = await state.get_data()
+    await state.clear()
+    broadcast_id = await db.create_broadcast(
+        user_data['broadcast_chat_id'],
+        user_data['broadcast_message_id'],
+        callback.from_user.id
+    )
+    broadcast.start_broadcast(callback.bot, broadcast_id, report_chat_id=callback.from_user.id)
+    await show_broadcast_status(callback, broadcast_id)
+
+@router.callback_query(F.data.startswith("admin_broadcast_status_"))
+async def broadcast_status(callback: CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+    await show_broadcast_status(callback, int(callback.data[len("admin_broadcast_status_"):]))
+
+@router.callback_query(F.data.startswith("admin_broadcast_cancel_"))
+async def broadcast_cancel(callback: CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+    broadcast_id = int(callback.data[len("admin_broadcast_cancel_"):])
+    await broadcast.cancel_broadcast(broadcast_id)
+    await show_broadcast_status(callback, broadcast_id)
+
+
+# --- ПРОФИЛИРОВАНИЕ ---
+async def show_profiler_status(callback: CallbackQuery):
+    summary = profiler.get_summary()
+    text = get_text(
+        'admin_profiler_status',
+        state="включено" if summary["enabled"] else "выключено",
+        duration=summary["duration"],
+        samples=summary["samples"],
+        slow_updates=summary["slow_updates"],
+        blocking_events=summary["blocking_events"],
+    )
+    with contextlib.suppress(TelegramBadRequest):
+        await callback.message.edit_text(text, reply_markup=kb.profiler_keyboard(summary["enabled"]))
+    await callback.answer()
+
+@router.callback_query(F.data == "admin_profiler")
+async def profiler_menu(callback: CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+    await show_profiler_status(callback)
+
+@router.callback_query(F.data == "admin_profiler_toggle")
+async def profiler_toggle(callback: CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+    if profiler.is_enabled():
+        profiler.stop()
+    else:
+        profiler.start()
+    await show_profiler_status(callback)
+
+@router.callback_query(F.data == "admin_profiler_report")
+async def profiler_report(callback: CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+    report = profiler.build_report()
+    filename = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+    await callback.message.answer_document(BufferedInputFile(report.encode("utf-8"), filename=filename))
+    await callback.answer()
+
+
+# --- СТАТИСТИКА ---
+STATS_PERIOD_TITLES = (("24h", "За 24 часа"), ("today", "Сегодня"), ("7d", "За 7 дней"), ("30d", "За 30 дней"))
+
+def format_stats(summary: dict) -> str:
+    lines = [get_text('admin_stats_header', time=datetime.now().strftime('%d.%m.%Y %H:%M')), ""]
+    for period, title in STATS_PERIOD_TITLES:
+        counters = summary.get(period, {})
+        lines.append(get_text(
+            'admin_stats_period',
+            title=title,
+            new_users=sum(counters.get("new_users", {}).values()),
+            reviews=sum(counters.get("reviews", {}).values()),
+            payments=sum(counters.get("payments", {}).values()),
+            revenue=sum(counters.get("revenue", {}).values()),
+        ))
+    month = summary.get("30d", {})
+    if month.get("reviews"):
+        lines += ["", get_text('admin_stats_reviews')]
+        lines += [f"• {task_type or 'без типа'}: {count}" for task_type, count in sorted(month["reviews"].items())]
+    if month.get("payments"):
+        lines += ["", get_text('admin_stats_revenue')]
+        lines += [
+            f"• {tariff or 'без тарифа'}: {count} на {month.get('revenue', {}).get(tariff, 0)} ₽"
+            for tariff, count in sorted(month["payments"].items())
+        ]
+    return "\n".join(lines)
+
+@router.callback_query(F.data == "admin_stats")
+async def show_stats(callback: CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+    text = format_stats(await storage.get().get_stats_summary())
+    with contextlib.suppress(TelegramBadRequest):
+        await callback.message.edit_text(text, reply_markup=kb.stats_keyboard())
+    await callback.answer()
+
+
+# --- ВЫГРУЗКА ---
+@router.callback_query(F.data == "admin_export")
+async def admin_export(callback: CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Недостаточно прав.", show_alert=True)
+        return
+    if export.is_running():
+        await callback.answer(get_text('admin_export_busy'), show_alert=True)
+        return
+    await callback.answer()
+    status = await callback.message.answer(get_text('admin_export_started'))
+    try:
+        result = await export.build_export()
+    except Exception as e:
+        logger.exception("ОШИБКА выгрузки: %s", e)
+        await status.edit_text(get_text('admin_export_failed'))
+        return
+    if result is None:
+        await status.edit_text(get_text('admin_export_busy'))
+        return
+    path, counts = result
+    size = os.path.getsize(path)
+    if size > export.MAX_DOCUMENT_BYTES:
+        await status.edit_text(get_text('admin_export_too_large', size_mb=round(size / 2**20, 1), path=path))
+        return
+    try:
+        await callback.message.answer_document(FSInputFile(path), caption=get_text('admin_export_done', **counts))
+        with contextlib.suppress(TelegramBadRequest):
+            await status.delete()
+    finally:
+        os.remove(path)
+
+
 # --- Обработка неизвестных команд ---
 @router.message(F.text)
 async def handle_unknown_text(message: Message):
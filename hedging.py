@@ -0,0 +1,117 @@
+# hedging.py
+
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Optional, TypeVar
+
+from config import GEMINI_HEDGE_BUDGET, GEMINI_HEDGE_PERCENTILE, GEMINI_HEDGING
+from metrics import describe, inc, observe
+
+logger = logging.getLogger(__name__)
+
+# Дублирующий запрос (hedged request): если ответ задерживается дольше обычного, параллельно
+# отправляется второй запрос, и берется тот ответ, что придет первым; второй отменяется.
+# Дубль стоит денег, поэтому доля запросов с дублем ограничена бюджетом.
+ENABLED = GEMINI_HEDGING
+# Дубль запускается, когда запрос идет дольше этого перцентиля недавних задержек
+PERCENTILE = GEMINI_HEDGE_PERCENTILE
+# Какая доля запросов в окне может получить дубль
+BUDGET = GEMINI_HEDGE_BUDGET
+# Пока замеров меньше, перцентиль не считается и дубль запускается после DEFAULT_DELAY
+MIN_SAMPLES = 20
+DEFAULT_DELAY = 30.0
+# Раньше этого времени дублировать бессмысленно: так быстро Gemini почти не отвечает
+MIN_DELAY = 3.0
+# Сколько последних запросов учитывать в перцентиле и бюджете
+WINDOW = 200
+
+LATENCY_METRIC = "egebot_gemini_review_seconds"
+HEDGE_METRIC = "egebot_gemini_hedge_total"
+describe(LATENCY_METRIC, "Время получения ответа Gemini с учетом дублей; mode=primary — без дубля, hedged — с дублем")
+describe(HEDGE_METRIC, "Дублирующие запросы к Gemini: won, lost, failed, over_budget")
+
+T = TypeVar("T")
+
+# Задержки первичных запросов (если первичный отменен, записывается время до отмены)
+_latencies: Deque[float] = deque(maxlen=WINDOW)
+# Был ли дубль у каждого из последних запросов
+_hedged: Deque[bool] = deque(maxlen=WINDOW)
+
+
+def hedge_delay() -> float:
+    """Через сколько секунд после начала запроса запускать дубль."""
+    if len(_latencies) < MIN_SAMPLES:
+        return DEFAULT_DELAY
+    ordered = sorted(_latencies)
+    index = min(len(ordered) - 1, max(0, math.ceil(PERCENTILE / 100 * len(ordered)) - 1))
+    return max(ordered[index], MIN_DELAY)
+
+
+def _within_budget() -> bool:
+    return sum(_hedged) < BUDGET * max(len(_hedged), MIN_SAMPLES)
+
+
+async def _wait_for_delay(first: asyncio.Future, started: float) -> bool:
+    # Порог пересчитывается по ходу ожидания: пока запрос идет, набираются новые замеры
+    while True:
+        remaining = hedge_delay() - (time.monotonic() - started)
+        if remaining <= 0:
+            return False
+        done, _ = await asyncio.wait({first}, timeout=min(remaining, MIN_DELAY))
+        if done:
+            return True
+
+
+async def run(primary: Callable[[], Awaitable[T]], hedge: Callable[[], Awaitable[T]]) -> T:
+    """
+    Выполняет primary(). Если он не завершился за hedge_delay() и бюджет позволяет,
+    параллельно запускает hedge() и возвращает первый успешный результат; проигравший отменяется.
+    Если оба запроса упали, пробрасывается последняя ошибка.
+    """
+    if not ENABLED:
+        return await primary()
+
+    started = time.monotonic()
+    first = asyncio.ensure_future(primary())
+    second: Optional[asyncio.Future] = None
+    try:
+        done = await _wait_for_delay(first, started)
+        if not done and _within_budget():
+            second = asyncio.ensure_future(hedge())
+            _hedged.append(True)
+            return await _first_success(first, second, started)
+
+        if not done:
+            inc(HEDGE_METRIC, result="over_budget")
+        _hedged.append(False)
+        result = await first
+        elapsed = time.monotonic() - started
+        _latencies.append(elapsed)
+        observe(LATENCY_METRIC, elapsed, mode="primary")
+        return result
+    finally:
+        for task in (first, second):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+async def _first_success(first: asyncio.Future, second: asyncio.Future, started: float):
+    logger.info("Ответ Gemini задерживается дольше %.1f сек., запущен дублирующий запрос.", time.monotonic() - started)
+    pending = {first, second}
+    error: Optional[BaseException] = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            error = task.exception()
+            if error is not None:
+                continue
+            elapsed = time.monotonic() - started
+            _latencies.append(elapsed)
+            observe(LATENCY_METRIC, elapsed, mode="hedged")
+            inc(HEDGE_METRIC, result="won" if task is second else "lost")
+            return task.result()
+    inc(HEDGE_METRIC, result="failed")
+    raise error
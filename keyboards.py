@@ -2,11 +2,13 @@
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
 from typing import List
+from price_manager import load_prices, add_price_listener
 
 def main_menu_keyboard():
     """Возвращает клавиатуру главного меню."""
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Получить задание", callback_data="get_task")],
+        [InlineKeyboardButton(text="📚 История", callback_data="history")],
         [InlineKeyboardButton(text="⭐ Оформить подписку", callback_data="show_subscribe_options")],
         [InlineKeyboardButton(text="ℹ️ Информация", callback_data="show_info")]
     ])
@@ -30,14 +32,27 @@ def web_app_keyboard(url: str):
         )]
     ])
 
-def subscribe_menu_keyboard(prices: dict):
+# Клавиатура подписки строится один раз и сбрасывается при изменении цен
+_subscribe_keyboard_cache = None
+
+def _reset_subscribe_keyboard(_version: int):
+    global _subscribe_keyboard_cache
+    _subscribe_keyboard_cache = None
+
+add_price_listener(_reset_subscribe_keyboard)
+
+def subscribe_menu_keyboard():
     """Возвращает клавиатуру для выбора тарифа подписки с актуальными ценами."""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"Неделя - {prices.get('week', 'N/A')} RUB", callback_data="buy_week")],
-        [InlineKeyboardButton(text=f"Месяц - {prices.get('month', 'N/A')} RUB", callback_data="buy_month")],
-        [InlineKeyboardButton(text=f"1 задание - {prices.get('single', 'N/A')} RUB", callback_data="buy_single")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="main_menu")]
-    ])
+    global _subscribe_keyboard_cache
+    if _subscribe_keyboard_cache is None:
+        prices = load_prices()
+        _subscribe_keyboard_cache = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=f"Неделя - {prices.get('week', 'N/A')} RUB", callback_data="buy_week")],
+            [InlineKeyboardButton(text=f"Месяц - {prices.get('month', 'N/A')} RUB", callback_data="buy_month")],
+            [InlineKeyboardButton(text=f"1 задание - {prices.get('single', 'N/A')} RUB", callback_data="buy_single")],
+            [InlineKeyboardButton(text="⬅️ Назад", callback_data="main_menu")]
+        ])
+    return _subscribe_keyboard_cache
     
 def payment_keyboard(payment_link: str, amount: int):
     """Клавиатура для оплаты."""
@@ -62,6 +77,26 @@ def info_menu_keyboard():
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="main_menu")]
     ])
 
+def history_keyboard(review_id: int, part: int, parts: int, older_id, newer_id):
+    """Клавиатура истории разборов: части текущего разбора и переход к соседним разборам."""
+    buttons = []
+    if parts > 1:
+        row = []
+        if part > 0:
+            row.append(InlineKeyboardButton(text="◀️ Часть", callback_data=f"history_{review_id}_{part - 1}"))
+        if part < parts - 1:
+            row.append(InlineKeyboardButton(text="Часть ▶️", callback_data=f"history_{review_id}_{part + 1}"))
+        buttons.append(row)
+    navigation = []
+    if older_id is not None:
+        navigation.append(InlineKeyboardButton(text="⬅️ Раньше", callback_data=f"history_{older_id}_0"))
+    if newer_id is not None:
+        navigation.append(InlineKeyboardButton(text="Позже ➡️", callback_data=f"history_{newer_id}_0"))
+    if navigation:
+        buttons.append(navigation)
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад в главное меню", callback_data="main_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
 def back_to_main_menu_keyboard():
     """Возвращает клавиатуру с одной кнопкой 'Назад' в главное меню."""
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -78,6 +113,10 @@ def admin_menu_keyboard():
         [InlineKeyboardButton(text="👨‍💻 Управление пользователями", callback_data="admin_manage_users")],
         # НОВАЯ КНОПКА
         [InlineKeyboardButton(text="✍️ Редактор промптов", callback_data="admin_edit_prompts")],
+        [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
+        [InlineKeyboardButton(text="🩺 Профилирование", callback_data="admin_profiler")],
+        [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
+        [InlineKeyboardButton(text="📤 Выгрузка CSV", callback_data="admin_export")],
         [InlineKeyboardButton(text="⬅️ Выйти из админ-панели", callback_data="main_menu")]
     ])
 
@@ -105,6 +144,19 @@ def back_to_admin_menu_keyboard():
         [InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data="admin_menu")]
     ])
 
+def subscribed_users_keyboard(page: int, total_pages: int):
+    """Клавиатура постраничного просмотра пользователей с подпиской."""
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(text="◀️", callback_data=f"admin_subscribed_page_{page - 1}"))
+    if total_pages > 1:
+        navigation.append(InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data=f"admin_subscribed_page_{page}"))
+    if page < total_pages - 1:
+        navigation.append(InlineKeyboardButton(text="▶️", callback_data=f"admin_subscribed_page_{page + 1}"))
+    buttons = [navigation] if navigation else []
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data="admin_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
 def edit_prices_keyboard():
     """Возвращает клавиатуру для выбора тарифа для изменения цены."""
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -127,4 +179,36 @@ def back_to_admins_menu_keyboard():
     """Клавиатура для возврата в меню управления администраторами."""
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_manage_admins")]
-    ])
\ No newline at end of file
+    ])
+
+def broadcast_confirm_keyboard():
+    """Клавиатура подтверждения рассылки."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Начать рассылку", callback_data="admin_broadcast_confirm")],
+        [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_menu")]
+    ])
+
+def broadcast_status_keyboard(broadcast_id: int, is_running: bool):
+    """Клавиатура просмотра хода рассылки."""
+    buttons = []
+    if is_running:
+        buttons.append([InlineKeyboardButton(text="🔄 Обновить", callback_data=f"admin_broadcast_status_{broadcast_id}")])
+        buttons.append([InlineKeyboardButton(text="⛔ Остановить", callback_data=f"admin_broadcast_cancel_{broadcast_id}")])
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data="admin_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def profiler_keyboard(is_enabled: bool):
+    """Клавиатура управления профилированием."""
+    toggle_text = "⏸ Выключить" if is_enabled else "▶️ Включить"
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=toggle_text, callback_data="admin_profiler_toggle")],
+        [InlineKeyboardButton(text="📥 Скачать отчет", callback_data="admin_profiler_report")],
+        [InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data="admin_menu")]
+    ])
+
+def stats_keyboard():
+    """Клавиатура экрана статистики."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_stats")],
+        [InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data="admin_menu")]
+    ])
@@ -0,0 +1,136 @@
+# log_manager.py
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+import time
+from typing import Iterable, Optional
+
+# ID текущего апдейта: попадает в каждую строку лога, пока апдейт обрабатывается
+request_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+# Значения параметров, которые нельзя выводить в лог как есть
+_SECRET_PARAMS = re.compile(r"(?i)\b(signature(?:value)?|password\d?|api_?key|token)(\s*[=:]\s*)([^\s&,;]+)")
+# Строка для подписи Robokassa имеет вид login:сумма:id:пароль
+_ROBOKASSA_SIGNATURE_STRING = re.compile(r"(СТРОКА ДЛЯ ПОДПИСИ:\s*)\S+")
+# MD5-подписи и похожие шестнадцатеричные хэши
+_HEX_DIGEST = re.compile(r"\b[0-9a-fA-F]{32}\b")
+# Токен бота: 123456:ABC...
+_BOT_TOKEN = re.compile(r"\b\d{6,}:[A-Za-z0-9_-]{30,}\b")
+
+
+class RedactingFilter(logging.Filter):
+    """Вырезает из сообщений пароли, ключи, токены и подписи."""
+
+    def __init__(self, secrets: Iterable[str] = ()):
+        super().__init__()
+        self.secrets = sorted({s for s in secrets if s and len(s) >= 4}, key=len, reverse=True)
+
+    def redact(self, text: str) -> str:
+        for secret in self.secrets:
+            text = text.replace(secret, "***")
+        text = _SECRET_PARAMS.sub(r"\1\2***", text)
+        text = _ROBOKASSA_SIGNATURE_STRING.sub(r"\1***", text)
+        text = _HEX_DIGEST.sub("***", text)
+        text = _BOT_TOKEN.sub("***", text)
+        return text
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.getMessage()
+        redacted = self.redact(message)
+        if redacted != message:
+            record.msg, record.args = redacted, None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает только часть "шумных" строк. Строка считается шумной, если при вызове
+    передан extra={"sample_rate": 0.1} — тогда в лог попадет примерно каждая десятая.
+    Ошибки не прореживаются никогда.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        sample_rate = getattr(record, "sample_rate", None)
+        if sample_rate is None or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < sample_rate
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет в запись ID текущего апдейта."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s [req=%(request_id)s] %(message)s"
+
+
+def setup_logging(level: str = "INFO", fmt: str = "text", secrets: Iterable[str] = ()):
+    """
+    Настраивает логирование: обработчики в коде только кладут запись в очередь,
+    а запись в stdout делает отдельный поток. Медленный stdout (pipe, journald)
+    больше не блокирует цикл событий бота.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Фильтры выполняются в потоке бота до постановки в очередь, пока доступен контекст апдейта
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(SamplingFilter())
+    queue_handler.addFilter(RedactingFilter(secrets))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level.upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """Дописывает оставшиеся записи и останавливает фоновый поток."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class CorrelationIdMiddleware:
+    """Внешний middleware для dp.update: помечает все строки лога ID апдейта."""
+
+    async def __call__(self, handler, event, data):
+        token = request_id_var.set(str(getattr(event, "update_id", "-")))
+        try:
+            return await handler(event, data)
+        finally:
+            request_id_var.reset(token)
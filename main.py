@@ -2,43 +2,128 @@
 
 import asyncio
 import logging
+import time
+from typing import Optional
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
 
-from config import TELEGRAM_TOKEN
+from config import TELEGRAM_TOKEN, METRICS_HOST, METRICS_PORT, LOG_LEVEL, LOG_FORMAT, LOG_SECRETS
+from log_manager import setup_logging, stop_logging, CorrelationIdMiddleware
+
+# Логирование настраиваем до импорта остальных модулей: они пишут в лог уже при загрузке
+setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_SECRETS)
+
 from handlers import router
-# ИЗМЕНЕНО: Импортируем db_start и функцию очистки отдельно
-from database import db_start, cleanup_old_pending_payments
+from metrics import HandlerMetricsMiddleware, TelegramRequestMetrics, start_metrics_server
+from profiler import SlowUpdateMiddleware
+from throttling import ThrottlingMiddleware
+import storage
+import ai_processing
+import audio_processing
+import task_manager
+from broadcast import resume_broadcasts
+from expiry_notifier import scheduled_expiry_notifications
+
+logger = logging.getLogger(__name__)
+
+# Как часто запускать очистку просроченных счетов (секунды).
+# Очистка идет небольшими пачками, поэтому запускать ее можно часто.
+CLEANUP_INTERVAL = 5 * 60
+
+_dispatcher: Optional[Dispatcher] = None
 
 # НОВАЯ ФУНКЦИЯ: Планировщик для периодической очистки
 async def scheduled_cleanup(wait_for_seconds: int):
     """Запускает функцию очистки каждые N секунд."""
     while True:
         await asyncio.sleep(wait_for_seconds)
-        await cleanup_old_pending_payments()
-        print(f"Выполнена плановая очистка старых счетов.")
+        try:
+            await storage.get().cleanup_old_pending_payments()
+        except Exception as e:
+            logger.exception("Ошибка плановой очистки старых счетов: %s", e)
 
 
-async def main():
-    logging.basicConfig(level=logging.INFO)
-    
+async def warm_up_dependencies():
+    """
+    Загружает в фоне то, что не нужно для первого ответа: SDK Gemini, pandas/openpyxl,
+    файл заданий и процессы проверки голосовых. Бот в это время уже принимает апдейты.
+    """
+    started = time.perf_counter()
+    try:
+        await task_manager.ensure_loaded_async()
+        await asyncio.to_thread(ai_processing.warm_up)
+        await audio_processing.warm_up()
+    except Exception as e:
+        logger.exception("Ошибка фоновой загрузки зависимостей: %s", e)
+        return
+    logger.info("Фоновая загрузка зависимостей завершена за %.1f сек.", time.perf_counter() - started)
+
+
+def create_dispatcher(bot: Bot) -> Dispatcher:
+    """
+    Возвращает диспетчер с роутером и всеми middleware. Используется также в benchmark.py.
+    Роутер из handlers.py можно подключить только к одному диспетчеру, поэтому диспетчер
+    собирается один раз на процесс; повторный вызов только подключает замеры к новому боту.
+    """
+    global _dispatcher
+    # Замеряем каждый запрос к Telegram (middleware сессии у каждого бота свои)
+    if not any(isinstance(middleware, TelegramRequestMetrics) for middleware in bot.session.middleware):
+        bot.session.middleware(TelegramRequestMetrics())
+    if _dispatcher is not None:
+        return _dispatcher
+
     # Создаем Dispatcher, передавая ему хранилище для состояний
     dp = Dispatcher(storage=MemoryStorage())
-    
-    bot = Bot(token=TELEGRAM_TOKEN)
-    
+    # Каждая строка лога, написанная во время обработки апдейта, получает его ID
+    dp.update.outer_middleware(CorrelationIdMiddleware())
+    # Флуд отсекается до фильтров и хендлеров; корзины общие для сообщений и кнопок
+    throttling = ThrottlingMiddleware()
+    dp.message.outer_middleware(throttling)
+    dp.callback_query.outer_middleware(throttling)
+
+    # Замеряем каждый хендлер
+    router.message.middleware(HandlerMetricsMiddleware())
+    router.callback_query.middleware(HandlerMetricsMiddleware())
+    # Медленные апдейты записываются, только когда профилирование включено в админ-панели
+    router.message.middleware(SlowUpdateMiddleware())
+    router.callback_query.middleware(SlowUpdateMiddleware())
+
     dp.include_router(router)
-    # Сначала инициализируем БД
-    await db_start()
+    _dispatcher = dp
+    return dp
+
+
+async def main():
+    bot = Bot(token=TELEGRAM_TOKEN)
+    dp = create_dispatcher(bot)
+    # Сначала инициализируем хранилище (STORAGE_BACKEND) и локальную БД
+    await storage.get().start()
+
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_HOST, METRICS_PORT)
     
-    # ИЗМЕНЕНО: Запускаем фоновую задачу для очистки каждые 24 часа (86400 секунд)
-    asyncio.create_task(scheduled_cleanup(86400))
+    # Запускаем фоновую задачу для инкрементальной очистки старых счетов
+    asyncio.create_task(scheduled_cleanup(CLEANUP_INTERVAL))
+    # Предупреждаем пользователей о скором окончании подписки
+    asyncio.create_task(scheduled_expiry_notifications(bot))
+    # Продолжаем рассылки, прерванные перезапуском
+    await resume_broadcasts(bot)
     
-    print("Бот готов к запуску!")
-    await dp.start_polling(bot)
+    # Тяжелые библиотеки догружаются параллельно с началом опроса
+    asyncio.create_task(warm_up_dependencies())
+
+    logger.info("Бот готов к запуску!")
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # Дописываем отложенные изменения пользователей и закрываем соединения перед выходом
+        await storage.get().close()
+        audio_processing.shutdown()
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        print("Бот остановлен.")
\ No newline at end of file
+        logger.info("Бот остановлен.")
+    finally:
+        stop_logging()
\ No newline at end of file
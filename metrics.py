@@ -0,0 +1,235 @@
+# metrics.py
+
+import contextvars
+import functools
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import CallbackQuery, TelegramObject
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм в секундах (как у стандартных клиентов Prometheus, плюс длинные вызовы AI)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+HANDLER_METRIC = "egebot_handler_seconds"
+DEPENDENCY_METRIC = "egebot_dependency_seconds"
+
+_HELP = {
+    HANDLER_METRIC: "Время обработки апдейта хендлером",
+    DEPENDENCY_METRIC: "Время вызова внешней зависимости (база, Gemini, Robokassa, Telegram)",
+}
+
+LabelSet = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+
+class DependencyTimings:
+    """
+    Время по зависимостям за один апдейт (для профилировщика медленных апдейтов).
+    Параллельные вызовы одной зависимости (дублирующие запросы к Gemini) считаются
+    один раз: пока идет хотя бы один вызов, время зависимости идет один раз.
+    """
+
+    def __init__(self):
+        self.totals: Dict[str, float] = {}
+        # зависимость -> (сколько вызовов идет, когда начался первый)
+        self._active: Dict[str, Tuple[int, float]] = {}
+
+    def enter(self, dependency: str, now: float):
+        running, since = self._active.get(dependency, (0, now))
+        self._active[dependency] = (running + 1, since)
+
+    def exit(self, dependency: str, now: float):
+        running, since = self._active[dependency]
+        if running > 1:
+            self._active[dependency] = (running - 1, since)
+            return
+        del self._active[dependency]
+        self.totals[dependency] = self.totals.get(dependency, 0.0) + now - since
+
+
+# Если задан, measure() дописывает в него время по зависимостям (профилировщик медленных апдейтов)
+dependency_timings_var: contextvars.ContextVar[Optional[DependencyTimings]] = contextvars.ContextVar(
+    "dependency_timings", default=None
+)
+# Зависимости, замер которых уже идет в этом контексте. Вложенный замер той же зависимости
+# (get_available_tasks -> check_subscription -> is_admin_db) не пишется: его время уже входит во внешний
+_active_dependencies: contextvars.ContextVar[frozenset] = contextvars.ContextVar(
+    "active_dependencies", default=frozenset()
+)
+
+_lock = threading.Lock()
+_histograms: Dict[str, Dict[LabelSet, Histogram]] = {}
+_counters: Dict[str, Dict[LabelSet, float]] = {}
+
+
+def observe(name: str, seconds: float, **labels: str):
+    """Добавляет значение в гистограмму name с указанными метками."""
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(seconds)
+
+
+def inc(name: str, value: float = 1, **labels: str):
+    """Увеличивает счетчик name с указанными метками."""
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+
+def describe(name: str, help_text: str):
+    """Задает описание метрики для страницы /metrics."""
+    _HELP[name] = help_text
+
+
+@contextmanager
+def measure(dependency: str, operation: str):
+    """
+    Замеряет время блока кода как вызов внешней зависимости: with measure("gemini", "generate"): ...
+    Внутри замера той же зависимости ничего не делает, чтобы время не считалось дважды.
+    """
+    active = _active_dependencies.get()
+    if dependency in active:
+        yield
+        return
+    token = _active_dependencies.set(active | {dependency})
+    timings = dependency_timings_var.get()
+    started = time.perf_counter()
+    if timings is not None:
+        timings.enter(dependency, started)
+    try:
+        yield
+    finally:
+        finished = time.perf_counter()
+        _active_dependencies.reset(token)
+        observe(DEPENDENCY_METRIC, finished - started, dependency=dependency, operation=operation)
+        if timings is not None:
+            timings.exit(dependency, finished)
+
+
+def timed(dependency: str, operation: Optional[str] = None):
+    """Декоратор для async-функций: замеряет каждый вызов как обращение к зависимости."""
+    def decorator(func):
+        name = operation or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with measure(dependency, name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# В callback_data бывают ID (страницы, рассылки) — заменяем числа, чтобы не плодить метки
+_NUMBERS = re.compile(r"\d+")
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Замеряет время каждого хендлера. Метки: имя хендлера и callback_data."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        handler_name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        callback_data = ""
+        if isinstance(event, CallbackQuery) and event.data:
+            callback_data = _NUMBERS.sub("#", event.data)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            observe(HANDLER_METRIC, time.perf_counter() - started, handler=handler_name, callback_data=callback_data)
+
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    """Замеряет каждый запрос к Bot API (sendMessage, editMessageText, getFile и т.д.)."""
+
+    async def __call__(self, make_request, bot, method):
+        with measure("telegram", type(method).__name__):
+            return await make_request(bot, method)
+
+
+# --- Экспорт в формате Prometheus ---
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels: LabelSet, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in items) + "}"
+
+
+def render() -> str:
+    """Возвращает все метрики в текстовом формате Prometheus."""
+    lines = []
+    with _lock:
+        for name, series in sorted(_histograms.items()):
+            if name in _HELP:
+                lines.append(f"# HELP {name} {_HELP[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS, histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', str(bound)))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        for name, series in sorted(_counters.items()):
+            if name in _HELP:
+                lines.append(f"# HELP {name} {_HELP[name]}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series.items():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+async def _metrics_view(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Запускает HTTP-сервер с единственной страницей /metrics."""
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_view)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return runner
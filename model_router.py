@@ -0,0 +1,90 @@
+# model_router.py
+
+import json
+import logging
+from typing import Any, Dict, Optional
+
+from config import GEMINI_PRESSURE_THRESHOLD
+from metrics import describe, inc
+
+logger = logging.getLogger(__name__)
+
+ROUTES_FILE = 'model_routes.json'
+DEFAULT_MODEL = 'gemini-2.5-flash'
+LIGHT_MODEL = 'gemini-2.5-flash-lite'
+# Сколько рецензий может быть в работе одновременно, прежде чем переключаться на pressure_model
+PRESSURE_THRESHOLD = GEMINI_PRESSURE_THRESHOLD
+
+# Таблица маршрутов: тип задания (или "default" для остальных) -> правила.
+# Правила "routes" перебираются по порядку, берется первое, у которого max_duration не задан
+# или не меньше длительности голосового (сек.); generation_config передается в GenerativeModel.
+# Под нагрузкой модель заменяется на pressure_model (если он задан).
+# Файл model_routes.json с той же структурой заменяет эту таблицу целиком, например:
+#   {"Task 4": {"routes": [{"max_duration": 60, "model": "gemini-2.5-flash-lite"},
+#                          {"model": "gemini-2.5-flash", "generation_config": {"temperature": 0.2}}],
+#               "pressure_model": "gemini-2.5-flash-lite"},
+#    "default": {"routes": [{"model": "gemini-2.5-flash"}]}}
+DEFAULT_ROUTES: Dict[str, Dict[str, Any]] = {
+    "default": {
+        "routes": [{"model": DEFAULT_MODEL}],
+        "pressure_model": LIGHT_MODEL,
+    },
+}
+
+ROUTE_METRIC = "egebot_gemini_route_total"
+describe(ROUTE_METRIC, "Выбор модели Gemini для рецензии: reason=duration — по таблице, pressure — из-за нагрузки")
+
+_routes: Optional[Dict[str, Dict[str, Any]]] = None
+
+
+def _read_routes_file() -> Dict[str, Dict[str, Any]]:
+    """Читает таблицу маршрутов. Если файла нет или он поврежден, используется таблица по умолчанию."""
+    try:
+        with open(ROUTES_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if isinstance(data, dict) and data:
+            return data
+        logger.error("Файл %s должен содержать непустой объект. Используются маршруты по умолчанию.", ROUTES_FILE)
+    except FileNotFoundError:
+        pass
+    except (json.JSONDecodeError, OSError) as e:
+        logger.error("Не удалось прочитать %s: %s. Используются маршруты по умолчанию.", ROUTES_FILE, e)
+    return DEFAULT_ROUTES
+
+
+def get_routes() -> Dict[str, Dict[str, Any]]:
+    """Таблица маршрутов из памяти (при первом обращении читает файл)."""
+    global _routes
+    if _routes is None:
+        _routes = _read_routes_file()
+    return _routes
+
+
+def choose_route(task_type: Optional[str], duration: Optional[float], in_flight: int) -> Dict[str, Any]:
+    """
+    Выбирает модель и настройки генерации для рецензии по типу задания, длительности
+    голосового и числу рецензий в работе. Возвращает {"model", "generation_config", "reason"}.
+    """
+    routes = get_routes()
+    table = routes.get(task_type) or routes.get("default") or DEFAULT_ROUTES["default"]
+    rules = table.get("routes") or DEFAULT_ROUTES["default"]["routes"]
+    rule = rules[-1]
+    if duration is not None:
+        for candidate in rules:
+            max_duration = candidate.get("max_duration")
+            if max_duration is None or duration <= max_duration:
+                rule = candidate
+                break
+
+    model = rule.get("model") or DEFAULT_MODEL
+    reason = "duration"
+    pressure_model = table.get("pressure_model")
+    if pressure_model and in_flight >= PRESSURE_THRESHOLD:
+        model, reason = pressure_model, "pressure"
+
+    inc(ROUTE_METRIC, model=model, reason=reason)
+    logger.info(
+        "Маршрут Gemini: тип '%s', %s сек., рецензий в работе %s -> %s (%s).",
+        task_type, duration, in_flight, model, reason
+    )
+    return {"model": model, "generation_config": dict(rule.get("generation_config") or {}), "reason": reason}
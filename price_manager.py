@@ -1,7 +1,14 @@
 # price_manager.py
 
+import asyncio
+import contextlib
+import logging
 import json
 import os
+import tempfile
+from typing import Callable, Dict, List
+
+logger = logging.getLogger(__name__)
 
 PRICES_FILE = 'prices.json'
 DEFAULT_PRICES = {
@@ -10,21 +17,92 @@ DEFAULT_PRICES = {
     "single": 50
 }
 
-def load_prices():
-    """Загружает цены из JSON-файла. Если файл не найден, создает его с ценами по умолчанию."""
-    if not os.path.exists(PRICES_FILE):
-        save_prices(DEFAULT_PRICES)
-        return DEFAULT_PRICES
-    
+# Цены хранятся в памяти: файл читается один раз, дальше чтение не требует ввода-вывода.
+_prices: Dict[str, int] = {}
+_version = 0
+_loaded = False
+# Колбэки, которые вызываются после изменения цен (например, сброс кэша клавиатуры подписки)
+_listeners: List[Callable[[int], None]] = []
+# Сохранения идут по очереди: файл и цены в памяти меняются в порядке вызовов save_prices
+_save_lock = asyncio.Lock()
+
+
+def _read_prices_file() -> Dict[str, int]:
+    """Читает цены с диска. Если файл отсутствует или поврежден, создает его с ценами по умолчанию."""
     try:
         with open(PRICES_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        # В случае ошибки или пустого файла, перезаписываем с дефолтными ценами
-        save_prices(DEFAULT_PRICES)
-        return DEFAULT_PRICES
-
-def save_prices(prices_data):
-    """Сохраняет словарь с ценами в JSON-файл."""
-    with open(PRICES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(prices_data, f, indent=4, ensure_ascii=False)
\ No newline at end of file
+            data = json.load(f)
+        if isinstance(data, dict):
+            return data
+    except FileNotFoundError:
+        pass
+    except json.JSONDecodeError:
+        logger.error("Файл %s поврежден. Используются цены по умолчанию.", PRICES_FILE)
+    _write_prices_file(DEFAULT_PRICES)
+    return dict(DEFAULT_PRICES)
+
+
+def _write_prices_file(prices_data: Dict[str, int]):
+    """Атомарно записывает цены: сначала во временный файл, затем переименование поверх старого."""
+    directory = os.path.dirname(os.path.abspath(PRICES_FILE))
+    fd, tmp_path = tempfile.mkstemp(prefix='.prices_', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(prices_data, f, indent=4, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, PRICES_FILE)
+    except Exception:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def _ensure_loaded():
+    global _prices, _loaded
+    if not _loaded:
+        _prices = _read_prices_file()
+        _loaded = True
+
+
+def load_prices() -> Dict[str, int]:
+    """Возвращает копию текущих цен из памяти (при первом обращении читает файл)."""
+    _ensure_loaded()
+    return dict(_prices)
+
+
+def get_price(tariff: str):
+    """Возвращает цену тарифа из памяти или None, если тариф не найден."""
+    _ensure_loaded()
+    return _prices.get(tariff)
+
+
+def get_prices_version() -> int:
+    """Возвращает номер версии цен. Увеличивается при каждом сохранении."""
+    _ensure_loaded()
+    return _version
+
+
+async def save_prices(prices_data: Dict[str, int]):
+    """
+    Сохраняет цены на диск, обновляет их в памяти и оповещает зависимые кэши.
+    Запись с fsync идет в отдельном потоке, чтобы не останавливать цикл событий.
+    """
+    global _prices, _version, _loaded
+    prices_data = dict(prices_data)
+    async with _save_lock:
+        await asyncio.to_thread(_write_prices_file, prices_data)
+        _prices = prices_data
+        _loaded = True
+        _version += 1
+        for listener in list(_listeners):
+            try:
+                listener(_version)
+            except Exception as e:
+                logger.exception("ОШИБКА в обработчике изменения цен: %s", e)
+
+
+def add_price_listener(listener: Callable[[int], None]):
+    """Регистрирует функцию, которая будет вызвана с новой версией цен после их изменения."""
+    if listener not in _listeners:
+        _listeners.append(listener)
@@ -0,0 +1,95 @@
+# profile_resolver.py
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+import storage
+
+# Сколько профилей держать в памяти и сколько секунд считать их актуальными
+CACHE_SIZE = 5000
+CACHE_TTL = 6 * 60 * 60
+# Неудачные запросы кэшируются ненадолго, чтобы не долбить API, но и не хранить заглушку часами
+FAILED_CACHE_TTL = 10 * 60
+# Сколько запросов get_chat может выполняться одновременно (защита от flood-лимитов)
+MAX_CONCURRENT_REQUESTS = 8
+
+# user_id -> (время истечения, отображаемое имя, username)
+_cache: "OrderedDict[int, Tuple[float, str, Optional[str]]]" = OrderedDict()
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return _semaphore
+
+
+def _cache_get(user_id: int) -> Optional[Tuple[str, Optional[str]]]:
+    entry = _cache.get(user_id)
+    if entry is None:
+        return None
+    expires_at, display_name, username = entry
+    if expires_at < time.monotonic():
+        del _cache[user_id]
+        return None
+    _cache.move_to_end(user_id)
+    return display_name, username
+
+
+def _cache_put(user_id: int, display_name: str, username: Optional[str], ttl: int):
+    _cache[user_id] = (time.monotonic() + ttl, display_name, username)
+    _cache.move_to_end(user_id)
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def invalidate(user_id: int):
+    """Удаляет профиль пользователя из кэша."""
+    _cache.pop(user_id, None)
+
+
+async def _fetch_profile(bot, user_id: int) -> Optional[Tuple[str, Optional[str]]]:
+    async with _get_semaphore():
+        try:
+            chat = await bot.get_chat(user_id)
+        except Exception:
+            return None
+    return chat.full_name or chat.username or f"User {user_id}", chat.username
+
+
+async def resolve_profiles(bot, user_ids: Iterable[int]) -> Dict[int, Tuple[str, Optional[str]]]:
+    """
+    Возвращает словарь user_id -> (отображаемое имя, username).
+    Профили берутся из кэша, недостающие запрашиваются у Telegram параллельно
+    (не более MAX_CONCURRENT_REQUESTS одновременно). Если запрос не удался,
+    используется username из таблицы users.
+    """
+    profiles = {}
+    missing = []
+    for user_id in dict.fromkeys(user_ids):
+        cached = _cache_get(user_id)
+        if cached is None:
+            missing.append(user_id)
+        else:
+            profiles[user_id] = cached
+
+    if not missing:
+        return profiles
+
+    fetched = await asyncio.gather(*(_fetch_profile(bot, user_id) for user_id in missing))
+    failed = [user_id for user_id, profile in zip(missing, fetched) if profile is None]
+    known_usernames = await storage.get().get_usernames(failed) if failed else {}
+
+    for user_id, profile in zip(missing, fetched):
+        if profile is not None:
+            _cache_put(user_id, profile[0], profile[1], CACHE_TTL)
+        else:
+            username = known_usernames.get(user_id)
+            profile = (username or f"User {user_id}", username)
+            _cache_put(user_id, profile[0], profile[1], FAILED_CACHE_TTL)
+        profiles[user_id] = profile
+
+    return profiles
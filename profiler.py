@@ -0,0 +1,256 @@
+# profiler.py
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, TelegramObject
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Апдейт медленнее этого порога попадает в отчет (секунды)
+SLOW_UPDATE_THRESHOLD = 1.0
+# Как часто снимать стек потока цикла событий (секунды)
+SAMPLE_INTERVAL = 0.01
+# Задержка цикла событий, после которой считаем, что его заблокировал синхронный вызов
+LOOP_LAG_THRESHOLD = 0.1
+# Как часто цикл событий отмечается, что он жив
+HEARTBEAT_INTERVAL = 0.05
+# Сколько выборок стека держать для привязки к медленным апдейтам (~2 минуты)
+RECENT_SAMPLES = 12000
+MAX_SLOW_UPDATES = 100
+MAX_BLOCKING_EVENTS = 100
+MAX_STACK_DEPTH = 60
+
+LOOP_LAG_METRIC = "egebot_loop_lag_seconds"
+metrics.describe(LOOP_LAG_METRIC, "Задержка цикла событий (измеряется только при включенном профилировании)")
+
+_lock = threading.Lock()
+_stop_event: Optional[threading.Event] = None
+_sampler: Optional[threading.Thread] = None
+_heartbeat_task: Optional[asyncio.Task] = None
+_heartbeat_at = 0.0
+_started_at: Optional[float] = None
+_stopped_at: Optional[float] = None
+
+# Сводка всех выборок: свернутый стек -> число выборок
+_stacks: Counter = Counter()
+# Последние выборки (время, стек) для поиска стека конкретного апдейта
+_recent: deque = deque(maxlen=RECENT_SAMPLES)
+# Стеки, снятые пока цикл событий не отвечал
+_block_stacks: Counter = Counter()
+_slow_updates: deque = deque(maxlen=MAX_SLOW_UPDATES)
+_blocking_events: deque = deque(maxlen=MAX_BLOCKING_EVENTS)
+
+
+def is_enabled() -> bool:
+    return _sampler is not None
+
+
+def _frame_label(frame, leaf: bool) -> str:
+    code = frame.f_code
+    label = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+    return f"{label}:{frame.f_lineno}" if leaf else label
+
+
+def _collapse(frame) -> str:
+    """Превращает стек в строку "корень;...;лист" (формат collapsed для flamegraph)."""
+    labels = []
+    leaf = True
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(_frame_label(frame, leaf))
+        leaf = False
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def _sample_loop(loop_thread_id: int, stop_event: threading.Event):
+    """Поток-сэмплер: снимает стек потока цикла событий и следит за его задержками."""
+    while not stop_event.wait(SAMPLE_INTERVAL):
+        frame = sys._current_frames().get(loop_thread_id)
+        if frame is None:
+            continue
+        stack = _collapse(frame)
+        del frame
+        now = time.monotonic()
+        with _lock:
+            _stacks[stack] += 1
+            _recent.append((now, stack))
+            if now - _heartbeat_at > HEARTBEAT_INTERVAL + LOOP_LAG_THRESHOLD:
+                _block_stacks[stack] += 1
+
+
+async def _heartbeat():
+    """Отмечает, что цикл событий жив, и замеряет, насколько он опаздывает."""
+    global _heartbeat_at
+    while True:
+        before = time.monotonic()
+        with _lock:
+            _heartbeat_at = before
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        lag = max(time.monotonic() - before - HEARTBEAT_INTERVAL, 0.0)
+        metrics.observe(LOOP_LAG_METRIC, lag)
+        if lag < LOOP_LAG_THRESHOLD:
+            continue
+        with _lock:
+            stacks = _block_stacks.most_common(3)
+            _block_stacks.clear()
+        _blocking_events.append({"at": time.time(), "duration": lag, "stacks": stacks})
+        logger.warning(
+            "Цикл событий был заблокирован на %.0f мс: %s",
+            lag * 1000, ";".join(stacks[0][0].split(";")[-3:]) if stacks else "стек не снят"
+        )
+
+
+def start():
+    """Включает профилирование. Вызывается из цикла событий; предыдущие данные сбрасываются."""
+    global _stop_event, _sampler, _heartbeat_task, _heartbeat_at, _started_at, _stopped_at
+    if is_enabled():
+        return
+    with _lock:
+        _stacks.clear()
+        _recent.clear()
+        _block_stacks.clear()
+        _heartbeat_at = time.monotonic()
+    _slow_updates.clear()
+    _blocking_events.clear()
+    _started_at, _stopped_at = time.time(), None
+
+    _heartbeat_task = asyncio.create_task(_heartbeat())
+    _stop_event = threading.Event()
+    _sampler = threading.Thread(
+        target=_sample_loop, args=(threading.get_ident(), _stop_event),
+        name="profiler-sampler", daemon=True
+    )
+    _sampler.start()
+    logger.info("Профилирование включено.")
+
+
+def stop():
+    """Выключает профилирование. Собранные данные остаются доступны для отчета."""
+    global _stop_event, _sampler, _heartbeat_task, _stopped_at
+    if not is_enabled():
+        return
+    _stop_event.set()
+    _sampler.join()
+    _heartbeat_task.cancel()
+    _stop_event = _sampler = _heartbeat_task = None
+    _stopped_at = time.time()
+    logger.info("Профилирование выключено.")
+
+
+def get_summary() -> Dict[str, Any]:
+    """Короткая сводка для админ-панели."""
+    end = _stopped_at or time.time()
+    with _lock:
+        samples = sum(_stacks.values())
+    return {
+        "enabled": is_enabled(),
+        "duration": round(end - _started_at) if _started_at else 0,
+        "samples": samples,
+        "slow_updates": len(_slow_updates),
+        "blocking_events": len(_blocking_events),
+    }
+
+
+def _stacks_in_window(started: float, finished: float, marker: str) -> List:
+    """Самые частые стеки за время апдейта, в которых есть его хендлер."""
+    with _lock:
+        window = [stack for at, stack in _recent if started <= at <= finished and marker in stack]
+    return Counter(window).most_common(3)
+
+
+class SlowUpdateMiddleware(BaseMiddleware):
+    """
+    При включенном профилировании записывает апдейты дольше SLOW_UPDATE_THRESHOLD:
+    хендлер, общее время, время в базе и во внешних вызовах, стеки хендлера.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not is_enabled():
+            return await handler(event, data)
+
+        timings = metrics.DependencyTimings()
+        token = metrics.dependency_timings_var.set(timings)
+        started = time.monotonic()
+        try:
+            return await handler(event, data)
+        finally:
+            finished = time.monotonic()
+            metrics.dependency_timings_var.reset(token)
+            if finished - started >= SLOW_UPDATE_THRESHOLD:
+                self._record(event, data, started, finished, timings.totals)
+
+    @staticmethod
+    def _record(event, data, started: float, finished: float, timings: Dict[str, float]):
+        callback = getattr(data.get("handler"), "callback", None)
+        code = getattr(callback, "__code__", None)
+        handler_name = getattr(callback, "__name__", "unknown")
+        marker = f"{os.path.basename(code.co_filename)}:{code.co_name}" if code else handler_name
+        db_time = timings.get("db", 0.0)
+        external_time = sum(value for dependency, value in timings.items() if dependency != "db")
+        _slow_updates.append({
+            "at": time.time() - (time.monotonic() - started),
+            "handler": handler_name,
+            "callback_data": event.data if isinstance(event, CallbackQuery) else "",
+            "duration": finished - started,
+            "db": db_time,
+            "external": external_time,
+            "timings": dict(timings),
+            "stacks": _stacks_in_window(started, finished, marker),
+        })
+
+
+def _format_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def build_report() -> str:
+    """Текстовый отчет: медленные апдейты, блокировки цикла событий и горячие стеки."""
+    summary = get_summary()
+    with _lock:
+        stacks = _stacks.most_common()
+    lines = [
+        "Отчет профилировщика",
+        f"Сформирован: {_format_time(time.time())}",
+        f"Профилирование: {'включено' if summary['enabled'] else 'выключено'}, "
+        f"длительность {summary['duration']} сек., выборок стека {summary['samples']}",
+        f"Пороги: медленный апдейт {SLOW_UPDATE_THRESHOLD} сек., блокировка цикла {LOOP_LAG_THRESHOLD * 1000:.0f} мс",
+        "",
+        f"=== Медленные апдейты ({len(_slow_updates)}) ===",
+    ]
+    for update in sorted(_slow_updates, key=lambda item: item["duration"], reverse=True):
+        other = max(update["duration"] - update["db"] - update["external"], 0.0)
+        lines.append(
+            f"{_format_time(update['at'])} {update['handler']} {update['callback_data']} — "
+            f"всего {update['duration']:.3f} с, база {update['db']:.3f} с, "
+            f"внешние вызовы {update['external']:.3f} с, прочее {other:.3f} с"
+        )
+        if update["timings"]:
+            lines.append("  " + ", ".join(f"{name}={value:.3f}" for name, value in sorted(update["timings"].items())))
+        for stack, count in update["stacks"]:
+            lines.append(f"  [{count}] {stack}")
+
+    lines += ["", f"=== Блокировки цикла событий ({len(_blocking_events)}) ==="]
+    for blocking in _blocking_events:
+        lines.append(f"{_format_time(blocking['at'])} — {blocking['duration'] * 1000:.0f} мс")
+        for stack, count in blocking["stacks"]:
+            lines.append(f"  [{count}] {stack}")
+
+    lines += ["", "=== Все выборки стека (collapsed: подходит для flamegraph.pl и speedscope) ==="]
+    lines += [f"{stack} {count}" for stack, count in stacks]
+    return "\n".join(lines) + "\n"
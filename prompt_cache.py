@@ -0,0 +1,197 @@
+# prompt_cache.py
+
+import asyncio
+import hashlib
+import logging
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from config import GEMINI_PROMPT_CACHE
+from metrics import describe, inc, measure
+import task_manager
+
+logger = logging.getLogger(__name__)
+
+# Промпт задания = неизменная инструкция для типа задания с полями {task_text} и {user_text}.
+# Инструкция (поля в ней заменены ссылками на запрос) сохраняется в Gemini как кэшированный
+# контекст (CachedContent), и в каждом запросе отправляются только текст задания и аудио.
+# Если кэш недоступен, промпт собирается и отправляется целиком, как раньше.
+ENABLED = GEMINI_PROMPT_CACHE
+
+USER_TEXT_REF = "[АУДИООТВЕТ УЧЕНИКА ПРИКРЕПЛЕН К ЗАПРОСУ]"
+TASK_TEXT_REF = "[ТЕКСТ ЗАДАНИЯ ПРИВЕДЕН В ЗАПРОСЕ]"
+REQUEST_TEMPLATE = "Текст задания:\n{task_text}"
+
+# Сколько живет кэш на стороне Gemini (секунды)
+CACHE_TTL = 60 * 60
+# Кэш пересоздается заранее, чтобы запрос не пришелся на момент его удаления
+REFRESH_MARGIN = 5 * 60
+# Минимальный размер кэшируемого контекста в токенах по моделям (документация Gemini API, context caching);
+# для незнакомой модели берется DEFAULT_MIN_CACHE_TOKENS. Более короткая инструкция отправляется как есть
+MIN_CACHE_TOKENS = {
+    "gemini-2.5-flash": 1024,
+    "gemini-2.5-flash-lite": 1024,
+    "gemini-2.5-pro": 4096,
+}
+DEFAULT_MIN_CACHE_TOKENS = 4096
+# После ошибки создания кэша для этой инструкции не пробуем снова столько секунд
+FAILURE_BACKOFF = 60 * 60
+
+CACHE_METRIC = "egebot_gemini_prompt_cache_total"
+TOKENS_METRIC = "egebot_gemini_prompt_tokens_total"
+describe(CACHE_METRIC, "Обращения к кэшу контекста Gemini: hit, created, skipped, failed, dropped")
+describe(TOKENS_METRIC, "Токены промпта в запросах к Gemini: всего и взятых из кэша")
+
+CacheKey = Tuple[str, str, str]
+
+# (хэш ключа API, модель, хэш инструкции) -> (CachedContent, время истечения по time.monotonic)
+_entries: Dict[CacheKey, Tuple[object, float]] = {}
+_failures: Dict[CacheKey, float] = {}
+# Инструкции, которые по подсчету Gemini короче минимума модели: их не кэшируем, пока не изменится промпт
+_too_short: Set[CacheKey] = set()
+_locks: Dict[CacheKey, asyncio.Lock] = {}
+# Фоновые удаления старых кэшей (ссылки держим, чтобы задачи не собрал сборщик мусора)
+_deletions: Set[asyncio.Task] = set()
+
+
+def static_prompt(template: str) -> str:
+    """Инструкция типа задания без данных конкретного запроса: поля заменены ссылками на запрос."""
+    return template.format(task_text=TASK_TEXT_REF, user_text=USER_TEXT_REF)
+
+
+def request_text(task_text: str) -> str:
+    """Текст, который отправляется вместе с аудио, когда инструкция взята из кэша."""
+    return REQUEST_TEMPLATE.format(task_text=task_text)
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _key(api_key: str, model_name: str, instruction: str) -> CacheKey:
+    return _digest(api_key)[:16], model_name, _digest(instruction)
+
+
+def min_cache_tokens(model_name: str) -> int:
+    """Минимум токенов для кэша модели; версии вида gemini-2.5-flash-001 берут значение базовой модели."""
+    name = model_name.replace("models/", "")
+    matches = [prefix for prefix in MIN_CACHE_TOKENS if name.startswith(prefix)]
+    return MIN_CACHE_TOKENS[max(matches, key=len)] if matches else DEFAULT_MIN_CACHE_TOKENS
+
+
+async def _count_tokens(genai, model_name: str, instruction: str) -> Optional[int]:
+    """Сколько токенов в инструкции по подсчету Gemini; None, если посчитать не удалось."""
+    try:
+        with measure("gemini", "count_tokens"):
+            response = await asyncio.to_thread(genai.GenerativeModel(model_name).count_tokens, instruction)
+        return response.total_tokens
+    except Exception as e:
+        logger.debug("Не удалось посчитать токены инструкции для %s: %s", model_name, e)
+        return None
+
+
+async def get_model(genai, api_key: str, model_name: str, instruction: str, generation_config: Optional[dict] = None):
+    """
+    Возвращает GenerativeModel, к которой уже подключен кэш с инструкцией, или None,
+    если кэш использовать нельзя (выключен, инструкция короче минимума токенов модели, SDK без кэширования,
+    недавняя ошибка).
+    genai должен быть уже настроен на api_key.
+    """
+    min_tokens = min_cache_tokens(model_name)
+    # Токен не короче символа, поэтому заведомо короткая инструкция отсекается без запроса к Gemini
+    if not ENABLED or len(instruction) < min_tokens or getattr(genai, "caching", None) is None:
+        inc(CACHE_METRIC, result="skipped")
+        return None
+    key = _key(api_key, model_name, instruction)
+    if key in _too_short or _failures.get(key, 0.0) > time.monotonic():
+        inc(CACHE_METRIC, result="skipped")
+        return None
+
+    lock = _locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        # Пока ждали блокировку, другой запрос мог выяснить, что инструкция слишком короткая
+        if key in _too_short:
+            inc(CACHE_METRIC, result="skipped")
+            return None
+        entry = _entries.get(key)
+        if entry is not None and entry[1] - REFRESH_MARGIN > time.monotonic():
+            cache = entry[0]
+            inc(CACHE_METRIC, result="hit")
+        else:
+            if entry is None:
+                # Токены считаются один раз на инструкцию; если посчитать не удалось, решит создание кэша
+                tokens = await _count_tokens(genai, model_name, instruction)
+                if tokens is not None and tokens < min_tokens:
+                    logger.info("Инструкция (%s токенов) короче минимума кэша %s для %s, отправляется целиком.",
+                                tokens, min_tokens, model_name)
+                    _too_short.add(key)
+                    inc(CACHE_METRIC, result="skipped")
+                    return None
+            try:
+                with measure("gemini", "cache_create"):
+                    cache = await asyncio.to_thread(
+                        genai.caching.CachedContent.create,
+                        model=f"models/{model_name}",
+                        display_name=f"egebot-{key[2][:12]}",
+                        contents=[instruction],
+                        ttl=timedelta(seconds=CACHE_TTL),
+                    )
+            except Exception as e:
+                logger.warning("Не удалось создать кэш промпта для ключа ...%s: %s", api_key[-4:], e)
+                _failures[key] = time.monotonic() + FAILURE_BACKOFF
+                inc(CACHE_METRIC, result="failed")
+                return None
+            # Старый кэш (если был) не удаляем: на нем могут выполняться запросы, он истечет сам
+            _entries[key] = (cache, time.monotonic() + CACHE_TTL)
+            _failures.pop(key, None)
+            inc(CACHE_METRIC, result="created")
+            logger.info("Создан кэш промпта %s (%s символов).", getattr(cache, "name", "?"), len(instruction))
+    return genai.GenerativeModel.from_cached_content(cached_content=cache, generation_config=generation_config)
+
+
+def drop(api_key: str, model_name: str, instruction: str):
+    """Забывает кэш после ошибки запроса с ним (например, его удалили на стороне Gemini раньше срока)."""
+    if _entries.pop(_key(api_key, model_name, instruction), None) is not None:
+        inc(CACHE_METRIC, result="dropped")
+
+
+def record_usage(response):
+    """Учитывает в метриках, сколько токенов промпта было в запросе и сколько из них взято из кэша."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    inc(TOKENS_METRIC, getattr(usage, "prompt_token_count", 0) or 0, kind="prompt")
+    inc(TOKENS_METRIC, getattr(usage, "cached_content_token_count", 0) or 0, kind="cached")
+
+
+async def _delete(caches: List[object]):
+    for cache in caches:
+        try:
+            await asyncio.to_thread(cache.delete)
+        except Exception as e:
+            # Кэш мог быть создан с другим ключом API или уже истечь; тогда он удалится сам по TTL
+            logger.debug("Не удалось удалить кэш промпта %s: %s", getattr(cache, "name", "?"), e)
+
+
+def _on_prompt_changed(task_type: str, old_prompt: str):
+    """После изменения промпта в админке забывает кэши его старой инструкции и удаляет их в Gemini."""
+    try:
+        old_instruction = static_prompt(str(old_prompt))
+    except (ValueError, IndexError, KeyError):
+        return
+    digest = _digest(old_instruction)
+    _too_short.difference_update({key for key in _too_short if key[2] == digest})
+    stale = [_entries.pop(key)[0] for key in list(_entries) if key[2] == digest]
+    if not stale:
+        return
+    logger.info("Промпт '%s' изменен, кэшей к удалению: %s.", task_type, len(stale))
+    try:
+        task = asyncio.get_running_loop().create_task(_delete(stale))
+    except RuntimeError:
+        return
+    _deletions.add(task)
+    task.add_done_callback(_deletions.discard)
+
+
+task_manager.add_prompt_listener(_on_prompt_changed)
@@ -1,7 +1,12 @@
 # robokassa_api.py
+import asyncio
 import hashlib
+import logging
+import time
 import aiohttp
 import xml.etree.ElementTree as ET
+from typing import Dict
+from metrics import timed
 from config import (
     ROBOKASSA_MERCHANT_LOGIN,
     ROBOKASSA_PASSWORD_1,
@@ -10,18 +15,31 @@ from config import (
     ROBOKASSA_TEST_PASSWORD_2
 )
 
+logger = logging.getLogger(__name__)
+
 # --- ГЛАВНЫЙ ПЕРЕКЛЮЧАТЕЛЬ РЕЖИМА ---
 # 1 = Тестовый режим, 0 = Боевой режим
 IS_TEST = 0
 
+# Адрес метода OpState (benchmark.py подменяет его адресом локальной заглушки)
+OPSTATE_URL = "https://auth.robokassa.ru/Merchant/WebService/Service.asmx/OpState"
+
+# Result Code=3: Robokassa не знает такой счет, то есть пользователь еще не начинал оплату.
+# Это такой же ответ "не оплачено", как State Code, отличный от 100.
+RESULT_INVOICE_NOT_FOUND = "3"
+
+
+class PaymentCheckError(Exception):
+    """Статус счета не удалось узнать: сеть, ошибка HTTP, неожиданный ответ OpState."""
+
 
 def _get_credentials():
     """Возвращает правильные пароли в зависимости от режима."""
     if IS_TEST == 1:
-        print("[ROBOKASSA LOG] Используются ТЕСТОВЫЕ пароли.")
+        logger.debug("Используются ТЕСТОВЫЕ пароли.", extra={"sample_rate": 0.01})
         return ROBOKASSA_TEST_PASSWORD_1, ROBOKASSA_TEST_PASSWORD_2
     else:
-        print("[ROBOKASSA LOG] Используются БОЕВЫЕ пароли.")
+        logger.debug("Используются БОЕВЫЕ пароли.", extra={"sample_rate": 0.01})
         return ROBOKASSA_PASSWORD_1, ROBOKASSA_PASSWORD_2
 
 
@@ -37,10 +55,8 @@ def generate_payment_link(amount: int, invoice_id: int) -> str:
     signature_str = f"{ROBOKASSA_MERCHANT_LOGIN}:{formatted_amount}:{invoice_id}:{password_1}"
     signature_hash = hashlib.md5(signature_str.encode("utf-8")).hexdigest()
 
-    print("\n--- [ROBOKASSA LOG] ГЕНЕРАЦИЯ ССЫЛКИ ---")
-    print(f"СТРОКА ДЛЯ ПОДПИСИ: {signature_str}")
-    print(f"ПОДПИСЬ (MD5): {signature_hash}")
-    print("---------------------------------------------------\n")
+    # Подпись и пароль в лог не попадают: RedactingFilter в log_manager вырезает их и из отладочных строк
+    logger.debug("Сгенерирована ссылка на оплату счета %s (сумма %s).", invoice_id, formatted_amount)
 
     link = (
         f"https://auth.robokassa.ru/Merchant/Index.aspx?"
@@ -54,75 +70,120 @@ def generate_payment_link(amount: int, invoice_id: int) -> str:
     return link
 
 
+# --- ОБЪЕДИНЕНИЕ ПОВТОРНЫХ ПРОВЕРОК ---
+# Пользователи часто нажимают "проверить оплату" несколько раз подряд.
+# Одновременные проверки одного счета используют один запрос OpState,
+# а отрицательный ответ запоминается на NEGATIVE_RESULT_TTL секунд.
+# Запоминается только настоящий ответ "не оплачено"; при PaymentCheckError
+# следующее нажатие снова идет в Robokassa.
+NEGATIVE_RESULT_TTL = 5
+
+_inflight_checks: Dict[int, asyncio.Future] = {}
+_negative_results: Dict[int, float] = {}
+
+
+def _on_check_done(invoice_id: int, task: asyncio.Future):
+    _inflight_checks.pop(invoice_id, None)
+    if task.cancelled() or task.exception() is not None:
+        return
+    now = time.monotonic()
+    if task.result() is False:
+        _negative_results[invoice_id] = now + NEGATIVE_RESULT_TTL
+    # Удаляем устаревшие записи, чтобы словарь не рос бесконечно
+    for expired_id in [key for key, expires_at in _negative_results.items() if expires_at <= now]:
+        del _negative_results[expired_id]
+
+
 async def check_payment(invoice_id: int) -> bool:
     """
     Проверяет статус оплаты через RoboKassa API (OpState).
-    Возвращает True, если платеж прошел успешно (State=100).
+    Возвращает True, если платеж прошел успешно (State=100), и False, если еще не оплачен.
+    Если статус узнать не удалось, бросает PaymentCheckError.
+    Параллельные вызовы для одного счета разделяют один запрос и его результат.
     """
+    expires_at = _negative_results.get(invoice_id)
+    if expires_at is not None and expires_at > time.monotonic():
+        logger.debug("Счет %s недавно проверен: платеж не найден.", invoice_id, extra={"sample_rate": 0.1})
+        return False
+
+    task = _inflight_checks.get(invoice_id)
+    if task is None:
+        task = asyncio.ensure_future(_request_payment_state(invoice_id))
+        _inflight_checks[invoice_id] = task
+        task.add_done_callback(lambda done: _on_check_done(invoice_id, done))
+    # shield: отмена одного ожидающего не должна отменять общий запрос
+    return await asyncio.shield(task)
+
+
+@timed("robokassa", "op_state")
+async def _request_payment_state(invoice_id: int) -> bool:
+    """Выполняет один запрос OpState и разбирает ответ. Сбои превращает в PaymentCheckError."""
     _, password_2 = _get_credentials()
 
     signature_str = f"{ROBOKASSA_MERCHANT_LOGIN}:{invoice_id}:{password_2}"
     signature_hash = hashlib.md5(signature_str.encode("utf-8")).hexdigest()
 
     url = (
-        f"https://auth.robokassa.ru/Merchant/WebService/Service.asmx/OpState?"
+        f"{OPSTATE_URL}?"
         f"MerchantLogin={ROBOKASSA_MERCHANT_LOGIN}&"
         f"InvoiceID={invoice_id}&"
         f"Signature={signature_hash}&"
         f"IsTest={IS_TEST}"
     )
 
-    print("\n--- [ROBOKASSA LOG] ПРОВЕРКА СТАТУСА ---")
-    print(f"СТРОКА ДЛЯ ПОДПИСИ: {signature_str}")
-    print(f"ПОДПИСЬ (MD5): {signature_hash}")
-    print(f"URL ДЛЯ ЗАПРОСА: {url}")
-    print("----------------------------------------------------\n")
+    logger.debug("Проверка статуса счета %s.", invoice_id)
 
-    async with aiohttp.ClientSession() as session:
-        try:
+    try:
+        async with aiohttp.ClientSession() as session:
             async with session.get(url) as response:
                 text_response = (await response.text()).lstrip("\ufeff")
-                print(f"[ROBOKASSA LOG] ПОЛУЧЕН ОТВЕТ (RAW XML):\n{text_response}\n")
-
-                if response.status != 200:
-                    print(f"[ROBOKASSA LOG] Ошибка HTTP: {response.status}")
-                    return False
-
-                # Парсим XML
-                root = ET.fromstring(text_response)
-                namespace = {"ns": "http://merchant.roboxchange.com/WebService/"}
-
-                # --- НАЧАЛО ИСПРАВЛЕНИЯ ---
-                # Ищем вложенные теги <Code> внутри <Result> и <State>
-                result_code_element = root.find("ns:Result/ns:Code", namespace)
-                state_code_element = root.find("ns:State/ns:Code", namespace)
-
-                # Проверка кода результата
-                if result_code_element is None:
-                    print("[ROBOKASSA LOG] Ошибка: Тег <Result/Code> не найден.")
-                    return False
-                if result_code_element.text.strip() != "0":
-                    print(f"[ROBOKASSA LOG] Ошибка: Result Code={result_code_element.text.strip()}")
-                    return False
-
-                # Проверка состояния платежа
-                if state_code_element is None:
-                    # Оставляем проверку на старый формат <StateCode> как запасной вариант
-                    state_code_element = root.find("ns:StateCode", namespace)
-                    if state_code_element is None:
-                        print("[ROBOKASSA LOG] Ошибка: Тег <State/Code> или <StateCode> не найден.")
-                        return False
-
-                print(f"[ROBOKASSA LOG] State Code={state_code_element.text.strip()}")
-
-                if state_code_element.text.strip() == "100":
-                    print("[ROBOKASSA LOG] ✅ Платеж подтвержден (код 100).")
-                    return True
-                else:
-                    print(f"[ROBOKASSA LOG] ❌ Платеж еще не завершен или отклонен (код {state_code_element.text.strip()}).")
-                    return False
-                # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
-
-        except Exception as e:
-            print(f"[ROBOKASSA LOG] КРИТИЧЕСКАЯ ОШИБКА: {e}")
-            return False
\ No newline at end of file
+                status = response.status
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning("Сетевая ошибка при проверке счета %s: %r", invoice_id, e)
+        raise PaymentCheckError(f"network error: {e!r}") from e
+
+    logger.debug("Получен ответ OpState для счета %s:\n%s", invoice_id, text_response)
+
+    if status != 200:
+        logger.warning("Ошибка HTTP при проверке счета %s: %s", invoice_id, status)
+        raise PaymentCheckError(f"HTTP {status}")
+
+    try:
+        root = ET.fromstring(text_response)
+    except ET.ParseError as e:
+        logger.warning("Не удалось разобрать ответ OpState для счета %s: %s", invoice_id, e)
+        raise PaymentCheckError("malformed OpState response") from e
+    namespace = {"ns": "http://merchant.roboxchange.com/WebService/"}
+
+    # Ищем вложенные теги <Code> внутри <Result> и <State>
+    result_code_element = root.find("ns:Result/ns:Code", namespace)
+    state_code_element = root.find("ns:State/ns:Code", namespace)
+
+    # Проверка кода результата
+    if result_code_element is None or result_code_element.text is None:
+        logger.warning("Тег <Result/Code> не найден в ответе для счета %s.", invoice_id)
+        raise PaymentCheckError("no Result/Code in OpState response")
+    result_code = result_code_element.text.strip()
+    if result_code == RESULT_INVOICE_NOT_FOUND:
+        logger.info("❌ Счет %s еще не создан в Robokassa (Result Code=3).", invoice_id)
+        return False
+    if result_code != "0":
+        logger.warning("Счет %s: Result Code=%s", invoice_id, result_code)
+        raise PaymentCheckError(f"Result Code={result_code}")
+
+    # Проверка состояния платежа
+    if state_code_element is None:
+        # Оставляем проверку на старый формат <StateCode> как запасной вариант
+        state_code_element = root.find("ns:StateCode", namespace)
+    if state_code_element is None or state_code_element.text is None:
+        logger.warning("Тег <State/Code> или <StateCode> не найден в ответе для счета %s.", invoice_id)
+        raise PaymentCheckError("no State/Code in OpState response")
+
+    state_code = state_code_element.text.strip()
+    logger.debug("Счет %s: State Code=%s", invoice_id, state_code)
+
+    if state_code == "100":
+        logger.info("✅ Платеж по счету %s подтвержден (код 100).", invoice_id)
+        return True
+    logger.info("❌ Платеж по счету %s еще не завершен или отклонен (код %s).", invoice_id, state_code)
+    return False
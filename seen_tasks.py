@@ -0,0 +1,152 @@
+# seen_tasks.py
+
+import asyncio
+import logging
+import random
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from metrics import describe, inc
+import storage
+import task_manager as tm
+
+logger = logging.getLogger(__name__)
+
+# Выдача заданий без повторов: для каждого пользователя и листа хранится битовый набор полученных
+# заданий (бит i — i-е задание на листе, 1000 заданий = 125 байт). Новое задание выбирается
+# среди непомеченных; когда помечены все, набор обнуляется и круг начинается заново.
+# Набор привязан к отпечатку списка заданий: если tasks.xlsx изменился, биты переносятся
+# на новые номера по ключам заданий (ID или хэш текста), так что решенные задания не вернутся.
+
+# Сколько раз пробовать случайный номер, прежде чем искать непомеченный перебором.
+# Пока помечено не больше 90% листа, перебор нужен реже, чем в 2% выдач
+RANDOM_TRIES = 36
+# Сколько старых списков заданий держать в памяти для переноса наборов
+CATALOG_CACHE_SIZE = 16
+# Сколько раз перечитывать набор, если его успел изменить другой хост
+SAVE_ATTEMPTS = 5
+
+SAMPLING_METRIC = "egebot_task_sampling_total"
+describe(SAMPLING_METRIC, "Выдача заданий без повторов: picked, scanned (перебором), reset (круг пройден), remapped, "
+                          "conflict (набор изменил параллельный запрос)")
+
+# Отпечаток -> ключи заданий: текущие и недавние старые списки
+_catalogs: "OrderedDict[str, List[str]]" = OrderedDict()
+# Отпечатки, уже сохраненные в базе в этом процессе
+_saved_catalogs: Set[str] = set()
+# Выдача одному пользователю по одному листу идет по очереди: два быстрых нажатия не прочитают
+# один и тот же набор. Блокировка исчезает из словаря, когда ее никто не держит
+_locks: "weakref.WeakValueDictionary[Tuple[int, str], asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def to_bits(data: Optional[bytes]) -> int:
+    return int.from_bytes(data or b"", "little")
+
+
+def to_bytes(seen: int, size: int) -> bytes:
+    return seen.to_bytes((size + 7) // 8, "little")
+
+
+def bit_indices(bits: int) -> List[int]:
+    """Номера единичных битов (по одному шагу на бит, а не на каждый номер)."""
+    indices = []
+    while bits:
+        lowest = bits & -bits
+        indices.append(lowest.bit_length() - 1)
+        bits ^= lowest
+    return indices
+
+
+def pick_unseen(seen: int, size: int, rng: random.Random = random) -> Tuple[int, bool]:
+    """
+    Случайный номер задания, которого нет в seen (в seen должен быть хотя бы один ноль среди size бит).
+    Возвращает номер и признак того, что понадобился перебор.
+    """
+    for _ in range(RANDOM_TRIES):
+        index = rng.randrange(size)
+        if not seen >> index & 1:
+            return index, False
+    # Сюда доходят, когда почти все помечено: непомеченных мало, их перебор дешев
+    return rng.choice(bit_indices(~seen & ((1 << size) - 1))), True
+
+
+def remap(seen: int, old_keys: List[str], new_index: Dict[str, int]) -> int:
+    """Переносит биты с номеров старого списка заданий на номера нового; удаленные задания пропадают."""
+    result = 0
+    for index in bit_indices(seen):
+        new = new_index.get(old_keys[index]) if index < len(old_keys) else None
+        if new is not None:
+            result |= 1 << new
+    return result
+
+
+def _remember_catalog(fingerprint: str, keys: List[str]):
+    _catalogs[fingerprint] = keys
+    _catalogs.move_to_end(fingerprint)
+    while len(_catalogs) > CATALOG_CACHE_SIZE:
+        _catalogs.popitem(last=False)
+
+
+async def _old_catalog(fingerprint: str) -> Optional[List[str]]:
+    keys = _catalogs.get(fingerprint)
+    if keys is None:
+        keys = await storage.get().get_task_catalog(fingerprint)
+        if keys is not None:
+            _remember_catalog(fingerprint, keys)
+    return keys
+
+
+async def _current_seen(user_id: int, task_type: str, row: Optional[Tuple[str, bytes]], fingerprint: str,
+                        keys: List[str]) -> int:
+    """Набор полученных заданий в номерах текущего списка; пройденный круг начинается заново."""
+    seen = 0
+    if row is not None:
+        old_fingerprint, data = row
+        seen = to_bits(data)
+        if old_fingerprint != fingerprint:
+            old_keys = await _old_catalog(old_fingerprint)
+            # Если старый список неизвестен, номера битов ничего не значат — круг начинается заново
+            seen = remap(seen, old_keys, {key: index for index, key in enumerate(keys)}) if old_keys else 0
+            inc(SAMPLING_METRIC, result="remapped")
+
+    full = (1 << len(keys)) - 1
+    seen &= full
+    if seen == full:
+        seen = 0
+        inc(SAMPLING_METRIC, result="reset")
+        logger.info("Пользователь %s получил все задания листа '%s', круг начат заново.", user_id, task_type)
+    return seen
+
+
+async def pick_task(user_id: int, task_type: str) -> Tuple[Optional[str], Optional[Dict]]:
+    """Выдает пользователю случайное задание листа, которое он еще не получал в текущем круге."""
+    await tm.ensure_loaded_async()
+    catalog = tm.get_catalog(task_type)
+    if catalog is None:
+        return None, None
+    fingerprint, keys = catalog
+    size = len(keys)
+    if fingerprint not in _saved_catalogs:
+        await storage.get().save_task_catalog(fingerprint, keys)
+        _saved_catalogs.add(fingerprint)
+        _remember_catalog(fingerprint, keys)
+
+    key = (user_id, task_type)
+    lock = _locks.get(key)
+    if lock is None:
+        lock = _locks[key] = asyncio.Lock()
+    async with lock:
+        for _ in range(SAVE_ATTEMPTS):
+            row = await storage.get().get_seen_tasks(user_id, task_type)
+            seen = await _current_seen(user_id, task_type, row, fingerprint, keys)
+            index, scanned = pick_unseen(seen, size)
+            # Набор сохраняется, только если его не изменил другой хост, иначе выбор повторяется
+            if await storage.get().save_seen_tasks(user_id, task_type, fingerprint, to_bytes(seen | 1 << index, size), row):
+                break
+            inc(SAMPLING_METRIC, result="conflict")
+        else:
+            logger.warning("Набор заданий пользователя %s по листу '%s' не удалось сохранить за %s попыток.",
+                           user_id, task_type, SAVE_ATTEMPTS)
+    inc(SAMPLING_METRIC, result="scanned" if scanned else "picked")
+    return tm.get_task_at(task_type, index)
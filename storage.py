@@ -0,0 +1,359 @@
+# storage.py
+
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+
+from config import DATABASE_URL, STORAGE_BACKEND
+import database as db
+
+logger = logging.getLogger(__name__)
+
+# Хранилище пользователей, админов, подписок, заданий (кредитов), счетов, истории разборов
+# и наборов полученных заданий. Хендлеры и фоновые задачи работают с ним через get(), не зная,
+# где лежат данные:
+#   sqlite   — локальный файл users.db (функции database.py), один хост;
+#   postgres — PostgreSQL через пул asyncpg (storage_postgres.py), несколько хостов бота.
+# Ход рассылок в любом случае хранится в локальном users.db (db_start() его создает всегда):
+# рассылка идет и продолжается после перезапуска только на том хосте, где ее запустили.
+BACKEND_SQLITE = "sqlite"
+BACKEND_POSTGRES = "postgres"
+
+# Строка выгрузки: (таблица, заголовок CSV, пачка строк). Пустая таблица дает одну пустую пачку
+ExportBatch = Tuple[str, List[str], List[tuple]]
+
+
+class Storage(ABC):
+    """Интерфейс хранилища. Все методы асинхронные; даты — секунды Unix, как в database.py."""
+
+    name: str
+
+    async def start(self):
+        """Подготавливает хранилище (схема, пул соединений). Вызывается один раз при старте бота."""
+
+    async def close(self):
+        """Дописывает отложенные изменения и закрывает соединения."""
+
+    # --- Пользователи ---
+
+    @abstractmethod
+    async def add_user(self, user_id: int, username: Optional[str]):
+        """Создает пользователя (с бесплатными заданиями) или обновляет его username."""
+
+    @abstractmethod
+    async def get_user_by_username(self, username: str) -> Optional[tuple]:
+        """(user_id, username) или None."""
+
+    @abstractmethod
+    async def get_usernames(self, user_ids: List[int]) -> Dict[int, Optional[str]]:
+        ...
+
+    @abstractmethod
+    async def get_broadcast_recipients(self, after_user_id: int, limit: int) -> List[int]:
+        """Следующая порция получателей рассылки по возрастанию user_id, без заблокировавших бота."""
+
+    @abstractmethod
+    async def mark_users_blocked(self, user_ids: List[int]):
+        ...
+
+    # --- Админы ---
+
+    @abstractmethod
+    async def get_admins(self) -> List[int]:
+        ...
+
+    @abstractmethod
+    async def add_admin(self, user_id: int):
+        ...
+
+    @abstractmethod
+    async def remove_admin(self, user_id: int):
+        """Удаляет админа; супер-админа удалить нельзя."""
+
+    # --- Подписки ---
+
+    @abstractmethod
+    async def set_subscription(self, user_id: int, days: int):
+        ...
+
+    @abstractmethod
+    async def check_subscription(self, user_id: int) -> Tuple[bool, Optional[Union[int, str]]]:
+        """(True, дата окончания) для активной подписки, (True, "admin") для админов, иначе (False, None)."""
+
+    @abstractmethod
+    async def get_subscribed_users(self, limit: Optional[int] = None, offset: int = 0) -> List[tuple]:
+        """[(user_id, username, дата окончания), ...] по возрастанию даты окончания."""
+
+    @abstractmethod
+    async def count_subscribed_users(self) -> int:
+        ...
+
+    @abstractmethod
+    async def get_expiring_subscriptions(self, until: int, limit: int) -> List[tuple]:
+        """[(user_id, дата окончания), ...]: подписка кончится до until, предупреждения еще не было."""
+
+    @abstractmethod
+    async def claim_expiring_subscriptions(self, until: int, limit: int, lease_until: int) -> List[tuple]:
+        """
+        Как get_expiring_subscriptions, но выданные пользователи откладываются до lease_until:
+        хосты, проверяющие одновременно, получают разных пользователей. Если хост упал до
+        mark_expiry_notified, предупреждение отправит другой хост после lease_until.
+        """
+
+    @abstractmethod
+    async def mark_expiry_notified(self, notified: List[tuple], blocked_user_ids: List[int]):
+        ...
+
+    @abstractmethod
+    async def postpone_expiry_notifications(self, user_ids: List[int], retry_at: int):
+        """Не выдавать этих пользователей в get_expiring_subscriptions до retry_at."""
+
+    # --- Задания (кредиты) ---
+
+    @abstractmethod
+    async def get_available_tasks(self, user_id: int) -> dict:
+        """{"is_subscribed", "tasks_left"}; неизвестный пользователь создается."""
+
+    @abstractmethod
+    async def add_tasks(self, user_id: int, count: int):
+        ...
+
+    @abstractmethod
+    async def reserve_task(self, user_id: int) -> Tuple[bool, Optional[int]]:
+        """(разрешено ли, id резерва); баланс не уходит в минус и при параллельных вызовах."""
+
+    @abstractmethod
+    async def commit_task_reservation(self, reservation_id: Optional[int]) -> bool:
+        ...
+
+    @abstractmethod
+    async def release_task_reservation(self, reservation_id: Optional[int]) -> bool:
+        ...
+
+    @abstractmethod
+    async def count_ledger_mismatches(self) -> int:
+        """Сколько пользователей с балансом, который не сходится с суммой журнала (должно быть 0)."""
+
+    # --- Счета ---
+
+    @abstractmethod
+    async def add_pending_payment(self, user_id: int, tariff: str, amount: int) -> int:
+        ...
+
+    @abstractmethod
+    async def get_pending_payment(self, invoice_id: int) -> Optional[tuple]:
+        """(user_id, tariff, amount) или None."""
+
+    @abstractmethod
+    async def remove_pending_payment(self, invoice_id: int):
+        ...
+
+    @abstractmethod
+    async def settle_pending_payment(self, invoice_id: int) -> Optional[tuple]:
+        """Проводит оплату и начисляет тариф ровно один раз; (user_id, tariff, amount) или None."""
+
+    @abstractmethod
+    async def cleanup_old_pending_payments(self) -> int:
+        ...
+
+    # --- История разборов ---
+
+    @abstractmethod
+    async def save_review(self, user_id: int, task_id: Optional[str], task_type: Optional[str], review: str) -> int:
+        """Сохраняет разбор в историю пользователя и возвращает его ID."""
+
+    @abstractmethod
+    async def get_review_page(self, user_id: int, review_id: Optional[int] = None) -> Optional[dict]:
+        """Один разбор из истории и ID соседних, как database.get_review_page."""
+
+    # --- Полученные задания (seen_tasks.py) ---
+
+    @abstractmethod
+    async def get_seen_tasks(self, user_id: int, task_type: str) -> Optional[Tuple[str, bytes]]:
+        """(отпечаток списка заданий, битовый набор полученных заданий) или None."""
+
+    @abstractmethod
+    async def save_seen_tasks(self, user_id: int, task_type: str, fingerprint: str, seen: bytes,
+                              previous: Optional[Tuple[str, bytes]]) -> bool:
+        """Сохраняет набор, только если сохраненный все еще равен previous (None — набора нет); иначе False."""
+
+    @abstractmethod
+    async def get_task_catalog(self, fingerprint: str) -> Optional[List[str]]:
+        ...
+
+    @abstractmethod
+    async def save_task_catalog(self, fingerprint: str, task_keys: List[str]):
+        """Запоминает список заданий листа под его отпечатком (если он еще не сохранен)."""
+
+    # --- Чтение для админки ---
+
+    @abstractmethod
+    async def get_stats_summary(self) -> Dict[str, Dict[str, Dict[str, int]]]:
+        """Сводка для экрана статистики, как database.get_stats_summary."""
+
+    @abstractmethod
+    def export_rows(self) -> AsyncIterator[ExportBatch]:
+        """Таблицы выгрузки (database.EXPORT_TABLES) пачками, из одного снимка данных."""
+
+
+class SQLiteStorage(Storage):
+    """Локальный users.db: методы передаются функциям database.py."""
+
+    name = BACKEND_SQLITE
+
+    async def start(self):
+        await db.db_start()
+
+    async def close(self):
+        await db.flush_user_writes()
+
+    async def add_user(self, user_id, username):
+        await db.add_user(user_id, username)
+
+    async def get_user_by_username(self, username):
+        return await db.get_user_by_username(username)
+
+    async def get_usernames(self, user_ids):
+        return await db.get_usernames(user_ids)
+
+    async def get_broadcast_recipients(self, after_user_id, limit):
+        return await db.get_broadcast_recipients(after_user_id, limit)
+
+    async def mark_users_blocked(self, user_ids):
+        await db.mark_users_blocked(user_ids)
+
+    async def get_admins(self):
+        return await db.get_admins()
+
+    async def add_admin(self, user_id):
+        await db.add_admin(user_id)
+
+    async def remove_admin(self, user_id):
+        await db.remove_admin(user_id)
+
+    async def set_subscription(self, user_id, days):
+        await db.set_subscription(user_id, days)
+
+    async def check_subscription(self, user_id):
+        return await db.check_subscription(user_id)
+
+    async def get_subscribed_users(self, limit=None, offset=0):
+        return await db.get_subscribed_users(limit=limit, offset=offset)
+
+    async def count_subscribed_users(self):
+        return await db.count_subscribed_users()
+
+    async def get_expiring_subscriptions(self, until, limit):
+        return await db.get_expiring_subscriptions(until, limit)
+
+    async def claim_expiring_subscriptions(self, until, limit, lease_until):
+        return await db.claim_expiring_subscriptions(until, limit, lease_until)
+
+    async def mark_expiry_notified(self, notified, blocked_user_ids):
+        await db.mark_expiry_notified(notified, blocked_user_ids)
+
+    async def postpone_expiry_notifications(self, user_ids, retry_at):
+        await db.postpone_expiry_notifications(user_ids, retry_at)
+
+    async def get_available_tasks(self, user_id):
+        return await db.get_available_tasks(user_id)
+
+    async def add_tasks(self, user_id, count):
+        await db.add_tasks(user_id, count)
+
+    async def reserve_task(self, user_id):
+        return await db.reserve_task(user_id)
+
+    async def commit_task_reservation(self, reservation_id):
+        return await db.commit_task_reservation(reservation_id)
+
+    async def release_task_reservation(self, reservation_id):
+        return await db.release_task_reservation(reservation_id)
+
+    async def count_ledger_mismatches(self):
+        return await db.count_ledger_mismatches()
+
+    async def add_pending_payment(self, user_id, tariff, amount):
+        return await db.add_pending_payment(user_id, tariff, amount)
+
+    async def get_pending_payment(self, invoice_id):
+        return await db.get_pending_payment(invoice_id)
+
+    async def remove_pending_payment(self, invoice_id):
+        await db.remove_pending_payment(invoice_id)
+
+    async def settle_pending_payment(self, invoice_id):
+        return await db.settle_pending_payment(invoice_id)
+
+    async def cleanup_old_pending_payments(self):
+        return await db.cleanup_old_pending_payments()
+
+    async def save_review(self, user_id, task_id, task_type, review):
+        return await db.save_review(user_id, task_id, task_type, review)
+
+    async def get_review_page(self, user_id, review_id=None):
+        return await db.get_review_page(user_id, review_id)
+
+    async def get_seen_tasks(self, user_id, task_type):
+        return await db.get_seen_tasks(user_id, task_type)
+
+    async def save_seen_tasks(self, user_id, task_type, fingerprint, seen, previous):
+        return await db.save_seen_tasks(user_id, task_type, fingerprint, seen, previous)
+
+    async def get_task_catalog(self, fingerprint):
+        return await db.get_task_catalog(fingerprint)
+
+    async def save_task_catalog(self, fingerprint, task_keys):
+        await db.save_task_catalog(fingerprint, task_keys)
+
+    async def get_stats_summary(self):
+        return await db.get_stats_summary()
+
+    async def export_rows(self):
+        # Каждая пачка читается в потоке, цикл событий между пачками свободен
+        connection = await asyncio.to_thread(db.open_export_snapshot)
+        try:
+            for name, columns, query in db.EXPORT_TABLES:
+                cursor = await asyncio.to_thread(connection.execute, query)
+                rows = await asyncio.to_thread(cursor.fetchmany, db.EXPORT_FETCH_SIZE)
+                yield name, columns, rows
+                while rows:
+                    rows = await asyncio.to_thread(cursor.fetchmany, db.EXPORT_FETCH_SIZE)
+                    if rows:
+                        yield name, columns, rows
+        finally:
+            await asyncio.to_thread(connection.close)
+
+
+_storage: Optional[Storage] = None
+
+
+def create_storage(backend: Optional[str] = None, dsn: Optional[str] = None) -> Storage:
+    """Создает хранилище по имени бэкенда (по умолчанию — STORAGE_BACKEND из .env)."""
+    backend = (backend or STORAGE_BACKEND or BACKEND_SQLITE).lower()
+    if backend == BACKEND_SQLITE:
+        return SQLiteStorage()
+    if backend == BACKEND_POSTGRES:
+        # asyncpg нужен только этому бэкенду и импортируется вместе с ним
+        from storage_postgres import PostgresStorage
+        dsn = dsn or DATABASE_URL
+        if not dsn:
+            raise ValueError("ОШИБКА: для STORAGE_BACKEND=postgres нужен DATABASE_URL. Проверьте ваш .env файл.")
+        return PostgresStorage(dsn)
+    raise ValueError(f"ОШИБКА: неизвестный STORAGE_BACKEND '{backend}' (ожидается sqlite или postgres).")
+
+
+def get() -> Storage:
+    """Текущее хранилище (создается при первом обращении по настройкам из .env)."""
+    global _storage
+    if _storage is None:
+        _storage = create_storage()
+        logger.info("Хранилище: %s.", _storage.name)
+    return _storage
+
+
+def set_storage(storage: Optional[Storage]):
+    """Подменяет текущее хранилище (используется в benchmark.py)."""
+    global _storage
+    _storage = storage
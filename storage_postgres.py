@@ -0,0 +1,870 @@
+# storage_postgres.py
+
+import argparse
+import asyncio
+import json
+import logging
+import re
+import sqlite3 as sq
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import asyncpg
+
+from config import DATABASE_POOL_SIZE, DATABASE_URL, SUPER_ADMIN_ID
+import database as db
+from metrics import timed
+from storage import BACKEND_POSTGRES, Storage
+
+logger = logging.getLogger(__name__)
+
+# Хранилище в PostgreSQL для нескольких хостов бота. Схема повторяет users.db: даты — секунды Unix
+# (BIGINT), баланс заданий поддерживает триггер журнала credit_ledger, сводки статистики —
+# триггеры users, payments и review_history. Часы и дни сводок считаются в часовом поясе сервера (TimeZone).
+# Данные, накопленные в users.db до перехода, переносятся один раз:
+#   python storage_postgres.py --import-sqlite users.db
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = DATABASE_POOL_SIZE
+COMMAND_TIMEOUT = db.TIMEOUT
+# Схему обновляет только один хост: остальные ждут на этой advisory-блокировке
+MIGRATION_LOCK_ID = 0x65676562
+# При старте возвращаются только давние незавершенные резервы: свежие может завершить другой хост
+STALE_RESERVATION_AGE = 60 * 60
+
+_SCHEMA_NAME = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+_INITIAL_SCHEMA = """
+    CREATE TABLE users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        subscription_end_date BIGINT,
+        tasks_available INTEGER NOT NULL DEFAULT 2,
+        is_blocked BOOLEAN NOT NULL DEFAULT FALSE,
+        expiry_notified_end BIGINT
+    );
+    CREATE INDEX idx_users_username ON users (username);
+    CREATE INDEX idx_users_subscription_end ON users (subscription_end_date);
+
+    CREATE TABLE admins (user_id BIGINT PRIMARY KEY);
+
+    CREATE TABLE pending_payments (
+        invoice_id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id BIGINT,
+        tariff TEXT,
+        amount INTEGER,
+        created_at BIGINT
+    );
+    CREATE INDEX idx_pending_payments_created_at ON pending_payments (created_at);
+
+    CREATE TABLE payments (
+        invoice_id BIGINT PRIMARY KEY,
+        user_id BIGINT,
+        tariff TEXT,
+        amount INTEGER,
+        created_at BIGINT,
+        paid_at BIGINT
+    );
+    CREATE INDEX idx_payments_paid_at ON payments (paid_at);
+
+    CREATE TABLE expired_payments_daily (
+        day TEXT,
+        tariff TEXT,
+        invoices INTEGER NOT NULL DEFAULT 0,
+        amount BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, tariff)
+    );
+
+    CREATE TABLE credit_ledger (
+        entry_id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        kind TEXT NOT NULL,
+        delta INTEGER NOT NULL,
+        reservation_id BIGINT UNIQUE,
+        created_at BIGINT NOT NULL
+    );
+    CREATE INDEX idx_credit_ledger_user ON credit_ledger (user_id, entry_id);
+    CREATE FUNCTION credit_ledger_balance() RETURNS trigger AS $$
+    BEGIN
+        UPDATE users SET tasks_available = tasks_available + NEW.delta WHERE user_id = NEW.user_id;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+    CREATE TRIGGER credit_ledger_balance AFTER INSERT ON credit_ledger
+        FOR EACH ROW EXECUTE FUNCTION credit_ledger_balance();
+
+    CREATE TABLE stats_hourly (
+        hour TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        dimension TEXT NOT NULL,
+        value BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (hour, metric, dimension)
+    );
+    CREATE TABLE stats_daily (
+        day TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        dimension TEXT NOT NULL,
+        value BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, metric, dimension)
+    );
+    CREATE FUNCTION stats_bump(BIGINT, TEXT, TEXT, BIGINT) RETURNS void AS $$
+        INSERT INTO stats_hourly (hour, metric, dimension, value)
+        VALUES (to_char(to_timestamp($1), 'YYYY-MM-DD HH24:00'), $2, $3, $4)
+        ON CONFLICT (hour, metric, dimension) DO UPDATE SET value = stats_hourly.value + EXCLUDED.value;
+        INSERT INTO stats_daily (day, metric, dimension, value)
+        VALUES (to_char(to_timestamp($1), 'YYYY-MM-DD'), $2, $3, $4)
+        ON CONFLICT (day, metric, dimension) DO UPDATE SET value = stats_daily.value + EXCLUDED.value;
+    $$ LANGUAGE sql;
+    CREATE FUNCTION stats_new_users() RETURNS trigger AS $$
+    BEGIN
+        PERFORM stats_bump(extract(epoch FROM now())::BIGINT, 'new_users', '', 1);
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+    CREATE TRIGGER stats_new_users AFTER INSERT ON users FOR EACH ROW EXECUTE FUNCTION stats_new_users();
+    CREATE FUNCTION stats_payments() RETURNS trigger AS $$
+    BEGIN
+        PERFORM stats_bump(NEW.paid_at, 'payments', COALESCE(NEW.tariff, ''), 1);
+        PERFORM stats_bump(NEW.paid_at, 'revenue', COALESCE(NEW.tariff, ''), COALESCE(NEW.amount, 0));
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+    CREATE TRIGGER stats_payments AFTER INSERT ON payments FOR EACH ROW EXECUTE FUNCTION stats_payments();
+"""
+
+# Начальный баланс пользователя — строка 'opening' в журнале (как в database.py): баланс
+# в users.tasks_available уже учтен, поэтому триггер баланса такие строки пропускает
+_LEDGER_OPENING_BALANCES = """
+    CREATE OR REPLACE FUNCTION credit_ledger_balance() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.kind <> 'opening' THEN
+            UPDATE users SET tasks_available = tasks_available + NEW.delta WHERE user_id = NEW.user_id;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+    CREATE FUNCTION credit_ledger_opening() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO credit_ledger (user_id, kind, delta, created_at)
+        VALUES (NEW.user_id, 'opening', NEW.tasks_available, extract(epoch FROM now())::BIGINT);
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+    CREATE TRIGGER credit_ledger_opening AFTER INSERT ON users FOR EACH ROW EXECUTE FUNCTION credit_ledger_opening();
+    INSERT INTO credit_ledger (user_id, kind, delta, created_at)
+    SELECT u.user_id, 'opening', u.tasks_available - COALESCE(l.total, 0), extract(epoch FROM now())::BIGINT
+    FROM users u
+    LEFT JOIN (SELECT user_id, SUM(delta) AS total FROM credit_ledger GROUP BY user_id) l ON l.user_id = u.user_id
+    WHERE u.tasks_available <> COALESCE(l.total, 0);
+"""
+
+# Неудачное предупреждение об окончании подписки откладывается до expiry_retry_at
+_EXPIRY_RETRY = """
+    ALTER TABLE users ADD COLUMN expiry_retry_at BIGINT;
+"""
+
+# История разборов и наборы полученных заданий: раньше они оставались в users.db каждого хоста,
+# и на другом хосте пользователь не видел своих разборов и снова получал решенные задания
+_REVIEWS_AND_SEEN_TASKS = """
+    CREATE TABLE review_history (
+        review_id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        task_id TEXT,
+        task_type TEXT,
+        created_at BIGINT NOT NULL,
+        review BYTEA NOT NULL
+    );
+    CREATE INDEX idx_review_history_user ON review_history (user_id, review_id);
+    CREATE FUNCTION stats_reviews() RETURNS trigger AS $$
+    BEGIN
+        PERFORM stats_bump(NEW.created_at, 'reviews', COALESCE(NEW.task_type, ''), 1);
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+    CREATE TRIGGER stats_reviews AFTER INSERT ON review_history FOR EACH ROW EXECUTE FUNCTION stats_reviews();
+
+    CREATE TABLE seen_tasks (
+        user_id BIGINT NOT NULL,
+        task_type TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        seen BYTEA NOT NULL,
+        PRIMARY KEY (user_id, task_type)
+    );
+    CREATE TABLE task_catalogs (
+        fingerprint TEXT PRIMARY KEY,
+        task_keys TEXT NOT NULL,
+        created_at BIGINT NOT NULL
+    );
+"""
+
+# Новые миграции добавляются только в конец списка; номер последней примененной хранится в egebot_schema
+MIGRATIONS = [_INITIAL_SCHEMA, _LEDGER_OPENING_BALANCES, _EXPIRY_RETRY, _REVIEWS_AND_SEEN_TASKS]
+
+# Периоды экрана статистики, как database.STATS_WINDOWS
+STATS_WINDOWS = (
+    ("24h", "stats_hourly", "hour", "to_char(now() - interval '23 hours', 'YYYY-MM-DD HH24:00')"),
+    ("today", "stats_daily", "day", "to_char(now(), 'YYYY-MM-DD')"),
+    ("7d", "stats_daily", "day", "to_char(now() - interval '6 days', 'YYYY-MM-DD')"),
+    ("30d", "stats_daily", "day", "to_char(now() - interval '29 days', 'YYYY-MM-DD')"),
+)
+
+# Те же файлы и столбцы, что database.EXPORT_TABLES
+_EXPORT_QUERIES = {
+    "users": "SELECT user_id, username, to_char(to_timestamp(subscription_end_date), 'YYYY-MM-DD HH24:MI:SS'), "
+             "tasks_available, is_blocked::INTEGER FROM users ORDER BY user_id",
+    "pending_payments": "SELECT invoice_id, user_id, tariff, amount, "
+                        "to_char(to_timestamp(created_at), 'YYYY-MM-DD HH24:MI:SS') FROM pending_payments ORDER BY invoice_id",
+    "payments": "SELECT invoice_id, user_id, tariff, amount, to_char(to_timestamp(created_at), 'YYYY-MM-DD HH24:MI:SS'), "
+                "to_char(to_timestamp(paid_at), 'YYYY-MM-DD HH24:MI:SS') FROM payments ORDER BY invoice_id",
+}
+
+# Перенос из users.db (import_sqlite): таблица -> (столбцы, запрос к SQLite).
+# Журнал заданий не переносится: начальный баланс каждого пользователя записывает триггер
+# credit_ledger_opening, и сумма журнала сразу сходится с балансом
+_IMPORT_USERS = (
+    "users",
+    ["user_id", "username", "subscription_end_date", "tasks_available", "is_blocked", "expiry_notified_end",
+     "expiry_retry_at"],
+    "SELECT user_id, username, subscription_end_date, COALESCE(tasks_available, 0), COALESCE(is_blocked, 0), "
+    "expiry_notified_end, expiry_retry_at FROM users ORDER BY user_id",
+)
+_IMPORT_TABLES = (
+    ("pending_payments", ["invoice_id", "user_id", "tariff", "amount", "created_at"],
+     "SELECT invoice_id, user_id, tariff, amount, created_at FROM pending_payments ORDER BY invoice_id"),
+    ("payments", ["invoice_id", "user_id", "tariff", "amount", "created_at", "paid_at"],
+     "SELECT invoice_id, user_id, tariff, amount, created_at, paid_at FROM payments ORDER BY invoice_id"),
+    ("expired_payments_daily", ["day", "tariff", "invoices", "amount"],
+     "SELECT day, tariff, invoices, amount FROM expired_payments_daily"),
+)
+
+
+def _read_sqlite(connection: sq.Connection, query: str):
+    """Строки запроса к SQLite пачками по database.EXPORT_FETCH_SIZE."""
+    cursor = connection.execute(query)
+    while True:
+        rows = cursor.fetchmany(db.EXPORT_FETCH_SIZE)
+        if not rows:
+            break
+        yield rows
+
+
+class PostgresStorage(Storage):
+    """Хранилище в PostgreSQL через пул соединений asyncpg."""
+
+    name = BACKEND_POSTGRES
+
+    def __init__(self, dsn: str, schema: Optional[str] = None):
+        if schema is not None and not _SCHEMA_NAME.match(schema):
+            raise ValueError(f"Недопустимое имя схемы: {schema}")
+        self._dsn = dsn
+        # Отдельная схема (search_path) — для прогонов benchmark.py рядом с рабочими данными
+        self._schema = schema
+        self._pool: Optional[asyncpg.Pool] = None
+        # Как в database.py: повторный /start с тем же username не обращается к базе
+        self._known_usernames: "OrderedDict[int, Optional[str]]" = OrderedDict()
+
+    async def start(self):
+        # Ход рассылок остается в users.db того хоста, где рассылку запустили
+        await db.db_start()
+        server_settings = {"search_path": self._schema} if self._schema else None
+        if self._schema:
+            connection = await asyncpg.connect(self._dsn)
+            try:
+                await connection.execute(f"CREATE SCHEMA IF NOT EXISTS {self._schema}")
+            finally:
+                await connection.close()
+        self._pool = await asyncpg.create_pool(
+            self._dsn,
+            min_size=POOL_MIN_SIZE,
+            max_size=POOL_MAX_SIZE,
+            command_timeout=COMMAND_TIMEOUT,
+            server_settings=server_settings,
+        )
+        async with self._pool.acquire() as connection:
+            await self._apply_migrations(connection)
+            await connection.execute(
+                "INSERT INTO admins (user_id) VALUES ($1) ON CONFLICT DO NOTHING", SUPER_ADMIN_ID
+            )
+            released = await connection.fetchval("""
+                WITH released AS (
+                    INSERT INTO credit_ledger (user_id, kind, delta, reservation_id, created_at)
+                    SELECT r.user_id, 'release', 1, r.entry_id, $1
+                    FROM credit_ledger r
+                    WHERE r.kind = 'reserve' AND r.created_at < $2
+                      AND NOT EXISTS (SELECT 1 FROM credit_ledger s WHERE s.reservation_id = r.entry_id)
+                    ON CONFLICT (reservation_id) DO NOTHING
+                    RETURNING 1
+                )
+                SELECT COUNT(*) FROM released
+            """, db.now_ts(), db.now_ts() - STALE_RESERVATION_AGE)
+        if released:
+            logger.info("Возвращено заданий по незавершенным проверкам: %s.", released)
+
+    async def _apply_migrations(self, connection: asyncpg.Connection):
+        async with connection.transaction():
+            await connection.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_ID)
+            await connection.execute("CREATE TABLE IF NOT EXISTS egebot_schema (version INTEGER NOT NULL)")
+            current_version = await connection.fetchval("SELECT version FROM egebot_schema")
+            if current_version is None:
+                current_version = 0
+                await connection.execute("INSERT INTO egebot_schema (version) VALUES (0)")
+            for version, migration in enumerate(MIGRATIONS, start=1):
+                if version <= current_version:
+                    continue
+                await connection.execute(migration)
+                await connection.execute("UPDATE egebot_schema SET version = $1", version)
+                logger.info("Миграция PostgreSQL %s применена.", version)
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    # --- Пользователи ---
+
+    def _remember_username(self, user_id: int, username: Optional[str]):
+        self._known_usernames[user_id] = username
+        self._known_usernames.move_to_end(user_id)
+        while len(self._known_usernames) > db.KNOWN_USERS_CACHE_SIZE:
+            self._known_usernames.popitem(last=False)
+
+    @timed("db")
+    async def add_user(self, user_id, username):
+        if user_id in self._known_usernames:
+            if self._known_usernames[user_id] == username:
+                self._known_usernames.move_to_end(user_id)
+                return
+            await self._pool.execute("UPDATE users SET username = $2 WHERE user_id = $1", user_id, username)
+        else:
+            await self._pool.execute(
+                "INSERT INTO users (user_id, username) VALUES ($1, $2) "
+                "ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username, is_blocked = FALSE "
+                "WHERE users.username IS DISTINCT FROM EXCLUDED.username OR users.is_blocked",
+                user_id, username
+            )
+        self._remember_username(user_id, username)
+
+    @timed("db")
+    async def get_user_by_username(self, username):
+        row = await self._pool.fetchrow("SELECT user_id, username FROM users WHERE username = $1 LIMIT 1", username)
+        return tuple(row) if row else None
+
+    @timed("db")
+    async def get_usernames(self, user_ids):
+        if not user_ids:
+            return {}
+        rows = await self._pool.fetch(
+            "SELECT user_id, username FROM users WHERE user_id = ANY($1::BIGINT[])", list(user_ids)
+        )
+        return {row["user_id"]: row["username"] for row in rows}
+
+    @timed("db")
+    async def get_broadcast_recipients(self, after_user_id, limit):
+        rows = await self._pool.fetch(
+            "SELECT user_id FROM users WHERE user_id > $1 AND NOT is_blocked ORDER BY user_id LIMIT $2",
+            after_user_id, limit
+        )
+        return [row["user_id"] for row in rows]
+
+    @timed("db")
+    async def mark_users_blocked(self, user_ids):
+        if not user_ids:
+            return
+        await self._pool.execute(
+            "UPDATE users SET is_blocked = TRUE WHERE user_id = ANY($1::BIGINT[])", list(user_ids)
+        )
+        for user_id in user_ids:
+            self._known_usernames.pop(user_id, None)
+
+    # --- Админы ---
+
+    @timed("db")
+    async def get_admins(self):
+        rows = await self._pool.fetch("SELECT user_id FROM admins")
+        return [row["user_id"] for row in rows]
+
+    @timed("db")
+    async def add_admin(self, user_id):
+        await self._pool.execute("INSERT INTO admins (user_id) VALUES ($1) ON CONFLICT DO NOTHING", user_id)
+
+    @timed("db")
+    async def remove_admin(self, user_id):
+        if user_id == SUPER_ADMIN_ID:
+            logger.warning("Attempt to remove super admin was blocked.")
+            return
+        await self._pool.execute("DELETE FROM admins WHERE user_id = $1", user_id)
+
+    # --- Подписки ---
+
+    @timed("db")
+    async def set_subscription(self, user_id, days):
+        end_date = db.now_ts() + days * db.SECONDS_IN_DAY
+        await self._pool.execute("UPDATE users SET subscription_end_date = $2 WHERE user_id = $1", user_id, end_date)
+
+    @timed("db")
+    async def check_subscription(self, user_id):
+        row = await self._pool.fetchrow(
+            "SELECT EXISTS (SELECT 1 FROM admins WHERE user_id = $1), "
+            "(SELECT subscription_end_date FROM users WHERE user_id = $1 AND subscription_end_date > $2)",
+            user_id, db.now_ts()
+        )
+        is_admin, end_date = row
+        if is_admin:
+            return True, "admin"
+        if end_date is not None:
+            return True, end_date
+        return False, None
+
+    @timed("db")
+    async def get_subscribed_users(self, limit=None, offset=0):
+        # LIMIT NULL в PostgreSQL означает «без ограничения»
+        rows = await self._pool.fetch(
+            "SELECT user_id, username, subscription_end_date FROM users WHERE subscription_end_date > $1 "
+            "ORDER BY subscription_end_date, user_id LIMIT $2 OFFSET $3",
+            db.now_ts(), limit, offset
+        )
+        return [tuple(row) for row in rows]
+
+    @timed("db")
+    async def count_subscribed_users(self):
+        return await self._pool.fetchval(
+            "SELECT COUNT(*) FROM users WHERE subscription_end_date > $1", db.now_ts()
+        )
+
+    @timed("db")
+    async def get_expiring_subscriptions(self, until, limit):
+        rows = await self._pool.fetch(
+            "SELECT user_id, subscription_end_date FROM users "
+            "WHERE subscription_end_date > $1 AND subscription_end_date <= $2 "
+            "AND expiry_notified_end IS DISTINCT FROM subscription_end_date AND NOT is_blocked "
+            "AND (expiry_retry_at IS NULL OR expiry_retry_at <= $1) "
+            "ORDER BY subscription_end_date LIMIT $3",
+            db.now_ts(), until, limit
+        )
+        return [tuple(row) for row in rows]
+
+    @timed("db")
+    async def claim_expiring_subscriptions(self, until, limit, lease_until):
+        # SKIP LOCKED: хосты, проверяющие одновременно, берут разных пользователей и не ждут друг друга
+        rows = await self._pool.fetch(
+            "UPDATE users SET expiry_retry_at = $4 WHERE user_id IN ("
+            "SELECT user_id FROM users "
+            "WHERE subscription_end_date > $1 AND subscription_end_date <= $2 "
+            "AND expiry_notified_end IS DISTINCT FROM subscription_end_date AND NOT is_blocked "
+            "AND (expiry_retry_at IS NULL OR expiry_retry_at <= $1) "
+            "ORDER BY subscription_end_date LIMIT $3 FOR UPDATE SKIP LOCKED"
+            ") RETURNING user_id, subscription_end_date",
+            db.now_ts(), until, limit, lease_until
+        )
+        return sorted((tuple(row) for row in rows), key=lambda row: row[1])
+
+    @timed("db")
+    async def mark_expiry_notified(self, notified, blocked_user_ids):
+        async with self._pool.acquire() as connection:
+            async with connection.transaction():
+                await connection.executemany(
+                    "UPDATE users SET expiry_notified_end = $2, expiry_retry_at = NULL WHERE user_id = $1",
+                    [(user_id, end_date) for user_id, end_date in notified]
+                )
+                if blocked_user_ids:
+                    await connection.execute(
+                        "UPDATE users SET is_blocked = TRUE WHERE user_id = ANY($1::BIGINT[])", list(blocked_user_ids)
+                    )
+        for user_id in blocked_user_ids:
+            self._known_usernames.pop(user_id, None)
+
+    @timed("db")
+    async def postpone_expiry_notifications(self, user_ids, retry_at):
+        if user_ids:
+            await self._pool.execute(
+                "UPDATE users SET expiry_retry_at = $2 WHERE user_id = ANY($1::BIGINT[])", list(user_ids), retry_at
+            )
+
+    # --- Задания (кредиты) ---
+
+    @timed("db")
+    async def get_available_tasks(self, user_id):
+        row = await self._pool.fetchrow(
+            "SELECT (SELECT tasks_available FROM users WHERE user_id = $1), "
+            "EXISTS (SELECT 1 FROM admins WHERE user_id = $1) "
+            "OR EXISTS (SELECT 1 FROM users WHERE user_id = $1 AND subscription_end_date > $2)",
+            user_id, db.now_ts()
+        )
+        tasks_left, is_subscribed = row
+        if tasks_left is None:
+            # Новый пользователь получает бесплатные задания (DEFAULT столбца tasks_available)
+            tasks_left = await self._pool.fetchval(
+                "WITH created AS (INSERT INTO users (user_id) VALUES ($1) ON CONFLICT DO NOTHING "
+                "RETURNING tasks_available) "
+                "SELECT COALESCE((SELECT tasks_available FROM created), "
+                "(SELECT tasks_available FROM users WHERE user_id = $1))",
+                user_id
+            )
+        return {"is_subscribed": is_subscribed, "tasks_left": tasks_left}
+
+    @timed("db")
+    async def add_tasks(self, user_id, count):
+        await self._pool.execute(
+            "INSERT INTO credit_ledger (user_id, kind, delta, created_at) "
+            "SELECT user_id, 'grant', $2, $3 FROM users WHERE user_id = $1",
+            user_id, count, db.now_ts()
+        )
+
+    @timed("db")
+    async def reserve_task(self, user_id):
+        now = db.now_ts()
+        async with self._pool.acquire() as connection:
+            is_free = await connection.fetchval(
+                "SELECT EXISTS (SELECT 1 FROM admins WHERE user_id = $1) "
+                "OR EXISTS (SELECT 1 FROM users WHERE user_id = $1 AND subscription_end_date > $2)",
+                user_id, now
+            )
+            if is_free:
+                return True, None
+            # FOR UPDATE: параллельный резерв того же пользователя ждет и перечитывает баланс
+            entry_id = await connection.fetchval(
+                "INSERT INTO credit_ledger (user_id, kind, delta, created_at) "
+                "SELECT user_id, 'reserve', -1, $2 FROM users WHERE user_id = $1 AND tasks_available > 0 FOR UPDATE "
+                "RETURNING entry_id",
+                user_id, now
+            )
+        if entry_id is None:
+            return False, None
+        return True, entry_id
+
+    async def _settle_reservation(self, reservation_id: int, kind: str, delta: int) -> bool:
+        entry_id = await self._pool.fetchval(
+            "INSERT INTO credit_ledger (user_id, kind, delta, reservation_id, created_at) "
+            "SELECT user_id, $2, $3, entry_id, $4 FROM credit_ledger WHERE entry_id = $1 AND kind = 'reserve' "
+            "ON CONFLICT (reservation_id) DO NOTHING RETURNING entry_id",
+            reservation_id, kind, delta, db.now_ts()
+        )
+        return entry_id is not None
+
+    @timed("db")
+    async def commit_task_reservation(self, reservation_id):
+        if reservation_id is None:
+            return False
+        return await self._settle_reservation(reservation_id, "commit", 0)
+
+    @timed("db")
+    async def release_task_reservation(self, reservation_id):
+        if reservation_id is None:
+            return False
+        return await self._settle_reservation(reservation_id, "release", 1)
+
+    @timed("db")
+    async def count_ledger_mismatches(self):
+        return await self._pool.fetchval("""
+            SELECT COUNT(*) FROM users u
+            WHERE u.tasks_available <> (SELECT COALESCE(SUM(delta), 0) FROM credit_ledger l WHERE l.user_id = u.user_id)
+        """)
+
+    # --- Счета ---
+
+    @timed("db")
+    async def add_pending_payment(self, user_id, tariff, amount):
+        return await self._pool.fetchval(
+            "INSERT INTO pending_payments (user_id, tariff, amount, created_at) VALUES ($1, $2, $3, $4) "
+            "RETURNING invoice_id",
+            user_id, tariff, amount, db.now_ts()
+        )
+
+    @timed("db")
+    async def get_pending_payment(self, invoice_id):
+        row = await self._pool.fetchrow(
+            "SELECT user_id, tariff, amount FROM pending_payments WHERE invoice_id = $1", invoice_id
+        )
+        return tuple(row) if row else None
+
+    @timed("db")
+    async def remove_pending_payment(self, invoice_id):
+        await self._pool.execute("DELETE FROM pending_payments WHERE invoice_id = $1", invoice_id)
+
+    @timed("db")
+    async def settle_pending_payment(self, invoice_id):
+        now = db.now_ts()
+        async with self._pool.acquire() as connection:
+            transaction = connection.transaction()
+            await transaction.start()
+            try:
+                # DELETE ... RETURNING блокирует счет: параллельная проводка дождется и не найдет его
+                payment = await connection.fetchrow(
+                    "DELETE FROM pending_payments WHERE invoice_id = $1 RETURNING user_id, tariff, amount, created_at",
+                    invoice_id
+                )
+                inserted = payment is not None and await connection.fetchval(
+                    "INSERT INTO payments (invoice_id, user_id, tariff, amount, created_at, paid_at) "
+                    "VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (invoice_id) DO NOTHING RETURNING invoice_id",
+                    invoice_id, payment["user_id"], payment["tariff"], payment["amount"], payment["created_at"], now
+                )
+                if not inserted:
+                    await transaction.rollback()
+                    return None
+                user_id, tariff = payment["user_id"], payment["tariff"]
+                if tariff in db.TARIFF_SUBSCRIPTION_DAYS:
+                    end_date = now + db.TARIFF_SUBSCRIPTION_DAYS[tariff] * db.SECONDS_IN_DAY
+                    await connection.execute(
+                        "UPDATE users SET subscription_end_date = $2 WHERE user_id = $1", user_id, end_date
+                    )
+                elif tariff in db.TARIFF_TASKS:
+                    await connection.execute(
+                        "INSERT INTO credit_ledger (user_id, kind, delta, created_at) "
+                        "SELECT user_id, 'grant', $2, $3 FROM users WHERE user_id = $1",
+                        user_id, db.TARIFF_TASKS[tariff], now
+                    )
+            except Exception:
+                await transaction.rollback()
+                raise
+            await transaction.commit()
+        return user_id, tariff, payment["amount"]
+
+    @timed("db")
+    async def cleanup_old_pending_payments(self, batch_size: int = db.CLEANUP_BATCH_SIZE):
+        threshold = db.now_ts() - db.PENDING_PAYMENT_TTL
+        deleted_rows = 0
+        while True:
+            # SKIP LOCKED: хосты, чистящие одновременно, берут разные пачки
+            deleted = await self._pool.fetchval("""
+                WITH expired AS (
+                    DELETE FROM pending_payments WHERE invoice_id IN (
+                        SELECT invoice_id FROM pending_payments WHERE created_at < $1
+                        ORDER BY created_at LIMIT $2 FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING created_at, tariff, amount
+                ), summary AS (
+                    INSERT INTO expired_payments_daily (day, tariff, invoices, amount)
+                    SELECT to_char(to_timestamp(created_at), 'YYYY-MM-DD'), COALESCE(tariff, ''),
+                           COUNT(*), COALESCE(SUM(amount), 0)
+                    FROM expired GROUP BY 1, 2
+                    ON CONFLICT (day, tariff) DO UPDATE SET
+                        invoices = expired_payments_daily.invoices + EXCLUDED.invoices,
+                        amount = expired_payments_daily.amount + EXCLUDED.amount
+                )
+                SELECT COUNT(*) FROM expired
+            """, threshold, batch_size)
+            deleted_rows += deleted
+            if deleted < batch_size:
+                break
+
+        db.cleanup_stats["runs"] += 1
+        db.cleanup_stats["deleted_total"] += deleted_rows
+        db.cleanup_stats["deleted_last_run"] = deleted_rows
+        db.cleanup_stats["last_run_at"] = db.now_ts()
+        if deleted_rows > 0:
+            logger.info("Автоматическая очистка: удалено %s старых записей из pending_payments.", deleted_rows)
+        return deleted_rows
+
+    # --- История разборов ---
+
+    @timed("db")
+    async def save_review(self, user_id, task_id, task_type, review):
+        return await self._pool.fetchval(
+            "INSERT INTO review_history (user_id, task_id, task_type, created_at, review) VALUES ($1, $2, $3, $4, $5) "
+            "RETURNING review_id",
+            user_id, task_id, task_type, db.now_ts(), db.compress_review(review)
+        )
+
+    @timed("db")
+    async def get_review_page(self, user_id, review_id=None):
+        query = """
+            SELECT r.review_id, r.task_id, r.task_type, r.created_at, r.review,
+                   (SELECT o.review_id FROM review_history o
+                    WHERE o.user_id = r.user_id AND o.review_id < r.review_id ORDER BY o.review_id DESC LIMIT 1),
+                   (SELECT n.review_id FROM review_history n
+                    WHERE n.user_id = r.user_id AND n.review_id > r.review_id ORDER BY n.review_id LIMIT 1)
+            FROM review_history r
+        """
+        row = None
+        if review_id is not None:
+            row = await self._pool.fetchrow(query + " WHERE r.user_id = $1 AND r.review_id = $2", user_id, review_id)
+        if row is None:
+            row = await self._pool.fetchrow(query + " WHERE r.user_id = $1 ORDER BY r.review_id DESC LIMIT 1", user_id)
+        if row is None:
+            return None
+        review_id, task_id, task_type, created_at, data, older_id, newer_id = row
+        return {
+            "review_id": review_id,
+            "task_id": task_id,
+            "task_type": task_type,
+            "created_at": created_at,
+            "review": db.decompress_review(data),
+            "older_id": older_id,
+            "newer_id": newer_id,
+        }
+
+    # --- Полученные задания ---
+
+    @timed("db")
+    async def get_seen_tasks(self, user_id, task_type):
+        row = await self._pool.fetchrow(
+            "SELECT fingerprint, seen FROM seen_tasks WHERE user_id = $1 AND task_type = $2", user_id, task_type
+        )
+        return tuple(row) if row else None
+
+    @timed("db")
+    async def save_seen_tasks(self, user_id, task_type, fingerprint, seen, previous):
+        # Сравнение с прочитанным набором: два хоста не перезапишут выдачу друг друга
+        if previous is None:
+            saved = await self._pool.fetchval(
+                "INSERT INTO seen_tasks (user_id, task_type, fingerprint, seen) VALUES ($1, $2, $3, $4) "
+                "ON CONFLICT DO NOTHING RETURNING 1",
+                user_id, task_type, fingerprint, seen
+            )
+        else:
+            saved = await self._pool.fetchval(
+                "UPDATE seen_tasks SET fingerprint = $3, seen = $4 "
+                "WHERE user_id = $1 AND task_type = $2 AND fingerprint = $5 AND seen = $6 RETURNING 1",
+                user_id, task_type, fingerprint, seen, *previous
+            )
+        return saved is not None
+
+    @timed("db")
+    async def get_task_catalog(self, fingerprint):
+        task_keys = await self._pool.fetchval("SELECT task_keys FROM task_catalogs WHERE fingerprint = $1", fingerprint)
+        return json.loads(task_keys) if task_keys is not None else None
+
+    @timed("db")
+    async def save_task_catalog(self, fingerprint, task_keys):
+        await self._pool.execute(
+            "INSERT INTO task_catalogs (fingerprint, task_keys, created_at) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING",
+            fingerprint, json.dumps(task_keys, ensure_ascii=False), db.now_ts()
+        )
+
+    # --- Чтение для админки ---
+
+    @timed("db")
+    async def get_stats_summary(self):
+        summary = {}
+        async with self._pool.acquire() as connection:
+            for name, table, column, start in STATS_WINDOWS:
+                rows = await connection.fetch(
+                    f"SELECT metric, dimension, SUM(value) FROM {table} WHERE {column} >= {start} GROUP BY metric, dimension"
+                )
+                period = summary[name] = {}
+                for metric, dimension, value in rows:
+                    period.setdefault(metric, {})[dimension] = value
+        return summary
+
+    async def export_rows(self):
+        async with self._pool.acquire() as connection:
+            # Один снимок на все таблицы; запись других хостов он не блокирует
+            async with connection.transaction(isolation="repeatable_read", readonly=True):
+                for name, columns, _ in db.EXPORT_TABLES:
+                    cursor = await connection.cursor(_EXPORT_QUERIES[name])
+                    rows = await cursor.fetch(db.EXPORT_FETCH_SIZE)
+                    yield name, columns, rows
+                    while rows:
+                        rows = await cursor.fetch(db.EXPORT_FETCH_SIZE)
+                        if rows:
+                            yield name, columns, rows
+
+    # --- Перенос из users.db ---
+
+    async def import_sqlite(self, path: str) -> Dict[str, int]:
+        """
+        Переносит данные из users.db (схема уже обновлена db_start()). Возвращает число строк по таблицам.
+        Пользователи, админы и счета переносятся, только если в PostgreSQL еще нет пользователей.
+        История разборов и наборы полученных заданий переносятся всегда: их можно перенести
+        с каждого хоста, который уже работал с PostgreSQL. Повторный перенос того же файла ничего не дублирует.
+        Бот на время переноса должен быть остановлен.
+        """
+        source = sq.connect(path, timeout=db.TIMEOUT)
+        counts: Dict[str, int] = {}
+
+        async def copy(connection, table, columns, query) -> int:
+            copied = 0
+            for rows in _read_sqlite(source, query):
+                if table == "users":
+                    # is_blocked в SQLite — 0/1
+                    rows = [(*row[:4], bool(row[4]), *row[5:]) for row in rows]
+                await connection.copy_records_to_table(table, records=rows, columns=columns)
+                copied += len(rows)
+            return copied
+
+        try:
+            async with self._pool.acquire() as connection:
+                async with connection.transaction():
+                    if not await connection.fetchval("SELECT EXISTS (SELECT 1 FROM users)"):
+                        # Дат регистрации в users.db нет: без этого триггера все перенесенные
+                        # пользователи попали бы в сводку как новые за сегодня
+                        await connection.execute("ALTER TABLE users DISABLE TRIGGER stats_new_users")
+                        counts["users"] = await copy(connection, *_IMPORT_USERS)
+                        await connection.execute("ALTER TABLE users ENABLE TRIGGER stats_new_users")
+                        for table, columns, query in _IMPORT_TABLES:
+                            counts[table] = await copy(connection, table, columns, query)
+                        admins = [row[0] for row in source.execute("SELECT user_id FROM admins")]
+                        await connection.executemany(
+                            "INSERT INTO admins (user_id) VALUES ($1) ON CONFLICT DO NOTHING", [(user_id,) for user_id in admins]
+                        )
+                        counts["admins"] = len(admins)
+                        # Номера новых счетов продолжают счетчик users.db и не совпадают с уже оплаченными
+                        row = source.execute("SELECT seq FROM sqlite_sequence WHERE name = 'pending_payments'").fetchone()
+                        await connection.execute(
+                            "SELECT setval(pg_get_serial_sequence('pending_payments', 'invoice_id'), "
+                            "GREATEST($1, (SELECT COALESCE(MAX(invoice_id), 0) FROM pending_payments), "
+                            "(SELECT COALESCE(MAX(invoice_id), 0) FROM payments), 1))",
+                            row[0] if row else 0
+                        )
+                    else:
+                        logger.warning("В PostgreSQL уже есть пользователи: переносятся только история разборов "
+                                       "и наборы полученных заданий.")
+
+                    for rows in _read_sqlite(source, "SELECT fingerprint, task_keys, created_at FROM task_catalogs"):
+                        await connection.executemany(
+                            "INSERT INTO task_catalogs (fingerprint, task_keys, created_at) VALUES ($1, $2, $3) "
+                            "ON CONFLICT DO NOTHING", rows
+                        )
+                    # Набор, уже сохраненный в PostgreSQL, новее локального
+                    counts["seen_tasks"] = 0
+                    for rows in _read_sqlite(source, "SELECT user_id, task_type, fingerprint, seen FROM seen_tasks"):
+                        await connection.executemany(
+                            "INSERT INTO seen_tasks (user_id, task_type, fingerprint, seen) VALUES ($1, $2, $3, $4) "
+                            "ON CONFLICT DO NOTHING", rows
+                        )
+                        counts["seen_tasks"] += len(rows)
+                    # Разборы получают новые review_id (на разных хостах номера совпадают); уже перенесенные
+                    # пропускаются. Сводку разборов по дням дополняет триггер stats_reviews
+                    await connection.execute(
+                        "CREATE TEMPORARY TABLE imported_reviews (review_id BIGINT, user_id BIGINT, task_id TEXT, "
+                        "task_type TEXT, created_at BIGINT, review BYTEA) ON COMMIT DROP"
+                    )
+                    await copy(
+                        connection, "imported_reviews", ["review_id", "user_id", "task_id", "task_type", "created_at", "review"],
+                        "SELECT review_id, user_id, task_id, task_type, created_at, review FROM review_history"
+                    )
+                    counts["review_history"] = await connection.fetchval("""
+                        WITH inserted AS (
+                            INSERT INTO review_history (user_id, task_id, task_type, created_at, review)
+                            SELECT i.user_id, i.task_id, i.task_type, i.created_at, i.review
+                            FROM imported_reviews i
+                            WHERE NOT EXISTS (
+                                SELECT 1 FROM review_history r
+                                WHERE r.user_id = i.user_id AND r.created_at = i.created_at AND r.review = i.review
+                            )
+                            ORDER BY i.created_at, i.review_id
+                            RETURNING 1
+                        )
+                        SELECT COUNT(*) FROM inserted
+                    """)
+        finally:
+            source.close()
+        logger.info("Перенос из %s завершен: %s.", path, counts)
+        return counts
+
+
+async def _import_sqlite(path: str):
+    # db_start() обновляет схему users.db до текущей, как при обычном старте бота
+    db.DB_FILE = path
+    store = PostgresStorage(DATABASE_URL)
+    await store.start()
+    try:
+        counts = await store.import_sqlite(path)
+    finally:
+        await store.close()
+    for table, count in counts.items():
+        print(f"{table}: {count}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Обслуживание хранилища PostgreSQL (DATABASE_URL из .env).")
+    parser.add_argument("--import-sqlite", metavar="USERS_DB", required=True,
+                        help="один раз перенести данные из users.db (бот должен быть остановлен)")
+    args = parser.parse_args()
+    if not DATABASE_URL:
+        parser.error("не задан DATABASE_URL")
+    asyncio.run(_import_sqlite(args.import_sqlite))
@@ -1,22 +1,51 @@
 # task_manager.py
 
-import pandas as pd
+import asyncio
+import hashlib
+import logging
 import random
-from typing import List, Dict, Optional, Tuple
-from openpyxl import load_workbook
+import threading
+from typing import Callable, List, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
 
 TASKS_FILE = 'tasks.xlsx'
 tasks_data = {}
+# pandas и openpyxl импортируются вместе с чтением файла, при первом обращении к заданиям
+# (или раньше — в фоновом прогреве из main.py), а не при старте бота
+_loaded = False
+_load_lock = threading.Lock()
+# Загрузка, запущенная из цикла событий: ее ждут все хендлеры, пришедшие до конца чтения файла
+_load_future: Optional[asyncio.Future] = None
+# Колбэки, которые вызываются после изменения промпта (например, сброс кэша контекста Gemini)
+_prompt_listeners: List[Callable[[str, str], None]] = []
 
 def clean_header(header):
     if isinstance(header, str):
         return header.replace('{', '').replace('}', '').strip()
     return header
 
+def task_key(task: Dict) -> str:
+    """Постоянный ключ задания: его ID, а если ID нет — хэш текста."""
+    task_id = task.get('id')
+    if task_id is not None and str(task_id).strip():
+        return str(task_id).strip()
+    return "text:" + hashlib.sha256(str(task.get('task_text')).encode('utf-8')).hexdigest()[:16]
+
+def catalog_fingerprint(keys: List[str]) -> str:
+    """Отпечаток списка заданий листа: меняется при любом добавлении, удалении или перестановке."""
+    return hashlib.sha256("\n".join(keys).encode('utf-8')).hexdigest()[:16]
+
+def _normalize_time_limit(task: Dict) -> Dict:
+    time_limit_str = task.get('time_limit')
+    task['time_limit'] = int(float(time_limit_str)) if time_limit_str and str(time_limit_str).replace('.', '', 1).isdigit() else None
+    return task
+
 def load_data():
     """Загружает задания и промпты из файла tasks.xlsx."""
     global tasks_data
-    
+    import pandas as pd
+
     try:
         xls = pd.ExcelFile(TASKS_FILE)
         tasks_data.clear()
@@ -32,63 +61,118 @@ def load_data():
                 df.columns = [clean_header(col) for col in df.columns]
                 
                 if 'task_text' not in df.columns:
-                    print(f"ПРЕДУПРЕЖДЕНИЕ: На листе '{sheet_name}' не найден столбец 'task_text'. Пропускаем лист.")
+                    logger.warning("На листе '%s' не найден столбец 'task_text'. Пропускаем лист.", sheet_name)
                     continue
                 
                 if 'time' in df.columns:
                     df = df.rename(columns={'time': 'time_limit'})
 
                 df = df.where(pd.notna(df), None)
-                tasks_data[sheet_name] = {"tasks": df.to_dict('records'), "prompt": prompt}
+                tasks = df.to_dict('records')
+                keys = [task_key(task) for task in tasks]
+                tasks_data[sheet_name] = {
+                    "tasks": tasks,
+                    "prompt": prompt,
+                    # Порядок заданий на листе задает номера битов в наборах решенных заданий (seen_tasks.py)
+                    "keys": keys,
+                    "fingerprint": catalog_fingerprint(keys),
+                }
             
             except Exception as e:
-                print(f"ОШИБКА: Не удалось обработать лист '{sheet_name}'. Ошибка: {e}")
+                logger.error("Не удалось обработать лист '%s'. Ошибка: %s", sheet_name, e)
                 continue
 
-        print(f"Файл с заданиями ({TASKS_FILE}) успешно загружен. Обработано листов: {len(tasks_data)}.")
+        logger.info("Файл с заданиями (%s) успешно загружен. Обработано листов: %s.", TASKS_FILE, len(tasks_data))
 
     except FileNotFoundError:
-        print(f"ОШИБКА: Файл с заданиями '{TASKS_FILE}' не найден.")
+        logger.error("Файл с заданиями '%s' не найден.", TASKS_FILE)
     except Exception as e:
-        print(f"ОШИБКА: Не удалось прочитать файл '{TASKS_FILE}'. Ошибка: {e}")
+        logger.error("Не удалось прочитать файл '%s'. Ошибка: %s", TASKS_FILE, e)
+
+def ensure_loaded():
+    """Загружает задания, если это еще не сделано. Безопасно вызывать из нескольких потоков."""
+    global _loaded
+    if _loaded:
+        return
+    with _load_lock:
+        if not _loaded:
+            load_data()
+            _loaded = True
+
+async def ensure_loaded_async():
+    """
+    То же, что ensure_loaded, для хендлеров: файл читается в отдельном потоке, а цикл
+    событий в это время продолжает работу. Одновременные вызовы ждут одно чтение.
+    """
+    global _load_future
+    if _loaded:
+        return
+    if _load_future is None or _load_future.done():
+        _load_future = asyncio.ensure_future(asyncio.to_thread(ensure_loaded))
+    # shield: отмена одного хендлера не должна прерывать общую загрузку
+    await asyncio.shield(_load_future)
 
 def get_task_types() -> List[str]:
+    ensure_loaded()
     return list(tasks_data.keys())
 
 def get_random_task(task_type: str) -> Optional[Tuple[str, Dict]]:
+    ensure_loaded()
     category = tasks_data.get(task_type)
     if not category or not category.get("tasks"):
         return None, None
     
     prompt = category.get("prompt", "Промпт не найден.")
-    tasks = []
-    for task in category["tasks"]:
-        time_limit_str = task.get('time_limit')
-        task['time_limit'] = int(float(time_limit_str)) if time_limit_str and str(time_limit_str).replace('.', '', 1).isdigit() else None
-        tasks.append(task)
-
-    random_task = random.choice(tasks)
+    random_task = _normalize_time_limit(random.choice(category["tasks"]))
     return prompt, random_task
 
+def get_catalog(task_type: str) -> Optional[Tuple[str, List[str]]]:
+    """Отпечаток и ключи заданий листа в порядке следования или None, если заданий нет."""
+    ensure_loaded()
+    category = tasks_data.get(task_type)
+    if not category or not category.get("tasks"):
+        return None
+    return category["fingerprint"], category["keys"]
+
+def get_task_at(task_type: str, index: int) -> Tuple[Optional[str], Optional[Dict]]:
+    """Задание листа по его номеру (порядку на листе)."""
+    ensure_loaded()
+    category = tasks_data.get(task_type)
+    if not category or not 0 <= index < len(category.get("tasks", [])):
+        return None, None
+    return category.get("prompt", "Промпт не найден."), _normalize_time_limit(category["tasks"][index])
+
+def get_task_type_by_id(task_id: str) -> Optional[str]:
+    """Возвращает тип (лист) задания по его ID или None."""
+    ensure_loaded()
+    for task_type, category_data in tasks_data.items():
+        for task in category_data.get("tasks", []):
+            if str(task.get("id")) == str(task_id):
+                return task_type
+    return None
+
 def get_task_by_id(task_id: str) -> Optional[Tuple[str, Dict]]:
+    ensure_loaded()
     for task_type, category_data in tasks_data.items():
         prompt = category_data.get("prompt", "Промпт не найден.")
         for task in category_data.get("tasks", []):
             if str(task.get("id")) == str(task_id):
-                time_limit_str = task.get('time_limit')
-                task['time_limit'] = int(float(time_limit_str)) if time_limit_str and str(time_limit_str).replace('.', '', 1).isdigit() else None
-                return prompt, task
+                return prompt, _normalize_time_limit(task)
     return None, None
 
 # --- НОВАЯ ФУНКЦИЯ ДЛЯ СОХРАНЕНИЯ ПРОМПТА ---
 def save_prompt(task_type: str, new_prompt: str) -> bool:
     """Сохраняет новый промпт в файл tasks.xlsx и обновляет его в памяти."""
+    ensure_loaded()
+    from openpyxl import load_workbook
     try:
         # Обновляем промпт в оперативной памяти
         if task_type in tasks_data:
+            old_prompt = tasks_data[task_type].get('prompt', '')
             tasks_data[task_type]['prompt'] = new_prompt
         else:
             return False
+        _notify_prompt_listeners(task_type, old_prompt)
 
         # Открываем Excel файл для записи
         book = load_workbook(TASKS_FILE)
@@ -97,15 +181,25 @@ def save_prompt(task_type: str, new_prompt: str) -> bool:
             # Записываем новый промпт в первую ячейку (A1)
             sheet['A1'] = new_prompt
             book.save(TASKS_FILE)
-            print(f"Промпт для '{task_type}' успешно сохранен в файл.")
+            logger.info("Промпт для '%s' успешно сохранен в файл.", task_type)
             return True
         else:
-            print(f"ОШИБКА: Лист '{task_type}' не найден в файле {TASKS_FILE}.")
+            logger.error("Лист '%s' не найден в файле %s.", task_type, TASKS_FILE)
             return False
     except Exception as e:
-        print(f"ОШИБКА при сохранении промпта в файл: {e}")
+        logger.error("ОШИБКА при сохранении промпта в файл: %s", e)
         return False
 
 
-# Загружаем данные один раз при старте бота
-load_data()
\ No newline at end of file
+def _notify_prompt_listeners(task_type: str, old_prompt: str):
+    for listener in list(_prompt_listeners):
+        try:
+            listener(task_type, old_prompt)
+        except Exception as e:
+            logger.exception("ОШИБКА в обработчике изменения промпта: %s", e)
+
+
+def add_prompt_listener(listener: Callable[[str, str], None]):
+    """Регистрирует функцию, которая будет вызвана с типом задания и старым промптом после его изменения."""
+    if listener not in _prompt_listeners:
+        _prompt_listeners.append(listener)
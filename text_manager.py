@@ -1,12 +1,15 @@
 # text_manager.py
+import logging
 import yaml
 
+logger = logging.getLogger(__name__)
+
 def load_texts():
     try:
         with open('texts.yml', 'r', encoding='utf-8') as file:
             return yaml.safe_load(file)
     except FileNotFoundError:
-        print("Error: texts.yml not found. Please create the texts file.")
+        logger.error("texts.yml not found. Please create the texts file.")
         return {}
 
 texts = load_texts()
@@ -0,0 +1,153 @@
+# throttling.py
+
+import logging
+import re
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from config import THROTTLING
+from metrics import describe, inc
+from text_manager import get_text
+
+logger = logging.getLogger(__name__)
+
+# Защита от флуда: корзины токенов в памяти. Каждый апдейт забирает токен из корзины пользователя,
+# нажатие кнопки — еще и из корзины этого типа кнопки у пользователя, и оба — из общей корзины бота.
+# Токены восстанавливаются со скоростью rate в секунду, но не больше burst.
+ENABLED = THROTTLING
+
+# Любые апдейты одного пользователя
+USER_RATE = 1.0
+USER_BURST = 20
+# Нажатия одной кнопки одним пользователем. Для тяжелых кнопок (база, запросы в Robokassa) — строже;
+# тип определяется по началу callback_data
+CALLBACK_LIMITS: Tuple[Tuple[str, float, int], ...] = (
+    ("check_robokassa_payment", 0.2, 3),
+    ("buy_", 0.2, 3),
+    ("get_task", 0.5, 5),
+    ("select_task_", 0.5, 5),
+)
+DEFAULT_CALLBACK_RATE = 1.0
+DEFAULT_CALLBACK_BURST = 10
+# Общий предел для всего бота: сверх него апдейты отбрасываются, пока нагрузка не спадет
+GLOBAL_RATE = 100.0
+GLOBAL_BURST = 300
+
+# Корзина, к которой не обращались дольше этого, уже полная — ее можно забыть
+IDLE_TTL = 60.0
+MAX_BUCKETS = 200_000
+
+THROTTLED_METRIC = "egebot_throttled_total"
+describe(THROTTLED_METRIC, "Апдейты, отклоненные защитой от флуда; scope=user|callback|global")
+
+# Счетчики отказов для отчетов (то же, что в метрике THROTTLED_METRIC, без меток kind)
+throttle_stats: Counter = Counter()
+
+# Числа в callback_data (ID, страницы) не делают кнопку новым типом
+_NUMBERS = re.compile(r"\d+")
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated", "notified")
+
+    def __init__(self, burst: int, now: float):
+        self.tokens = float(burst)
+        self.updated = now
+        # Пользователю уже сообщили об ограничении (на сообщения отвечаем один раз за серию)
+        self.notified = False
+
+    def take(self, rate: float, burst: int, now: float) -> bool:
+        tokens = min(float(burst), self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if tokens < 1.0:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1.0
+        return True
+
+
+def callback_limit(data: str) -> Tuple[str, float, int]:
+    """Тип кнопки и ее лимит (rate, burst) по callback_data."""
+    for prefix, rate, burst in CALLBACK_LIMITS:
+        if data.startswith(prefix):
+            return prefix, rate, burst
+    return _NUMBERS.sub("#", data), DEFAULT_CALLBACK_RATE, DEFAULT_CALLBACK_BURST
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Внешний middleware для dp.message и dp.callback_query: отклоняет апдейты сверх лимитов
+    до фильтров и хендлеров. На кнопки отвечает всплывающим уведомлением (иначе кнопка «висит»),
+    на сообщения — один раз за серию; при общей перегрузке сообщения отбрасываются молча.
+    """
+
+    def __init__(self):
+        # Корзины пользователей и их кнопок: порядок — от давно не использованных к недавним
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+        self._global = TokenBucket(GLOBAL_BURST, time.monotonic())
+
+    def _bucket(self, key: Hashable, burst: int, now: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(burst, now)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _evict(self, now: float):
+        buckets = self._buckets
+        while buckets:
+            oldest = next(iter(buckets.values()))
+            if now - oldest.updated < IDLE_TTL and len(buckets) <= MAX_BUCKETS:
+                break
+            buckets.popitem(last=False)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if not ENABLED or user is None:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        self._evict(now)
+        user_bucket = self._bucket(user.id, USER_BURST, now)
+        if not user_bucket.take(USER_RATE, USER_BURST, now):
+            inc(THROTTLED_METRIC, scope="user", kind=type(event).__name__)
+            throttle_stats["user"] += 1
+            return await self._reject(event, user_bucket, 'throttled')
+
+        bucket = user_bucket
+        if isinstance(event, CallbackQuery) and event.data:
+            kind, rate, burst = callback_limit(event.data)
+            bucket = self._bucket((user.id, kind), burst, now)
+            if not bucket.take(rate, burst, now):
+                inc(THROTTLED_METRIC, scope="callback", kind=kind)
+                throttle_stats["callback"] += 1
+                return await self._reject(event, bucket, 'throttled')
+
+        if not self._global.take(GLOBAL_RATE, GLOBAL_BURST, now):
+            inc(THROTTLED_METRIC, scope="global", kind=type(event).__name__)
+            throttle_stats["global"] += 1
+            return await self._reject(event, None, 'throttled_global')
+
+        user_bucket.notified = bucket.notified = False
+        return await handler(event, data)
+
+    @staticmethod
+    async def _reject(event: TelegramObject, bucket, text_key: str):
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer(get_text(text_key))
+            elif isinstance(event, Message) and bucket is not None and not bucket.notified:
+                bucket.notified = True
+                await event.answer(get_text(text_key))
+        except Exception as e:
+            logger.debug("Не удалось ответить на отклоненный апдейт: %s", e)
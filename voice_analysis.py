@@ -0,0 +1,119 @@
+# voice_analysis.py
+#
+# Анализ голосовых в процессах пула (см. audio_processing.py). Модуль намеренно
+# не импортирует ничего из бота: процессы пула загружают только его и numpy.
+
+import os
+import subprocess
+
+SAMPLE_RATE = 16000
+FRAME_MS = 30
+# Кадр тише этого уровня (дБ относительно полной шкалы) речью не считается никогда
+MIN_SPEECH_DB = -45.0
+# Насколько кадр должен быть громче фонового шума, чтобы считаться речью
+NOISE_MARGIN_DB = 12.0
+# Паузы короче этого внутри речи не вырезаются (кадры)
+HANGOVER_FRAMES = 10
+# Запас тишины, который оставляется до и после речи (секунды)
+PAD_SECONDS = 0.25
+# Меньше этого количества речи — запись считается пустой (случайное нажатие, тишина)
+MIN_SPEECH_SECONDS = 0.7
+# Битрейт для пережатия: для распознавания речи моно 24 кбит/с Opus достаточно
+OUTPUT_BITRATE = "24k"
+# Сложность кодера Opus (0-10) и длина кадра: запись не нужна в реальном времени,
+# поэтому длинные кадры и средняя сложность — вдвое быстрее настроек по умолчанию при меньшем размере
+OUTPUT_COMPRESSION_LEVEL = "3"
+OUTPUT_FRAME_MS = "60"
+FFMPEG_TIMEOUT = 60
+
+VOICE_OK = "ok"
+VOICE_EMPTY = "empty"
+
+
+def warm_up() -> bool:
+    """Импортирует numpy в процессе пула, чтобы первое голосовое не ждало загрузки."""
+    import numpy  # noqa: F401
+    return True
+
+
+def _decode(ffmpeg: str, path: str) -> bytes:
+    """Декодирует файл в 16-битный моно PCM с частотой SAMPLE_RATE."""
+    completed = subprocess.run(
+        [ffmpeg, "-hide_banner", "-loglevel", "error", "-i", path,
+         "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"],
+        capture_output=True, timeout=FFMPEG_TIMEOUT, check=True,
+    )
+    return completed.stdout
+
+
+def _encode(ffmpeg: str, pcm: bytes, output_path: str):
+    """Сжимает PCM в OGG/Opus, настроенный на речь."""
+    subprocess.run(
+        [ffmpeg, "-hide_banner", "-loglevel", "error", "-y",
+         "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-i", "pipe:0",
+         "-c:a", "libopus", "-b:a", OUTPUT_BITRATE, "-application", "voip",
+         "-compression_level", OUTPUT_COMPRESSION_LEVEL, "-frame_duration", OUTPUT_FRAME_MS, output_path],
+        input=pcm, capture_output=True, timeout=FFMPEG_TIMEOUT, check=True,
+    )
+
+
+def detect_speech(samples):
+    """
+    Возвращает (маска речевых кадров, маска со сглаживанием пауз).
+    Порог — выше фонового шума на NOISE_MARGIN_DB, но не выше пика минус NOISE_MARGIN_DB
+    (иначе непрерывная речь без пауз целиком ушла бы в "шум") и не ниже MIN_SPEECH_DB.
+    """
+    import numpy as np
+
+    frame = SAMPLE_RATE * FRAME_MS // 1000
+    count = len(samples) // frame
+    if count == 0:
+        empty = np.zeros(0, dtype=bool)
+        return empty, empty
+    frames = samples[:count * frame].reshape(count, frame).astype(np.float32) / 32768.0
+    levels = 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-12)
+    noise_floor = np.percentile(levels, 20)
+    threshold = max(MIN_SPEECH_DB, min(noise_floor + NOISE_MARGIN_DB, levels.max() - NOISE_MARGIN_DB))
+    speech = levels > threshold
+    smoothed = np.convolve(speech, np.ones(HANGOVER_FRAMES, dtype=np.int32), mode="same") > 0
+    return speech, smoothed
+
+
+def prescreen_file(ffmpeg: str, path: str, output_path: str) -> dict:
+    """
+    Выполняется в процессе пула. Ищет речь в записи; если ее нет — VOICE_EMPTY,
+    иначе обрезает тишину по краям, сводит в моно и сохраняет в output_path.
+    """
+    import numpy as np
+
+    bytes_in = os.path.getsize(path)
+    samples = np.frombuffer(_decode(ffmpeg, path), dtype=np.int16)
+    duration = len(samples) / SAMPLE_RATE
+    speech, smoothed = detect_speech(samples)
+    speech_seconds = float(speech.sum()) * FRAME_MS / 1000
+    result = {
+        "status": VOICE_OK,
+        "path": path,
+        "duration": round(duration, 2),
+        "speech_seconds": round(speech_seconds, 2),
+        "bytes_in": bytes_in,
+        "bytes_out": bytes_in,
+    }
+    if speech_seconds < MIN_SPEECH_SECONDS:
+        result.update(status=VOICE_EMPTY, bytes_out=0)
+        return result
+
+    frame = SAMPLE_RATE * FRAME_MS // 1000
+    voiced = np.flatnonzero(smoothed)
+    pad = int(PAD_SECONDS * SAMPLE_RATE)
+    start = max(int(voiced[0]) * frame - pad, 0)
+    end = min((int(voiced[-1]) + 1) * frame + pad, len(samples))
+    _encode(ffmpeg, samples[start:end].tobytes(), output_path)
+
+    bytes_out = os.path.getsize(output_path)
+    if bytes_out >= bytes_in:
+        # Пережатие не помогло — отправляем оригинал
+        os.remove(output_path)
+        return result
+    result.update(path=output_path, bytes_out=bytes_out, trimmed_seconds=round((end - start) / SAMPLE_RATE, 2))
+    return result